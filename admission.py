@@ -0,0 +1,151 @@
+"""Admission control for the server, so one flooding client can't starve the rest
+
+Each request costs a token from its sender name's bucket and its source IP's
+bucket, and at most max_in_flight requests are served at once with a bounded
+number waiting for a turn. A request that is over a limit is answered straight
+away with a retry later frame rather than being served slowly, and counted.
+
+Name: Zya Gurau
+"""
+
+import threading
+import time
+
+# seconds a request waits for an in-flight slot before being told to retry later
+ADMISSION_WAIT = 1.0
+# the retry delay suggested when the in-flight limit is reached
+IN_FLIGHT_RETRY = 0.05
+# buckets are pruned every this many requests, a full one is dropped as it is the same as a new one
+PRUNE_EVERY = 4096
+# seconds between the rejection counts in the server log
+ADMISSION_REPORT_INTERVAL = 10
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens, updated):
+        self.tokens = tokens
+        self.updated = updated
+
+class Admission:
+    """The admission limits of a server and the state enforcing them, None leaves a limit off
+
+    Args:
+        sender_rate (float): requests per second allowed for each sender name
+        sender_burst (float): requests a sender name may make at once, sender_rate if not given
+        ip_rate (float): requests per second allowed from each source IP
+        ip_burst (float): requests an IP may make at once, ip_rate if not given
+        max_in_flight (int): the most requests served at once
+        queue (int): the most requests waiting for an in-flight slot
+    """
+
+    def __init__(self, sender_rate=None, sender_burst=None, ip_rate=None, ip_burst=None, max_in_flight=None, queue=64):
+        self.sender_rate = sender_rate
+        self.sender_burst = max(1, sender_burst or sender_rate or 1)
+        self.ip_rate = ip_rate
+        self.ip_burst = max(1, ip_burst or ip_rate or 1)
+        self.max_in_flight = max_in_flight
+        self.queue = queue
+        self.lock = threading.Lock()
+        self.sender_buckets = dict()
+        self.ip_buckets = dict()
+        self.requests = 0
+        self.slots = threading.Condition()
+        self.in_flight = 0
+        self.waiting = 0
+        self.rejected = {"sender": 0, "ip": 0, "in_flight": 0}
+        self.last_report = time.monotonic()
+
+    def refill(self, buckets, key, rate, burst, now):
+        """Adds the tokens key's bucket has earned since it was last used, without taking one
+
+        Returns:
+            bucket (TokenBucket): the bucket
+            (float): None if it has a token, otherwise seconds until it will
+        """
+
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = TokenBucket(burst, now)
+        bucket.tokens = min(burst, bucket.tokens + (now - bucket.updated) * rate)
+        bucket.updated = now
+        if bucket.tokens >= 1:
+            return bucket, None
+        return bucket, (1 - bucket.tokens) / rate
+
+    def prune(self, buckets, rate, burst, now):
+        for key, bucket in list(buckets.items()):
+            if bucket.tokens + (now - bucket.updated) * rate >= burst:
+                del buckets[key]
+
+    def admit(self, sender, ip):
+        """Decides whether to serve a request, an admitted request must be released
+
+        Args:
+            sender (str): the sender name of the request
+            ip (str): the source IP, None for a Unix socket
+
+        Returns:
+            (tuple): None if admitted, otherwise the reason and the seconds to wait before retrying
+        """
+
+        now = time.monotonic()
+        with self.lock:
+            self.requests += 1
+            if self.requests % PRUNE_EVERY == 0:
+                if self.ip_rate is not None:
+                    self.prune(self.ip_buckets, self.ip_rate, self.ip_burst, now)
+                if self.sender_rate is not None:
+                    self.prune(self.sender_buckets, self.sender_rate, self.sender_burst, now)
+            # both buckets are checked before a token is taken from either, so a request
+            # refused by one limit doesn't use up the other
+            taken = []
+            if self.ip_rate is not None and ip is not None:
+                bucket, retry_after = self.refill(self.ip_buckets, ip, self.ip_rate, self.ip_burst, now)
+                if retry_after is not None:
+                    return self.reject("ip", retry_after)
+                taken.append(bucket)
+            if self.sender_rate is not None:
+                bucket, retry_after = self.refill(self.sender_buckets, sender, self.sender_rate,
+                    self.sender_burst, now)
+                if retry_after is not None:
+                    return self.reject("sender", retry_after)
+                taken.append(bucket)
+            for bucket in taken:
+                bucket.tokens -= 1
+
+        with self.slots:
+            if self.max_in_flight is not None and self.in_flight >= self.max_in_flight:
+                if self.waiting >= self.queue:
+                    return self.reject("in_flight", IN_FLIGHT_RETRY)
+                self.waiting += 1
+                try:
+                    if not self.slots.wait_for(lambda: self.in_flight < self.max_in_flight, ADMISSION_WAIT):
+                        return self.reject("in_flight", IN_FLIGHT_RETRY)
+                finally:
+                    self.waiting -= 1
+            self.in_flight += 1
+        return None
+
+    def reject(self, reason, retry_after):
+        # called holding lock or slots, the counts are only read for reports
+        self.rejected[reason] += 1
+        return reason, retry_after
+
+    def release(self):
+        with self.slots:
+            self.in_flight -= 1
+            self.slots.notify()
+
+    def report_due(self):
+        """Returns True at most once every ADMISSION_REPORT_INTERVAL seconds"""
+
+        now = time.monotonic()
+        if now - self.last_report < ADMISSION_REPORT_INTERVAL:
+            return False
+        self.last_report = now
+        return True
+
+    def metrics(self):
+        return {"in_flight": self.in_flight, "waiting": self.waiting, "rejected": dict(self.rejected),
+            "senders": len(self.sender_buckets), "ips": len(self.ip_buckets)}
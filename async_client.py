@@ -0,0 +1,566 @@
+"""Importable asyncio client for the socket based networking application
+
+AsyncClient sends v2 requests over a pool of keep-alive connections and raises
+exceptions rather than exiting, so it can be embedded in other programs:
+
+    async with AsyncClient("localhost", 50000, "zya") as client:
+        await client.create("bob", ciphertext)
+        messages, more_msgs = await client.read()
+
+Messages are opaque bytes, encrypting them is left to the caller.
+
+Author: Zya Gurau
+"""
+
+import asyncio
+import os
+import time
+from common import (MessageRequestV2, KEYS_BINARY_ID, REGISTER_BINARY_ID, STATUS_ID, RETRY_LATER_ID, UPLOAD_STATE_ID, UPLOAD_OPEN_ID,
+    UPLOAD_CHUNK_ID, UPLOAD_QUERY_ID, DEPTH_ID, DEPTH_ITEM, DEPTH_MAX_NAMES,
+    STATUS_OK, STATUS_UNKNOWN_UPLOAD, STATUS_BAD_OFFSET, STATUS_DROPPED_OLDEST, MAGIC_V2, RESPONSE_HEADER_V2, ITEM_HEADER_V2,
+    KEY_HEADER_V2, UPLOAD_OPEN, UPLOAD_CHUNK, UPLOAD_QUERY, UPLOAD_STATE, TTL, READ_ACKED, CURSOR, FLAG_KEEP_ALIVE, FLAG_TTL,
+    FLAG_ACK, FLAG_MORE_MSGS, FLAG_CURSOR,
+    FLAG_UPLOAD_COMPLETE, PAGE_SIZE_V2, MAX_KEY_BITS, encode_key_int, decode_key_int, parse_address)
+
+# size of each chunk of a resumable upload
+UPLOAD_PIECE = 4 * 1024 * 1024
+# how many times in a row a failed upload request is retried
+UPLOAD_RETRIES = 5
+# how many times a request the server said to retry later is sent again
+RETRY_LATER_RETRIES = 3
+# requests that can be sent again if a connection fails after they were written, they
+# only look at the server's state or, for uploads, name the token and offset they change
+RETRY_SAFE_IDS = (KEYS_BINARY_ID, DEPTH_ID, UPLOAD_OPEN_ID, UPLOAD_CHUNK_ID, UPLOAD_QUERY_ID)
+# seconds a pooled connection may sit idle before it is closed instead of reused, less
+# than the server's idle deadline so a request isn't sent as the server closes it
+POOL_IDLE_TIMEOUT = 30
+
+class ClientError(Exception):
+    """Base class of the errors raised by AsyncClient"""
+
+class ProtocolError(ClientError):
+    """The server sent something other than the expected response"""
+
+class ClientTimeoutError(ClientError):
+    """A request did not complete within the client's timeout"""
+
+class ClientConnectionError(ClientError):
+    """The connection to the server could not be made or was lost"""
+
+class StatusError(ClientError):
+    """The server answered a request with a status other than STATUS_OK"""
+
+    def __init__(self, message, status):
+        super().__init__(message + " (status " + str(status) + ")")
+        self.status = status
+
+class RetryLater(ClientError):
+    """The server is over its admission limits and closed the connection, retry_after is in seconds"""
+
+    def __init__(self, retry_after):
+        super().__init__("server is busy, retry after " + str(retry_after) + " seconds")
+        self.retry_after = retry_after
+
+class ConnectionPool:
+    """A bounded pool of keep-alive connections to one server
+
+    At most size connections are open at once, a request waits for a free one.
+    Connections are handed back for reuse only after a complete exchange, and
+    one left idle for more than max_idle seconds is closed rather than reused.
+    """
+
+    def __init__(self, host, port, size=4, max_idle=POOL_IDLE_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.max_idle = max_idle
+        self.path = None
+        if host.startswith("unix:"):
+            family, self.path = parse_address(host)
+        # (conn, time it was handed back), most recently used last
+        self.idle = []
+        self.slots = asyncio.Semaphore(size)
+
+    async def acquire(self):
+        """Takes an idle connection or opens a new one
+
+        Returns:
+            conn (tuple): the (StreamReader, StreamWriter) pair
+            reused (bool): True if the connection has served a request before
+        """
+
+        await self.slots.acquire()
+        now = time.monotonic()
+        while self.idle:
+            conn, released = self.idle.pop()
+            if now - released <= self.max_idle:
+                return conn, True
+            conn[1].close()
+        try:
+            if self.path is not None:
+                return await asyncio.open_unix_connection(self.path), False
+            return await asyncio.open_connection(self.host, self.port), False
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def release(self, conn, keep):
+        if keep:
+            self.idle.append((conn, time.monotonic()))
+        else:
+            conn[1].close()
+        self.slots.release()
+
+    async def close(self):
+        while self.idle:
+            (reader, writer), released = self.idle.pop()
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+async def read_header(reader, r_id):
+    """Reads a v2 response header, checking it is the response that was expected
+
+    Returns:
+        flags (int): the response flags
+        num_items (int): the item count, or the status code of a status frame
+    """
+
+    magic_no, got_id, flags, num_items = RESPONSE_HEADER_V2.unpack(await reader.readexactly(RESPONSE_HEADER_V2.size))
+    if magic_no != MAGIC_V2:
+        raise ProtocolError("magic number incorrect")
+    if got_id == STATUS_ID and r_id != STATUS_ID:
+        raise StatusError("server refused the request", num_items)
+    if got_id == RETRY_LATER_ID:
+        raise RetryLater(num_items / 1000)
+    if got_id != r_id:
+        raise ProtocolError("expected response ID " + str(r_id) + " but got " + str(got_id))
+    return flags, num_items
+
+async def read_status(reader):
+    flags, status = await read_header(reader, STATUS_ID)
+    if status != STATUS_OK:
+        raise StatusError("server refused the request", status)
+    return status
+
+async def read_create_status(reader):
+    """Reads the status of a 'create', a message stored by dropping older ones is not an error"""
+
+    flags, status = await read_header(reader, STATUS_ID)
+    if status not in (STATUS_OK, STATUS_DROPPED_OLDEST):
+        raise StatusError("server refused the message", status)
+    return status
+
+async def read_items(reader):
+    flags, num_items = await read_header(reader, 3)
+    return await read_page(reader, flags, num_items)
+
+async def read_items_acked(reader):
+    """Reads the reply to an acknowledged read
+
+    Returns:
+        items (list): (sender name, message bytes) tuples, oldest first
+        more_msgs (bool): True if the server has more messages
+        cursor (int): acknowledges this page and every earlier one
+    """
+
+    num_items, more_msgs, cursor = await read_acked_header(reader)
+    items = []
+    for i in range(num_items):
+        items.append(await read_item(reader))
+    return items, more_msgs, cursor
+
+async def read_page(reader, flags, num_items):
+    items = []
+    for i in range(num_items):
+        items.append(await read_item(reader))
+    return items, bool(flags & FLAG_MORE_MSGS)
+
+async def read_item(reader):
+    """Reads one message of a read reply, returning its sender name and bytes"""
+
+    sender_len, message_len = ITEM_HEADER_V2.unpack(await reader.readexactly(ITEM_HEADER_V2.size))
+    sender = (await reader.readexactly(sender_len)).decode("utf-8")
+    return sender, await reader.readexactly(message_len)
+
+async def read_acked_header(reader):
+    """Reads the header and cursor of the reply to an acknowledged read, leaving its messages to be read
+
+    Returns:
+        num_items (int): the number of messages that follow
+        more_msgs (bool): True if the server has more messages after this page
+        cursor (int): acknowledges this page once it has been handled
+    """
+
+    flags, num_items = await read_header(reader, 3)
+    if not flags & FLAG_CURSOR:
+        raise ProtocolError("acknowledged read reply has no cursor")
+    cursor = CURSOR.unpack(await reader.readexactly(CURSOR.size))[0]
+    return num_items, bool(flags & FLAG_MORE_MSGS), cursor
+
+async def read_keys(reader):
+    flags, num_items = await read_header(reader, KEYS_BINARY_ID)
+    keys = dict()
+    for i in range(num_items):
+        name_len, e_len, n_len = KEY_HEADER_V2.unpack(await reader.readexactly(KEY_HEADER_V2.size))
+        fields = await reader.readexactly(name_len + e_len + n_len)
+        e = decode_key_int(fields[name_len:name_len + e_len], True)
+        n = decode_key_int(fields[name_len + e_len:], True)
+        keys[fields[:name_len].decode("utf-8")] = (n, e)
+    return keys
+
+async def read_depths(reader):
+    flags, num_items = await read_header(reader, DEPTH_ID)
+    return list(DEPTH_ITEM.iter_unpack(await reader.readexactly(num_items * DEPTH_ITEM.size)))
+
+async def read_upload_state(reader):
+    flags, status = await read_header(reader, UPLOAD_STATE_ID)
+    offset = UPLOAD_STATE.unpack(await reader.readexactly(UPLOAD_STATE.size))[0]
+    return status, bool(flags & FLAG_UPLOAD_COMPLETE), offset
+
+class AsyncClient:
+    """Sends requests to the server on behalf of one named client
+
+    Args:
+        host (str): the server host name or address, or 'unix:/path' for a server's Unix domain socket
+        port (int): the server port, unused for a Unix domain socket
+        name (str): the name requests are sent as
+        pool_size (int): the most connections open at once
+        timeout (float): seconds a request may take before ClientTimeoutError is raised
+        pool_idle (float): seconds a pooled connection may be left idle and still be reused
+    """
+
+    def __init__(self, host, port, name, pool_size=4, timeout=5.0, pool_idle=POOL_IDLE_TIMEOUT):
+        self.name = name
+        self.name_bytes = name.encode("utf-8")
+        if len(self.name_bytes) < 1 or len(self.name_bytes) > 255:
+            raise ValueError("user name must be at least one character and less than 255 bytes")
+        self.timeout = timeout
+        self.pool = ConnectionPool(host, port, pool_size, pool_idle)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        await self.pool.close()
+
+    def make_request(self, r_id, rec_name_bytes=b"", message=b"", flags=0):
+        message_request = MessageRequestV2(r_id, len(self.name_bytes), len(rec_name_bytes), len(message),
+            FLAG_KEEP_ALIVE | flags)
+        message_request.add_name(self.name_bytes)
+        message_request.add_reciever_name(rec_name_bytes)
+        message_request.add_message(message)
+        return message_request
+
+    async def request(self, message_request, get_reply, data=b"", hold=False):
+        """Sends a request on a pooled connection and parses the reply
+
+        A pooled connection may have been closed by the server while idle. One the
+        server is known to have closed is dropped before anything is written to it,
+        and a failure on a reused connection is retried once on a new one only for the
+        RETRY_SAFE_IDS requests, as the server may have acted on any other request
+        before the connection failed and a create would be stored twice. A request the
+        server says to retry later is sent again after the wait it asks for, up to
+        RETRY_LATER_RETRIES times within the timeout.
+
+        Args:
+            message_request (MessageRequestV2): the request
+            get_reply (coroutine function): parses the reply from the StreamReader
+            data (bytes): sent after the request content
+            hold (bool): True if get_reply only parses the start of the reply, the
+                connection is then returned too and must be handed back with pool.release()
+
+        Returns:
+            the value returned by get_reply, and the connection if hold is True
+        """
+
+        return await self.within_timeout(self.retry_exchange(message_request, get_reply, data, hold))
+
+    async def within_timeout(self, awaitable):
+        try:
+            return await asyncio.wait_for(awaitable, self.timeout)
+        except asyncio.TimeoutError:
+            raise ClientTimeoutError("server timed out")
+
+    async def retry_exchange(self, message_request, get_reply, data, hold):
+        for attempt in range(RETRY_LATER_RETRIES):
+            try:
+                return await self.exchange(message_request, get_reply, data, hold)
+            except RetryLater as err:
+                await asyncio.sleep(err.retry_after)
+        return await self.exchange(message_request, get_reply, data, hold)
+
+    async def exchange(self, message_request, get_reply, data, hold):
+        attempt = 0
+        while True:
+            try:
+                conn, reused = await self.pool.acquire()
+            except OSError as err:
+                raise ClientConnectionError(str(err))
+            keep = False
+            held = False
+            try:
+                reader, writer = conn
+                if reused and (reader.at_eof() or writer.is_closing()):
+                    # the server closed it while idle, nothing has been sent so try another
+                    continue
+                writer.write(message_request.content)
+                if data:
+                    writer.write(data)
+                await writer.drain()
+                result = await get_reply(reader)
+                if hold:
+                    held = True
+                    return result, conn
+                keep = True
+                return result
+            except StatusError:
+                # the refusal was read in full so the connection can be reused
+                keep = True
+                raise
+            except (OSError, asyncio.IncompleteReadError) as err:
+                attempt += 1
+                if not reused or attempt == 2 or message_request.id not in RETRY_SAFE_IDS:
+                    raise ClientConnectionError("connection lost - " + str(err))
+            except (UnicodeDecodeError, ValueError) as err:
+                raise ProtocolError(str(err))
+            finally:
+                if not held:
+                    self.pool.release(conn, keep)
+
+    async def create(self, receiver, message, ttl=None):
+        """Stores a message for another client
+
+        A server with byte caps raises StatusError with STATUS_MAILBOX_FULL if it refuses
+        the message.
+
+        Args:
+            receiver (str): the name of the reciever
+            message (bytes): the message, at least one byte
+            ttl (int): seconds the message may wait to be read, the server may keep it for less
+
+        Returns:
+            status (int): STATUS_OK, or STATUS_DROPPED_OLDEST if the reciever's oldest
+                messages were dropped to make room
+        """
+
+        rec_name_bytes = receiver.encode("utf-8")
+        if len(rec_name_bytes) < 1 or len(rec_name_bytes) > 255:
+            raise ValueError("Reciever name must be at least 1 character long and at most 255 bytes")
+        if len(message) < 1:
+            raise ValueError("message must be at least one byte")
+        if ttl is None:
+            return await self.request(self.make_request(2, rec_name_bytes, message), read_create_status)
+        # the TTL goes between the names and the message
+        message_request = MessageRequestV2(2, len(self.name_bytes), len(rec_name_bytes), len(message),
+            FLAG_KEEP_ALIVE | FLAG_TTL)
+        message_request.add_name(self.name_bytes)
+        message_request.add_reciever_name(rec_name_bytes)
+        message_request.add_message(TTL.pack(ttl))
+        message_request.add_message(message)
+        return await self.request(message_request, read_create_status)
+
+    async def read(self, max_items=PAGE_SIZE_V2, sender=None):
+        """Collects up to max_items of the messages stored for this client, removing them from the server
+
+        Args:
+            max_items (int): the most messages to return
+            sender (str): only messages from this client are returned if given, the
+                server finds them through an index and leaves the others queued
+
+        Returns:
+            items (list): (sender name, message bytes) tuples, oldest first
+            more_msgs (bool): True if the server has more messages, from sender if given
+        """
+
+        sender_bytes = b""
+        if sender is not None:
+            sender_bytes = sender.encode("utf-8")
+            if len(sender_bytes) < 1 or len(sender_bytes) > 255:
+                raise ValueError("sender name must be at least 1 character long and at most 255 bytes")
+        return await self.request(self.make_request(1, sender_bytes, max_items.to_bytes(4, "big")), read_items)
+
+    async def read_acked(self, max_items=PAGE_SIZE_V2, ack=0):
+        """Collects the next max_items messages, leaving them on the server until acknowledged
+
+        Passing a page's cursor as ack to a later call removes that page and every
+        earlier one. The next page starts after those still in flight, so several
+        calls passing the same cursor fetch several pages to handle while the
+        earlier ones are acknowledged:
+
+            items, more_msgs, cursor = await client.read_acked()
+            while more_msgs:
+                handle(items)
+                items, more_msgs, cursor = await client.read_acked(ack=cursor)
+            handle(items)
+            await client.read_acked(0, ack=cursor)
+
+        Pages not acknowledged within the server's timeout are sent again, so a message
+        may be delivered more than once but is never lost to a failed read. A call
+        with no cursor starts again from the oldest message not acknowledged, so
+        retrying a first read whose reply was lost gets the same page again.
+
+        Args:
+            max_items (int): the most messages to return
+            ack (int): the cursor of the last page that has been handled, 0 to start again
+
+        Returns:
+            items (list): (sender name, message bytes) tuples, oldest first
+            more_msgs (bool): True if the server has more messages after this page
+            cursor (int): acknowledges this page once it has been handled
+        """
+
+        return await self.request(self.make_request(1, message=READ_ACKED.pack(max_items, ack), flags=FLAG_ACK),
+            read_items_acked)
+
+    async def read_stream(self, max_items=PAGE_SIZE_V2):
+        """Yields the next max_items messages one at a time, as each arrives
+
+        Only one message is held at a time, so a caller can show each while the rest
+        are still on their way. The page is an acknowledged read, it is acknowledged
+        on the same connection once every message has been taken, so a caller that
+        stops part way or fails gets the page again after the server's ack timeout.
+        Like read_acked with no cursor, it starts from the oldest message not
+        acknowledged:
+
+            async for sender, message, more_msgs in client.read_stream():
+                handle(sender, message)
+
+        Args:
+            max_items (int): the most messages to yield
+
+        Yields:
+            sender (str): the name of the client who sent the message
+            message (bytes): the message
+            more_msgs (bool): True if the server has more messages after this page
+        """
+
+        (num_items, more_msgs, cursor), conn = await self.request(
+            self.make_request(1, message=READ_ACKED.pack(max_items, 0), flags=FLAG_ACK), read_acked_header, hold=True)
+        reader, writer = conn
+        keep = False
+        try:
+            for i in range(num_items):
+                sender, message = await self.within_timeout(read_item(reader))
+                yield sender, message, more_msgs
+            if num_items > 0:
+                writer.write(self.make_request(1, message=READ_ACKED.pack(0, cursor), flags=FLAG_ACK).content)
+                await self.within_timeout(writer.drain())
+                await self.within_timeout(read_items_acked(reader))
+            keep = True
+        except (OSError, asyncio.IncompleteReadError) as err:
+            raise ClientConnectionError("connection lost - " + str(err))
+        except (UnicodeDecodeError, ValueError) as err:
+            raise ProtocolError(str(err))
+        finally:
+            self.pool.release(conn, keep)
+
+    async def register(self, n, e):
+        """Registers this client's RSA public key
+
+        Args:
+            n (int): the public modulus
+            e (int): the public exponent
+        """
+
+        if n.bit_length() > MAX_KEY_BITS or e.bit_length() > MAX_KEY_BITS:
+            raise ValueError("the server only takes keys of up to " + str(MAX_KEY_BITS) + " bits")
+        e_bytes = encode_key_int(e)
+        await self.request(self.make_request(REGISTER_BINARY_ID, e_bytes, encode_key_int(n)), read_status)
+
+    async def fetch_keys(self):
+        """Gets the server's public key directory
+
+        Returns:
+            keys (dict): name -> (n, e)
+        """
+
+        return await self.request(self.make_request(KEYS_BINARY_ID), read_keys)
+
+    async def depths(self, names):
+        """Finds out how much mail is waiting for many clients in one request, nothing is read
+
+        Args:
+            names (list): the names of the recievers, at most DEPTH_MAX_NAMES
+
+        Returns:
+            depths (dict): name -> (message count, message bytes)
+        """
+
+        names = list(names)
+        if len(names) > DEPTH_MAX_NAMES:
+            raise ValueError("at most " + str(DEPTH_MAX_NAMES) + " names can be asked about at once")
+        body = bytearray()
+        for name in names:
+            name_bytes = name.encode("utf-8")
+            if len(name_bytes) < 1 or len(name_bytes) > 255:
+                raise ValueError("Reciever name must be at least 1 character long and at most 255 bytes")
+            body.append(len(name_bytes))
+            body += name_bytes
+        depths = await self.request(self.make_request(DEPTH_ID, message=body), read_depths)
+        if len(depths) != len(names):
+            raise ProtocolError("asked about " + str(len(names)) + " names but got " + str(len(depths)) + " depths")
+        return dict(zip(names, depths))
+
+    async def upload(self, receiver, fileobj, length, token=None, prefix=b""):
+        """Sends a message read from a file as a resumable upload
+
+        The message is prefix followed by the file's contents and is sent in UPLOAD_PIECE
+        sized chunks. After a failed chunk the server is asked for its committed offset and
+        the upload carries on from there. Passing the same token again, even from another
+        process, resumes an unfinished upload.
+
+        Args:
+            receiver (str): the name of the reciever
+            fileobj (file): a seekable file opened in binary mode
+            length (int): the number of bytes to send from the file
+            token (bytes): 16 bytes naming the upload, random if not given
+            prefix (bytes): bytes sent before the file's contents
+        """
+
+        rec_name_bytes = receiver.encode("utf-8")
+        if token is None:
+            token = os.urandom(16)
+        length += len(prefix)
+
+        status, complete, offset = await self.request(
+            self.make_request(UPLOAD_OPEN_ID, rec_name_bytes, UPLOAD_OPEN.pack(token, length)), read_upload_state)
+        if status == STATUS_UNKNOWN_UPLOAD:
+            raise StatusError("the token is in use by another upload", status)
+        retries = 0
+        while not complete:
+            try:
+                if offset is None:
+                    # after a failure, asks the server how much it has committed
+                    status, complete, offset = await self.request(
+                        self.make_request(UPLOAD_QUERY_ID, message=UPLOAD_QUERY.pack(token)), read_upload_state)
+                    if status == STATUS_UNKNOWN_UPLOAD:
+                        status, complete, offset = await self.request(
+                            self.make_request(UPLOAD_OPEN_ID, rec_name_bytes, UPLOAD_OPEN.pack(token, length)),
+                            read_upload_state)
+                        if status == STATUS_UNKNOWN_UPLOAD:
+                            raise StatusError("the token is in use by another upload", status)
+                    continue
+                data = prefix[offset:offset + UPLOAD_PIECE]
+                fileobj.seek(max(0, offset - len(prefix)))
+                data += fileobj.read(UPLOAD_PIECE - len(data))
+                message_request = MessageRequestV2(UPLOAD_CHUNK_ID, len(self.name_bytes), 0,
+                    UPLOAD_CHUNK.size + len(data), FLAG_KEEP_ALIVE)
+                message_request.add_name(self.name_bytes)
+                message_request.add_message(UPLOAD_CHUNK.pack(token, offset))
+                status, complete, offset = await self.request(message_request, read_upload_state, data)
+                if status == STATUS_UNKNOWN_UPLOAD:
+                    offset = None
+                elif status not in (STATUS_OK, STATUS_BAD_OFFSET, STATUS_DROPPED_OLDEST):
+                    raise StatusError("server refused the upload", status)
+                retries = 0
+            except (ClientConnectionError, ClientTimeoutError):
+                retries += 1
+                if retries > UPLOAD_RETRIES:
+                    raise
+                await asyncio.sleep(retries)
+                offset = None
@@ -0,0 +1,200 @@
+"""Benchmarks the server's storage backends side by side in one process
+
+Each backend gets an embedded Server on a free port, then AsyncClient senders store
+messages for a set of recievers and the recievers drain their mailboxes. The clients
+connect over TCP or the server's Unix domain socket, the CPU time the process spends
+per create covers the client and the server together. Given any of proxy.py's
+impairment options the clients connect through a Proxy, so throughput and tail
+latency can be measured under latency, a bandwidth cap, fragmentation or resets.
+A request that fails is counted as an error and, when draining, tried again.
+
+    python bench.py --messages 20000 --size 128 --stores memory sqlite log
+    python bench.py --stores memory --transports tcp unix
+    python bench.py --stores memory --latency 20 --jitter 5 --bandwidth 2000000
+
+Author: Zya Gurau
+"""
+
+import argparse
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+from async_client import AsyncClient, ClientError
+from proxy import Proxy, add_impairment_arguments, impairment_from_args
+from server import Server
+from storage import STORE_TYPES, open_stores
+
+TRANSPORTS = ('tcp', 'unix')
+
+async def create_messages(host, port, senders, receivers, count, size, concurrency):
+    """Stores count messages spread over the senders and recievers
+
+    Returns:
+        latencies (list): the seconds each successful create took
+        errors (int): the number of creates that failed
+    """
+
+    clients = [AsyncClient(host, port, name, pool_size=concurrency) for name in senders]
+    message = os.urandom(size)
+    latencies = []
+    errors = 0
+    queue = asyncio.Queue()
+    for i in range(count):
+        queue.put_nowait(i)
+
+    async def worker():
+        nonlocal errors
+        while not queue.empty():
+            i = queue.get_nowait()
+            start = time.perf_counter()
+            try:
+                await clients[i % len(clients)].create(receivers[i % len(receivers)], message)
+            except ClientError:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+
+    try:
+        await asyncio.gather(*[worker() for i in range(concurrency)])
+    finally:
+        for client in clients:
+            await client.close()
+    return latencies, errors
+
+async def drain_mailboxes(host, port, receivers, page_size, acked=0):
+    """Reads every mailbox until the server has nothing more
+
+    Args:
+        acked (int): with 0 pages are removed as they are read, otherwise this many
+            acknowledged reads are kept in flight per mailbox
+
+    Returns:
+        read (int): the number of messages read
+        errors (int): the number of reads that failed
+    """
+
+    errors = 0
+
+    async def drain_acked(name):
+        nonlocal errors
+        read = 0
+        async with AsyncClient(host, port, name, pool_size=acked) as client:
+            more_msgs = True
+            cursor = 0
+            while more_msgs:
+                try:
+                    # a read with no cursor starts again from the oldest message, so only
+                    # one is sent until there is a cursor the rest can pass as well
+                    pages = await asyncio.gather(*[client.read_acked(page_size, cursor)
+                        for i in range(acked if cursor else 1)])
+                except ClientError:
+                    # unacknowledged pages are sent again once the server's ack timeout runs out
+                    errors += 1
+                    continue
+                read += sum(len(items) for items, more, page_cursor in pages)
+                more_msgs = any(more for items, more, page_cursor in pages)
+                cursor = max(page_cursor for items, more, page_cursor in pages)
+            await client.read_acked(0, cursor)
+        return read
+
+    async def drain(name):
+        nonlocal errors
+        read = 0
+        async with AsyncClient(host, port, name) as client:
+            more_msgs = True
+            while more_msgs:
+                try:
+                    items, more_msgs = await client.read(page_size)
+                except ClientError:
+                    errors += 1
+                    continue
+                read += len(items)
+        return read
+
+    read = sum(await asyncio.gather(*[(drain_acked if acked else drain)(name) for name in receivers]))
+    return read, errors
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def run_store(store_type, transport, args):
+    """Runs the benchmark against one backend, returning a line of results"""
+
+    data_dir = tempfile.mkdtemp(prefix="mailserver-bench-")
+    try:
+        mail_store, key_store = open_stores(store_type, data_dir)
+        if transport == 'unix':
+            unix_path = os.path.join(data_dir, "server.sock")
+            server = Server(None, mail_store, key_store, os.path.join(data_dir, "spool"), quiet=True,
+                unix_path=unix_path)
+        else:
+            server = Server(0, mail_store, key_store, os.path.join(data_dir, "spool"), host='127.0.0.1', quiet=True)
+        server.start()
+        host = "unix:" + unix_path if transport == 'unix' else '127.0.0.1'
+        port = server.port
+        proxy = None
+        if args.proxy:
+            # the clients reach the server through the proxy over TCP
+            proxy = Proxy(0, host if transport == 'unix' else host + ":" + str(port), impairment_from_args(args),
+                quiet=True).start()
+            host, port = '127.0.0.1', proxy.port
+        try:
+            senders = ["sender" + str(i) for i in range(args.senders)]
+            receivers = ["receiver" + str(i) for i in range(args.receivers)]
+            start = time.perf_counter()
+            cpu_start = time.process_time()
+            latencies, create_errors = asyncio.run(create_messages(host, port, senders, receivers,
+                args.messages, args.size, args.concurrency))
+            create_cpu = time.process_time() - cpu_start
+            create_time = time.perf_counter() - start
+            start = time.perf_counter()
+            read, read_errors = asyncio.run(drain_mailboxes(host, port, receivers, args.page_size, args.acked))
+            read_time = time.perf_counter() - start
+        finally:
+            if proxy is not None:
+                proxy.stop()
+            server.stop()
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    errors = create_errors + read_errors
+    # a reset can lose a reply after its request was served, and AsyncClient retries some requests
+    if not args.reset_rate and errors == 0 and read != args.messages:
+        raise ValueError(store_type + " store returned " + str(read) + " of " + str(args.messages) + " messages")
+    if not latencies:
+        raise ValueError("every create failed")
+    return "%-8s %-5s %10.0f %10.2f %10.2f %10.1f %10.0f %8d" % (store_type, transport, len(latencies) / create_time,
+        percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000,
+        create_cpu / args.messages * 1000000, read / read_time, errors)
+
+def process_argv():
+    parser = argparse.ArgumentParser(description="Compares the server's storage backends")
+    parser.add_argument("--stores", nargs="+", choices=STORE_TYPES, default=list(STORE_TYPES))
+    parser.add_argument("--transports", nargs="+", choices=TRANSPORTS, default=['tcp'],
+        help="how the clients connect to the server (default: tcp)")
+    parser.add_argument("--messages", type=int, default=10000, help="messages to create (default: 10000)")
+    parser.add_argument("--size", type=int, default=128, help="bytes per message (default: 128)")
+    parser.add_argument("--senders", type=int, default=8)
+    parser.add_argument("--receivers", type=int, default=8)
+    parser.add_argument("--concurrency", type=int, default=16, help="requests in flight at once (default: 16)")
+    parser.add_argument("--page-size", type=int, default=1024, help="messages per read (default: 1024)")
+    parser.add_argument("--acked", type=int, default=0, metavar="PAGES",
+        help="drain with acknowledged reads, keeping this many pages in flight per mailbox")
+    add_impairment_arguments(parser)
+    args = parser.parse_args()
+    args.proxy = bool(args.latency or args.jitter or args.bandwidth or args.fragment or args.reset_rate)
+    return args
+
+def main():
+    args = process_argv()
+    print("%-8s %-5s %10s %10s %10s %10s %10s %8s" % ("store", "conn", "create/s", "p50 ms", "p99 ms", "cpu us",
+        "read/s", "errors"))
+    for store_type in args.stores:
+        for transport in args.transports:
+            print(run_store(store_type, transport, args))
+
+if __name__ == "__main__":
+    main()
@@ -1,263 +1,219 @@
 """Defines the client side for a socket based networking application
 
-Allows the client to send 'create' and 'read' requests to the server. 
-A 'create request allows the client to address a message for another client, 
-which is then stored in the server, a 'read' request gets the server to 
-send the Client all the messages addressed to them.
-
-Includes RSA encryption and public private key distribution architecture.
+Allows the client to send 'create' and 'read' requests to the server.
+A 'create request allows the client to address a message for another client,
+which is then stored in the server, a 'read' request gets the server to
+send the Client all the messages addressed to them. The server is given as
+'<host> <port>', or as 'unix:/path' for a server on this host listening on a Unix
+domain socket. An 'attach' request streams a
+file to another client as a resumable upload. A 'daemon' request keeps running and
+serves the commands of mailctl.py with its connection and keys kept warm.
+
+Includes RSA encryption and public private key distribution architecture. The
+requests themselves are made with AsyncClient from async_client.py, this module is
+the command line front-end to it.
 
 Author: Zya Gurau
 """
 
-from socket import *
+from socket import getaddrinfo, gaierror, AF_INET, SOCK_STREAM
+import asyncio
+import hashlib
+import json
+import os
 import sys
-from common import MessageRequest, MessageRegister
-from rsa import newkeys, PublicKey, encrypt, decrypt
+from async_client import AsyncClient, ClientError
+from common import daemon_path, parse_address
+from rsa import newkeys, PublicKey, DecryptionError, encrypt, decrypt
 import pickle
 
-def get_key_response(s):
-    """Gets a response from the server containing its public key database
+# marks a message body as an unencrypted file attachment, followed by a 16 bit
+# file name length, the file name and then the file contents
+ATTACHMENT_MAGIC = b"\xAE\x74AT"
+# seconds a request to the server may take
+REQUEST_TIMEOUT = 5
+# a message that can't be decrypted is saved to a file named after its sender, its
+# digest and this suffix, so it can still be acknowledged with the rest of its page
+UNDECRYPTED_SUFFIX = ".undecrypted"
 
-    Recieves data from the server in multiple parts, first recieves the header,
-    and chacks validity. 
-    
-    Args:
-        s (socket): the main client socket
+def file_safe(name):
+    """Makes a name sent by another client safe to start a file name with
 
-    Returns:
-        (None)
+    Path separators are replaced, so a sender named '../x' can't have a file written
+    outside the client's directory.
     """
 
-    try:
-        # sets a timeout of one second on the socket throws a timeout error 
-        # if there is a gap in data
-        s.settimeout(1)
-        # recieves the first five bytes of the packet 
-        mes_res = s.recv(5)
-        req_array = bytearray(mes_res)
-        
-        # initialises variables from the recieved data
-        magic_no = req_array[0]<<8 | req_array[1]
-        r_id = req_array[2]
-        numitems = req_array[3]
-        moremsgs = req_array[4]
-        
-        # checks if header is valid
-        if magic_no != 0xAE73:
-            raise ValueError("magic number incorrect")
-        if r_id != 6:
-            raise ValueError("ID is not 6")
-        if moremsgs not in [0,1]:
-            raise ValueError("errouneous packet")
-        
-        # if there are no messages prints info and exit 
-        if numitems == 0:
-            print("no messages")
-            s.close()
-            exit()
-        
-        for i in range(numitems):
-            # recieves the next three bytes from the response
-            req_array = s.recv(4)
-
-            name_len = req_array[0]
-            e_len = req_array[1]
-            h_len = req_array[2]<<8 | req_array[3]
-
-            # checks the validity of the recieved data
-            if name_len < 1:
-                raise ValueError("Length of sender name must be at least 1 - Erroneous packet")
-            if h_len < 1:
-                raise ValueError("Length of sender name must be at least 1 - Erroneous packet")
-            if e_len < 1:
-                raise ValueError("Length of sender name must be at least 1 - Erroneous packet")
-
-            # recieves the senders name and message date
-            req_array = s.recv(name_len + e_len + h_len)
-
-            # get each of the field by iterating through the byte array based on length
-            name = []
-            for i in range(name_len):
-                name.append(req_array[i])
-            
-            e = []
-            for i in range(name_len, name_len + e_len):
-                e.append(req_array[i])
-
-            n= []
-            for i in range(name_len + e_len,name_len + e_len + h_len):
-                n.append(req_array[i])
-            
-            # decode each of the fields
-            name_done = bytes(bytearray(name)).decode("utf-8")
-            e_done = int(bytes(bytearray(e)).decode("utf-8"))
-            n_done = int(bytes(bytearray(n)).decode("utf-8"))
-
-            # create a public key and dump into a pickle file 
-            dbfile = open(name_done+'pubpem', 'ab')
-            pickle.dump(PublicKey(n_done, e_done), dbfile)                    
-            dbfile.close()
-        
-        if moremsgs == 1:
-            print("more messages available from server")
-            print("")
-        s.close()
-        return None
+    for sep in (os.sep, os.altsep, "\0"):
+        if sep:
+            name = name.replace(sep, "_")
+    return name
 
-    except ValueError as err:
-        print("ERROR - " + str(err))
-        s.close()
-        exit()
-    except OSError as err:
-        print("ERROR - " + str(err))
-        s.close()
-        exit()
-    except UnicodeDecodeError:
-        print("ERROR - could not decode")
-        s.close()
-        exit()
-    except TimeoutError:
-        print("ERROR - Server timed out")
-        s.close()
-        exit()
-    except IndexError as err:
-        print("ERROR - " + str(err))
-        s.close()
-        exit()
-
-def get_response(s, name):
-    """Gets a message response from the server
+class ClientCommands:
+    """Carries out the client's requests, keeping its keys loaded between them
 
-    Recieves data from the server in multiple parts, first recieves the header,
-    and chacks validity, then the length of sender name and length of messages, finally
-    recieves the senders name and message.
-    If there is a gap while reading parts of data error handling occurs.
-    
-    Args:
-        s (socket): the main client socket
-
-    Returns:
-        (None)
+    Each request returns the text to show the client and raises an exception if
+    it fails, so the same commands serve the command line and the daemon. Given an
+    emit function, a read passes it each message's text as soon as it is shown and
+    returns only what is left.
     """
 
-    try:
-        # sets a timeout of one second on the socket throws a timeout error 
-        # if there is a gap in data
-        s.settimeout(1)
-        # recieves the first five bytes of the packet 
-        mes_res = s.recv(5)
-        req_array = bytearray(mes_res)
-        
-        # initialises variables from the recieved data
-        magic_no = req_array[0]<<8 | req_array[1]
-        r_id = req_array[2]
-        numitems = req_array[3]
-        moremsgs = req_array[4]
-        
-        # checks if header is valid
-        if magic_no != 0xAE73:
-            raise ValueError("magic number incorrect")
-        if r_id != 3:
-            raise ValueError("ID is not 3")
-        if moremsgs not in [0,1]:
-            raise ValueError("errouneous packet")
-        
-        # if there are no messages prints info and exit 
-        if numitems == 0:
-            print("no messages")
-            s.close()
-            exit()
-        
-        for i in range(numitems):
-            # recieves the next three bytes from the response
-            req_array = s.recv(3)
-
-            sender_len = req_array[0]
-            message_len = req_array[1]<<8 | req_array[2]
-
-            # checks the validity of the recieved data
-            if sender_len < 1:
-                raise ValueError("Length of sender name must be at least 1 - Erroneous packet")
-            if message_len < 1:
-                raise ValueError("Length of sender name must be at least 1 - Erroneous packet")
-
-            # recieves the senders name and message date
-            req_array = s.recv(sender_len + message_len)
-
-            # gets the senders name by iterating through the bytearray based on the length
-            # of the senders name
-            sender = []
-            for i in range(sender_len):
-                sender.append(req_array[i])
-                
-            # gets the message by iterating through the bytearray based on the length
-            # of the senders name and message starting from the end of the senders name
-            message = []
-            for i in range(sender_len,sender_len+message_len):
-                message.append(req_array[i])
-            
-            # decodes the senders name using utf-8
-            decode_sender_one = bytearray(sender)
-            decode_sender_two = bytes(decode_sender_one)
-            sender_done = decode_sender_two.decode("utf-8")
-
-            dbfile = open(name+'pem', 'rb')
-            # source, destination
-            priv_key = pickle.load(dbfile)  
-            dbfile.close()
-            
-            # decodes the message using utf-8
-            decode_message_one = bytearray(message)
-            decode_message_two = bytes(decode_message_one)
-            message_done = decrypt(decode_message_two, priv_key).decode("utf-8")  
-            
-            print("Sender Name:")
-            print(sender_done)
-            print("")
-            print("Message:")
-            print(message_done)
-            print("")
-            print("")
-        
-        if moremsgs == 1:
-            print("more messages available from server")
-            print("")
-        s.close()
-        return None
-
-    except ValueError as err:
-        print("ERROR - " + str(err))
-        s.close()
-        exit()
-    except OSError as err:
-        print("ERROR - " + str(err))
-        s.close()
-        exit()
-    except UnicodeDecodeError:
-        print("ERROR - could not decode")
-        s.close()
-        exit()
-    except TimeoutError:
-        print("ERROR - Server timed out")
-        s.close()
-        exit()
-    except IndexError as err:
-        print("ERROR - " + str(err))
-        s.close()
-        exit()
-
-def get_input(s):
-    """Gets a clients input for a create request
+    def __init__(self, name, address, emit=None):
+        self.name = name
+        self.address = address
+        self.emit = emit
+        self.client = AsyncClient(address[0], address[1], name, timeout=REQUEST_TIMEOUT)
+        self.priv_key = None
+        self.pub_keys = dict()
+
+    async def read(self):
+        """Reads a page of messages, decrypting each one as soon as it has arrived
+
+        The messages come from AsyncClient.read_stream, so only one is held at a time
+        and each is shown while the rest are still being recieved. A message that can't
+        be decrypted is reported and saved rather than stopping the read. The messages
+        stay on the server until the whole page has been handled and acknowledged, a
+        read that fails part way gets the page again after the server's ack timeout.
+        """
+
+        if self.priv_key is None:
+            with open(self.name+'pem', 'rb') as dbfile:
+                self.priv_key = pickle.load(dbfile)
+        output = []
+        more = False
+        num_items = 0
+        async for sender, message, more_msgs in self.client.read_stream():
+            num_items += 1
+            more = more_msgs
+            lines = self.show_message(sender, message)
+            if self.emit is None:
+                output += lines
+            else:
+                self.emit("\n".join(lines) + "\n")
+        if num_items == 0:
+            return "no messages\n"
+        if more:
+            output += ["more messages available from server", ""]
+        return "\n".join(output) + "\n" if output else ""
+
+    def show_message(self, sender, message):
+        """Decrypts a message or saves an attachment, returning the lines to show
+
+        A message that can't be decrypted or decoded is saved as it arrived to a file
+        named after its sender and digest, and the lines say where.
+        """
+
+        output = ["Sender Name:", sender, ""]
+        try:
+            if message[:len(ATTACHMENT_MAGIC)] == ATTACHMENT_MAGIC and len(message) >= len(ATTACHMENT_MAGIC) + 2:
+                file_len = message[len(ATTACHMENT_MAGIC)]<<8 | message[len(ATTACHMENT_MAGIC) + 1]
+                start = len(ATTACHMENT_MAGIC) + 2
+                filename = file_safe(sender) + "-" + os.path.basename(str(message[start:start + file_len], "utf-8"))
+                with open(filename, 'wb') as attachment:
+                    attachment.write(message[start + file_len:])
+                output += ["Attachment:", filename]
+            else:
+                output += ["Message:", decrypt(bytes(message), self.priv_key).decode("utf-8")]
+        except (DecryptionError, UnicodeError):
+            filename = file_safe(sender) + "-" + hashlib.sha256(message).hexdigest()[:16] + UNDECRYPTED_SUFFIX
+            with open(filename, 'wb') as undecrypted:
+                undecrypted.write(message)
+            output += ["ERROR - could not decrypt the message, saved as:", filename]
+        return output + ["", ""]
+
+    async def create(self, rec_name, message):
+        # encrypt with RSA public key of the receiver
+        if rec_name not in self.pub_keys:
+            with open(rec_name+'pubpem', 'rb') as dbfile:
+                self.pub_keys[rec_name] = pickle.load(dbfile)
+        await self.client.create(rec_name, encrypt(message.encode("utf-8"), self.pub_keys[rec_name]))
+        return "Message for " + rec_name + " Created\n"
+
+    async def keys(self):
+        keys = await self.client.fetch_keys()
+        if len(keys) == 0:
+            return "no messages\n"
+        for name, (n, e) in keys.items():
+            # create a public key and dump into a pickle file
+            self.pub_keys[name] = PublicKey(n, e)
+            with open(name+'pubpem', 'ab') as dbfile:
+                pickle.dump(self.pub_keys[name], dbfile)
+        return ""
+
+    async def register(self):
+        # send public key to server and create file with private key of user.
+        keypair = newkeys(512, poolsize=1)
+        with open(self.name+'pem', 'ab') as dbfile:
+            pickle.dump(keypair[1], dbfile)
+        await self.client.register(keypair[0].n, keypair[0].e)
+        self.priv_key = keypair[1]
+        return "registered\n"
+
+    async def attach(self, rec_name, path):
+        """Sends a file as a resumable upload, attachments are not RSA encrypted
+
+        The upload token is derived from the names and the file, so running the same
+        command again after it was interrupted carries on from where it stopped.
+        """
+
+        file_bytes = os.path.basename(path).encode("utf-8")
+        envelope = ATTACHMENT_MAGIC + len(file_bytes).to_bytes(2, "big") + file_bytes
+        with open(path, 'rb') as attachment:
+            stat = os.fstat(attachment.fileno())
+            token = hashlib.sha256(b"\0".join([self.name.encode("utf-8"), rec_name.encode("utf-8"),
+                os.path.abspath(path).encode("utf-8"), str(stat.st_size).encode(),
+                str(stat.st_mtime_ns).encode()])).digest()[:16]
+            await self.client.upload(rec_name, attachment, stat.st_size, token, envelope)
+        return "Attachment for " + rec_name + " Created\n"
+
+    async def run_command(self, command, args):
+        commands = {'read': self.read, 'create': self.create, 'keys': self.keys,
+            'reg': self.register, 'attach': self.attach}
+        if command not in commands:
+            raise ValueError("request muse be of type 'read', 'create', 'attach', 'reg', or 'keys' ")
+        return await commands[command](*args)
+
+    async def serve(self):
+        """Accepts commands from mailctl.py on the daemons Unix socket until cancelled
+
+        Each command is one JSON line holding 'command' and 'args', the reply is one JSON
+        line holding 'ok' and the 'output' the command would have printed. The
+        AsyncClient's pooled connections and the loaded keys are kept between commands.
+        """
+
+        path = daemon_path(self.name)
+        if os.path.exists(path):
+            os.remove(path)
+        listener = await asyncio.start_unix_server(self.serve_command, path)
+        os.chmod(path, 0o600)
+        print("daemon for " + self.name + " listening on " + path)
+        try:
+            async with listener:
+                await listener.serve_forever()
+        finally:
+            os.remove(path)
+            await self.client.close()
+
+    async def serve_command(self, reader, writer):
+        try:
+            request = json.loads(await reader.readline())
+            reply = {"ok": True, "output": await self.run_command(request["command"], request.get("args", []))}
+        except (ClientError, OSError, ValueError, KeyError, TypeError, DecryptionError) as err:
+            reply = {"ok": False, "output": "ERROR - " + str(err) + "\n"}
+        writer.write(json.dumps(reply).encode("utf-8") + b"\n")
+        await writer.drain()
+        writer.close()
+
+def get_input(type_rw):
+    """Gets a clients input for a create or attach request
 
     Uses While true loops to get input and perform validity checks.
-    
+
     Args:
-        s (socket): the main client socket
-    
+        type_rw (str): 'create' or 'attach'
+
     Returns:
         rec_name (str): the name of the reciever
-        message (str): the message written by the client
+        message (str): the message written by the client, or the path of the file to attach
     """
 
     try:
@@ -268,127 +224,58 @@ def get_input(s):
                 continue
             else:
                 break
-            
+
+        if type_rw == 'attach':
+            return rec_name, input("Enter File Path: ")
+
         while True:
             message = input("Enter Message: ")
             if len(message) < 1 or len(message.encode("utf-8")) >= 65535:
                 print("message must be at least 1 character long and must be less than 65,535 bytes")
                 continue
             else:
-                break 
+                break
         return rec_name, message
     except UnicodeEncodeError:
         print("ERROR - could not encode")
-        s.close()
         exit()
 
-def create_request_main(s, name, address):
-    """puts together a create request and sends it to the server
-    
-    Encodes data and appends it to a byte array which is then sent to the server,
-    exceptions are raised if errors occur in sending and encoding.
-
-    Args:
-        s (socket): the main client socket
-
-    Returns
-        (None)
-    """
-
+def process_argv():
     try:
-        rec_name, message = get_input(s)
-        rec_name_bytes = rec_name.encode("utf-8")
-
-        # open the receiving clients public key
-        dbfile = open(rec_name+'pubpem', 'rb')
-        rec_pub_key = pickle.load(dbfile)  
-        dbfile.close()
-
-        # encrypt with RSA public key of the receiver and encode with utf-8
-        message_bytes = encrypt(message.encode("utf-8"), rec_pub_key)
-        name_bytes = name.encode("utf-8")
-
-    except UnicodeEncodeError:
-        print("ERROR - could not encode")
-        s.close()
-        exit()
-    
-    message_request = MessageRequest(2, len(name_bytes), len(rec_name_bytes), len(message_bytes)) 
-    message_request.add_name(name_bytes)
-    message_request.add_reciever_name(rec_name_bytes)
-    message_request.add_message(message_bytes)
+        # gets values from the arguments on the command line and preforms validity checks on them
 
-    try:
-        s.settimeout(1)
-        s.connect(address)  
-        s.send(message_request.content)
-        print("Message for " + rec_name + " Created")
-        return None
-    
-    except TimeoutError:
-        print("ERROR - Server timed out")
-        s.close()
-        exit()
-    except OSError as err:
-        print("ERROR -  " + str(err))
-        s.close()
-        exit()
+        argv = sys.argv
 
-def read_request_main(s, name, address):
-    """Puts together a read request and sends it to the server 
-    
-    Args:
-        s (socket): the main client socket
+        # a server on this host can be reached through its Unix socket, which takes no port
+        unix = len(argv) == 4 and argv[1].startswith("unix:")
+        if unix:
+            parse_address(argv[1])
+            argv = argv[:2] + [None] + argv[2:]
+        elif len(argv) != 5:
+            raise ValueError("Request must include exactly four parameters")
 
-    Returns:
-        (None)
-    """
+        filename = argv[0] # "client.py"
 
-    name_bytes = name.encode("utf-8")
+        port = None
+        if not unix:
+            port = int(argv[2]) # 5000
 
-    message_request = bytearray()
-    message_request = MessageRequest(1, len(name_bytes), 0, 0)
-    message_request.add_name(name_bytes)
-    
-    try:
-        #connects to server and sends request
-        s.settimeout(1)
-        s.connect(address)  
-        s.send(message_request.content)
-        return None
-    except TimeoutError:
-        print("ERROR - Server timed out")
-        s.close()
-        exit()
-    except OSError as err:
-        print("ERROR -  " + str(err))
-        s.close()
-        exit()
+            if port < 1024 or port > 64000:
+                        raise ValueError("Port must be between 1024 and 64000 inclusive")
 
-def process_argv():
-    try:
-        # gets values from the arguments on the command line and preforms validity checks on them
+        name = argv[3] # "zya gurau"
 
-        if len(sys.argv) != 5:
-            raise ValueError("Request must include exactly four parameters")
-        
-        filename = sys.argv[0] # "client.py"
+        if len(name) < 1 or len(name.encode("utf-8")) > 255:
+            raise ValueError("user name must be at least one character and less than 255 bytes")
 
-        port = int(sys.argv[2]) # 5000
+        type_rw = argv[4] # "read"
 
-        if port < 1024 or port > 64000:
-                    raise ValueError("Port must be between 1024 and 64000 inclusive")
-        
-        name = sys.argv[3] # "zya gurau"
+        if type_rw not in ('read', 'create', 'attach', 'reg', 'keys', 'daemon'):
+            raise ValueError("request muse be of type 'read', 'create', 'attach', 'reg', 'keys' or 'daemon' ")
 
-        if len(name) < 1 or len(name.encode("utf-8")) > 255:
-            raise ValueError("user name must be at least one character and less than 255 bytes")
+        if unix:
+            return port, name, type_rw, (argv[1], None)
 
-        type_rw = sys.argv[4] # "read"
-        
-        if type_rw != 'read' and type_rw != 'create' and type_rw != 'reg' and type_rw != 'keys':
-            raise ValueError("request muse be of type 'read', 'create', 'reg', or 'keys' ")
-        
         services = getaddrinfo(sys.argv[1], port, AF_INET, SOCK_STREAM)
         family, type, proto, canonname, address = services[0]
 
@@ -406,104 +293,49 @@ def process_argv():
         print("ERROR - Request must include exactly four parameters")
         exit()
 
-def register_with_server(s, name, address):
-    #send public key to server and create file with private key of user.
-    keypair = newkeys(512, poolsize=1)
-    dbfile = open(name+'pem', 'ab')
-    pickle.dump(keypair[1], dbfile)                    
-    dbfile.close()
-    
-    try:
-        rec_name = str(keypair[0].e)
-        message = str(keypair[0].n)
-        rec_name_bytes = rec_name.encode("utf-8")
-        message_bytes = message.encode("utf-8")
-        name_bytes = name.encode("utf-8")
-
-    except UnicodeEncodeError:
-        print("ERROR - could not encode")
-        s.close()
-        exit()
-    
-    message_register = MessageRegister(len(name_bytes), len(rec_name_bytes), len(message_bytes)) 
-    message_register.add_name(name_bytes)
-    message_register.add_reciever_name(rec_name_bytes)
-    message_register.add_message(message_bytes)
+def print_now(text):
+    print(text, end="", flush=True)
 
+async def run_once(commands, type_rw, args):
     try:
-        s.settimeout(1)
-        s.connect(address)  
-        s.send(message_register.content)
+        return await commands.run_command(type_rw, args)
+    finally:
+        await commands.client.close()
 
-        print("registered")
+def main():
+    """Carries out one request from the command line, or runs the daemon"""
 
+    port, name, type_rw, address = process_argv()
+    # a read prints each message as soon as it is shown, the daemon collects them into its reply
+    commands = ClientCommands(name, address, None if type_rw == 'daemon' else print_now)
+
+    if type_rw == 'daemon':
+        try:
+            asyncio.run(commands.serve())
+        except KeyboardInterrupt:
+            pass
+        except OSError as err:
+            print("ERROR -  " + str(err))
         return None
-    
-    except TimeoutError:
-        print("ERROR - Server timed out")
-        s.close()
-        exit()
-    except OSError as err:
-        print("ERROR -  " + str(err))
-        s.close()
-        exit()
-
-def get_public_keys(s, name, address):
-    """Puts together a public key request and sends it to the server 
-    
-    Args:
-        s (socket): the main client socket
 
-    Returns:
-        (None)
-    """
+    args = []
+    if type_rw in ('create', 'attach'):
+        args = get_input(type_rw)
 
-    name_bytes = name.encode("utf-8")
-    key_request = bytearray()
-    key_request = MessageRequest(6, len(name_bytes), 0, 0)
-    key_request.add_name(name_bytes)
-    
     try:
-        #connects to server and sends request
-        s.settimeout(1)
-        s.connect(address)  
-        s.send(key_request.content)
-        return None
-    
-    except TimeoutError:
-        print("ERROR - Server timed out")
-        s.close()
+        print(asyncio.run(run_once(commands, type_rw, args)), end="")
+    except ClientError as err:
+        print("ERROR - " + str(err))
         exit()
-    except OSError as err:
+    except (OSError, ValueError) as err:
         print("ERROR -  " + str(err))
-        s.close()
+        exit()
+    except DecryptionError:
+        print("ERROR - could not decrypt")
+        exit()
+    except UnicodeError:
+        print("ERROR - could not decode")
         exit()
 
-def main():
-    """Sets up read and create requests from the Client"""
-
-    port, name, type_rw, address = process_argv()
-
-    #creates the main socket
-    s = socket(AF_INET, SOCK_STREAM)
-    # handles read request
-    if type_rw == 'read':
-        read_request_main(s, name, address)
-        get_response(s, name)
-    # handles create request
-    elif type_rw == 'create':
-        create_request_main(s, name, address)
-    # handles registration with server
-    elif type_rw == 'reg':
-        register_with_server(s,name,address)
-    # handles key request
-    elif type_rw == 'keys':
-        get_public_keys(s, name, address)
-        get_key_response(s)
-    s.close()
-
-
-main()
-    
-    
-    
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,268 @@
 Author: Zya Gurau
 """
 
+import os
+import socket
+import struct
+import tempfile
+
+# request IDs for the compact key encoding, public key fields are sent as
+# big-endian integers rather than decimal text
+KEYS_BINARY_ID = 7
+REGISTER_BINARY_ID = 8
+# the largest n or e a client may register, bigger keys could not be sent back in the
+# decimal ID 6 key response
+MAX_KEY_BITS = 4096
+# response ID for a v2 status frame, the item count field holds the status code
+STATUS_ID = 5
+
+STATUS_OK = 0
+
+# version 2 frames start with their own magic number so v1 and v2 requests can be
+# told apart from the first two bytes, all lengths and counts are big-endian
+MAGIC_V1 = 0xAE73
+MAGIC_V2 = 0xAE74
+# magic, ID, flags, name length, receiver length, message length, on a 'read' the
+# receiver name, if given, selects the messages from that sender
+HEADER_V2 = struct.Struct("!HBBHHI")
+# magic, ID, flags, number of items
+RESPONSE_HEADER_V2 = struct.Struct("!HBBI")
+# sender length, message length
+ITEM_HEADER_V2 = struct.Struct("!HI")
+# name length, e length, n length
+KEY_HEADER_V2 = struct.Struct("!HHH")
+# length prefix of each chunk in a chunked body, a zero length chunk ends the body
+CHUNK_HEADER = struct.Struct("!I")
+
+# request flag, the message body is sent as a sequence of length prefixed chunks
+FLAG_CHUNKED = 0x01
+# request flag, the server keeps the connection open for another request afterwards
+FLAG_KEEP_ALIVE = 0x02
+# request flag on a 'create', a TTL giving the seconds the message may wait to be read
+# follows the names, it is not counted in the message length
+FLAG_TTL = 0x04
+TTL = struct.Struct("!I")
+# request flag on a 'read', the messages sent stay stored until the client acknowledges
+# them, the body is READ_ACKED rather than a bare page size
+FLAG_ACK = 0x08
+# page size, cursor of the last page the client has finished with, 0 to acknowledge nothing
+READ_ACKED = struct.Struct("!IQ")
+# response flag, the server has more messages than fit in this page
+FLAG_MORE_MSGS = 0x01
+# response flag on the reply to an acknowledged read, CURSOR follows the header
+FLAG_CURSOR = 0x04
+# the cursor to acknowledge once the page has been handled
+CURSOR = struct.Struct("!Q")
+
+# upload session requests, a session is named by a 16 byte token chosen by the client
+UPLOAD_OPEN_ID = 9
+UPLOAD_CHUNK_ID = 10
+UPLOAD_QUERY_ID = 11
+# response ID for an upload session state, followed by UPLOAD_STATE
+UPLOAD_STATE_ID = 12
+# token, total message length
+UPLOAD_OPEN = struct.Struct("!16sQ")
+# token, offset of the data that follows
+UPLOAD_CHUNK = struct.Struct("!16sQ")
+# token
+UPLOAD_QUERY = struct.Struct("!16s")
+# committed offset
+UPLOAD_STATE = struct.Struct("!Q")
+
+STATUS_UNKNOWN_UPLOAD = 1
+STATUS_BAD_OFFSET = 2
+# the server is a replication follower and only answers key requests
+STATUS_READ_ONLY = 3
+# the message was refused, it would take the reciever's mailbox or the server over its byte cap
+STATUS_MAILBOX_FULL = 4
+# the message was stored, the reciever's oldest messages were dropped to make room for it
+STATUS_DROPPED_OLDEST = 5
+
+# response flag on UPLOAD_STATE_ID, the upload has been delivered to the receiver
+FLAG_UPLOAD_COMPLETE = 0x02
+
+# response ID sent instead of serving a request while the client or server is over
+# its limits, the item count field holds the milliseconds to wait before retrying,
+# the connection is closed after it
+RETRY_LATER_ID = 13
+
+# request and response ID for the depths of many mailboxes, the request body is the
+# names, each a byte of length and then the name, the response has a DEPTH_ITEM per
+# name in the same order
+DEPTH_ID = 14
+# message count, message bytes
+DEPTH_ITEM = struct.Struct("!IQ")
+# the most names one depth request may ask about
+DEPTH_MAX_NAMES = 65536
+
+# size of the pieces large payloads are streamed in
+CHUNK_SIZE = 256 * 1024
+# number of messages in a v2 read page unless the client asks for fewer
+PAGE_SIZE_V2 = 4096
+
+def encode_key_int(value):
+    """Encodes a public key component as a length-minimal big-endian byte string
+
+    Args:
+        value (int): The key component (n or e)
+
+    Returns:
+        (bytes): The big-endian encoding of the value
+    """
+    return value.to_bytes(max(1, (value.bit_length() + 7) // 8), "big")
+
+def decode_key_int(data, binary):
+    """Decodes a public key component received in either key encoding
+
+    Args:
+        data (bytes): The encoded key component
+        binary (bool): True if the field is big-endian, False if it is decimal text
+
+    Returns:
+        (int): The key component
+    """
+    if binary:
+        return int.from_bytes(data, "big")
+    return int(bytes(data).decode("utf-8"))
+
+def daemon_path(name):
+    """Gives the path of the Unix socket the client daemon for a name listens on
+
+    Args:
+        name (str): The clients name
+
+    Returns:
+        (str): The socket path
+    """
+    return os.path.join(tempfile.gettempdir(), "mailclient-" + name.replace(os.sep, "_") + ".sock")
+
+def parse_address(text, host='0.0.0.0'):
+    """Parses a socket address given on the command line
+
+    'unix:/path' names a Unix domain socket, 'host:port' or a bare port a TCP one.
+
+    Args:
+        text (str): The address
+        host (str): The host used when only a port is given
+
+    Returns:
+        family (int): socket.AF_UNIX or socket.AF_INET
+        address (str or tuple): The path, or the (host, port) pair
+    """
+    if text.startswith("unix:"):
+        if len(text) == len("unix:"):
+            raise ValueError("a unix: address needs a path")
+        return socket.AF_UNIX, text[len("unix:"):]
+    if ":" in text:
+        host, text = text.rsplit(":", 1)
+    try:
+        return socket.AF_INET, (host, int(text))
+    except ValueError:
+        raise ValueError("'" + text + "' is not a port number")
+
+def recv_exact(sock, size):
+    """Recieves exactly size bytes from a socket
+
+    A single recv can return less than was asked for, so this keeps reading
+    into one preallocated buffer until it is full.
+
+    Args:
+        sock (socket): The socket to read from
+        size (int): The number of bytes to recieve
+
+    Returns:
+        data (bytearray): The recieved bytes
+    """
+    # only the first chunk is preallocated, the size usually comes from the peer
+    data = bytearray(min(size, CHUNK_SIZE))
+    recv_into_exact(sock, memoryview(data))
+    recv_append(sock, data, size - len(data))
+    return data
+
+def recv_append(sock, data, size):
+    """Recieves size bytes onto the end of a bytearray, growing it only as they arrive"""
+    while size > 0:
+        piece = sock.recv(min(size, CHUNK_SIZE))
+        if not piece:
+            raise ConnectionError("connection closed mid-message")
+        data += piece
+        size -= len(piece)
+
+def recv_into_exact(sock, view):
+    """Fills a writable buffer from a socket, raising ConnectionError if the peer closes early"""
+    while len(view) > 0:
+        count = sock.recv_into(view, min(len(view), CHUNK_SIZE))
+        if count == 0:
+            raise ConnectionError("connection closed mid-message")
+        view = view[count:]
+
+def recv_to_file(sock, fileobj, size):
+    """Streams size bytes from a socket into a file through one reused buffer
+
+    Args:
+        sock (socket): The socket to read from
+        fileobj (file): The file to write to opened in binary mode, or None to discard the bytes
+        size (int): The number of bytes to copy
+    """
+    buffer = bytearray(min(size, CHUNK_SIZE))
+    view = memoryview(buffer)
+    while size > 0:
+        count = sock.recv_into(view, min(size, len(buffer)))
+        if count == 0:
+            raise ConnectionError("connection closed mid-message")
+        if fileobj is not None:
+            fileobj.write(view[:count])
+        size -= count
+
+def recv_chunked(sock, message_len, progress=None):
+    """Recieves a chunked message body
+
+    Each chunk is appended straight onto the buffer that will be stored, so
+    the body is never held twice, and the buffer only grows as chunks arrive
+    rather than being sized from the length the sender claims.
+
+    Args:
+        sock (socket): The socket to read from
+        message_len (int): The total body length from the header, or 0 if the sender did not know it
+        progress (function): Called with each chunk's length before its bytes are recieved
+
+    Returns:
+        message (bytearray): The reassembled message body
+    """
+    message = bytearray()
+    while True:
+        chunk_len = CHUNK_HEADER.unpack(recv_exact(sock, CHUNK_HEADER.size))[0]
+        if chunk_len == 0:
+            break
+        if message_len != 0 and len(message) + chunk_len > message_len:
+            raise ValueError("chunks are longer than the message length")
+        if progress is not None:
+            progress(chunk_len)
+        recv_append(sock, message, chunk_len)
+    if message_len != 0 and len(message) != message_len:
+        raise ValueError("chunks are shorter than the message length")
+    return message
+
+def send_chunked(sock, fileobj, chunk_size=CHUNK_SIZE):
+    """Sends the rest of a binary file as a chunked body, ending with a zero length chunk
+
+    Args:
+        sock (socket): The socket to write to
+        fileobj (file): A file opened in binary mode
+        chunk_size (int): The largest chunk to send
+
+    Returns:
+        sent (int): The number of body bytes sent
+    """
+    sent = 0
+    while True:
+        chunk = fileobj.read(chunk_size)
+        sock.sendall(CHUNK_HEADER.pack(len(chunk)))
+        if not chunk:
+            return sent
+        sock.sendall(chunk)
+        sent += len(chunk)
+
 class MessageRequest:
     def __init__(self, id, name_len, reciever_len, message_len):
         self.index = 7
@@ -34,29 +296,34 @@ class MessageRequest:
             self.index += 1
 
 class MessageKeys:
-    def __init__(self, num_items, more_msgs):
+    def __init__(self, num_items, more_msgs, binary=False):
+        self.binary = binary
         self.content = bytearray(5)
         self.content[0] = 0xAE
         self.content[1] = 0x73
-        self.content[2] = 6
+        self.content[2] = KEYS_BINARY_ID if binary else 6
         self.content[3] = num_items
         self.content[4] = more_msgs
 
+    def add_key(self, name, n, e):
+        """Adds a key entry, encoding the integer n and e in this response's key encoding"""
+        if self.binary:
+            self.add_message(name, encode_key_int(n), encode_key_int(e))
+        else:
+            self.add_message(name, str(n).encode("utf-8"), str(e).encode("utf-8"))
+
     def add_message(self, name, n, e):
         self.content.append(len(name))
         self.content.append(len(e))
         self.content.append(len(n)>>8)
         self.content.append(0xff & len(n)) 
 
-        for byte in name:
-            self.content.append(byte)
-        for byte in e:
-            self.content.append(byte)
-        for byte in n:
-            self.content.append(byte)
+        self.content += name
+        self.content += e
+        self.content += n
         
 class MessageRegister:
-    def __init__(self, name_len, reciever_len, message_len):
+    def __init__(self, name_len, reciever_len, message_len, binary=False):
         self.index = 7
         self.name_len = name_len
         self.receiver_len = reciever_len
@@ -64,7 +331,7 @@ class MessageRegister:
         self.content = bytearray(7 + name_len + reciever_len + message_len)
         self.content[0] = 0xAE
         self.content[1] = 0x73
-        self.content[2] = 4
+        self.content[2] = REGISTER_BINARY_ID if binary else 4
         self.content[3] = name_len
         self.content[4] = reciever_len
         self.content[5] = message_len >> 8
@@ -104,4 +371,62 @@ class MessageResponse:
         for byte in message:
             self.content.append(byte)
 
-        
\ No newline at end of file
+class MessageRequestV2:
+    def __init__(self, id, name_len, reciever_len, message_len, flags=0):
+        self.id = id
+        self.name_len = name_len
+        self.receiver_len = reciever_len
+        self.message_len = message_len
+        self.content = bytearray(HEADER_V2.pack(MAGIC_V2, id, flags, name_len, reciever_len, message_len))
+
+    def add_name(self, name):
+        self.content += name
+
+    def add_reciever_name(self, name):
+        self.content += name
+
+    def add_message(self, message):
+        self.content += message
+
+class MessageResponseV2:
+    def __init__(self, id, num_items, more_msgs, cursor=None):
+        flags = FLAG_MORE_MSGS if more_msgs else 0
+        if cursor is not None:
+            flags |= FLAG_CURSOR
+        self.content = bytearray(RESPONSE_HEADER_V2.pack(MAGIC_V2, id, flags, num_items))
+        if cursor is not None:
+            self.content += CURSOR.pack(cursor)
+
+    def add_item_header(self, sender_name, message_len):
+        """Adds a messages header and sender name, leaving the message itself to be sent after"""
+        self.content += ITEM_HEADER_V2.pack(len(sender_name), message_len)
+        self.content += sender_name
+
+    def add_message(self, sender_name, message):
+        self.add_item_header(sender_name, len(message))
+        self.content += message
+
+    def add_key(self, name, n, e):
+        n = encode_key_int(n)
+        e = encode_key_int(e)
+        self.content += KEY_HEADER_V2.pack(len(name), len(e), len(n))
+        self.content += name
+        self.content += e
+        self.content += n
+
+    def add_depths(self, depths):
+        self.content += b"".join(DEPTH_ITEM.pack(count, size) for count, size in depths)
+
+class MessageStatus:
+    def __init__(self, status):
+        self.content = bytearray(RESPONSE_HEADER_V2.pack(MAGIC_V2, STATUS_ID, 0, status))
+
+class MessageRetryLater:
+    def __init__(self, retry_after):
+        self.content = bytearray(RESPONSE_HEADER_V2.pack(MAGIC_V2, RETRY_LATER_ID, 0,
+            min(int(retry_after * 1000 + 0.999), 0xFFFFFFFF)))
+
+class MessageUploadState:
+    def __init__(self, status, offset, complete):
+        self.content = bytearray(RESPONSE_HEADER_V2.pack(MAGIC_V2, UPLOAD_STATE_ID, FLAG_UPLOAD_COMPLETE if complete else 0, status))
+        self.content += UPLOAD_STATE.pack(offset)
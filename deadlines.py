@@ -0,0 +1,144 @@
+"""Connection deadlines for the server, so slow clients can't tie up its connections
+
+A connection being served has one deadline at a time, for the phase it is in:
+recieving a request header, recieving a body, waiting idle between keep-alive
+requests or sending a response. Body and write deadlines grow with the bytes to be
+moved, so a large transfer over a slow link is given the time it needs while a
+client trickling bytes is not, however often it sends one. A per-recv socket
+timeout is restarted by every byte, a deadline is not.
+
+The deadlines of every connection are kept in one heap checked by a single thread,
+and a connection whose deadline passes is shut down, which wakes the thread serving
+it out of its recv or send with an error.
+
+Name: Zya Gurau
+"""
+
+import heapq
+import itertools
+import threading
+import time
+from socket import SHUT_RDWR
+
+PHASE_HEADER = 'header'
+PHASE_BODY = 'body'
+PHASE_IDLE = 'idle'
+PHASE_WRITE = 'write'
+PHASES = (PHASE_HEADER, PHASE_BODY, PHASE_IDLE, PHASE_WRITE)
+
+# seconds between deadline checks, connections are closed up to this late
+DEADLINE_TICK = 0.25
+# cancelled heap entries allowed beyond the number of live ones before the heap is rebuilt
+HEAP_SLACK = 1024
+
+class Deadlines:
+    """The deadlines of a server's connections and the thread enforcing them
+
+    Args:
+        header (float): seconds to recieve a request header, from the first byte or the connection opening
+        body (float): seconds to recieve a request body on top of the time its length allows
+        idle (float): seconds a keep-alive connection may wait for its next request
+        write (float): seconds to send a response on top of the time its length allows
+        min_rate (float): the slowest transfer in bytes per second a body or response is given time for
+    """
+
+    def __init__(self, header=5.0, body=10.0, idle=60.0, write=10.0, min_rate=16 * 1024):
+        self.timeouts = {PHASE_HEADER: header, PHASE_BODY: body, PHASE_IDLE: idle, PHASE_WRITE: write}
+        self.min_rate = min_rate
+        self.lock = threading.Lock()
+        # [deadline, order, connection, phase, live], earliest first
+        self.heap = []
+        # connection -> its live heap entry
+        self.entries = dict()
+        self.cancelled = 0
+        self.order = itertools.count()
+        # connection -> the phase whose deadline it missed, until it is cleared
+        self.missed = dict()
+        self.culled = {phase: 0 for phase in PHASES}
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def arm(self, c, phase, size=0):
+        """Starts the deadline for a connection's next phase, replacing its last one
+
+        Args:
+            c (socket): The connection socket
+            phase (str): One of PHASES
+            size (int): The bytes a body or response phase has to move
+        """
+
+        deadline = time.monotonic() + self.timeouts[phase] + size / self.min_rate
+        with self.lock:
+            self.cancel(c)
+            entry = [deadline, next(self.order), c, phase, True]
+            self.entries[c] = entry
+            heapq.heappush(self.heap, entry)
+
+    def extend(self, c, size):
+        """Gives a connection's current phase time for size more bytes, as a body's pieces arrive"""
+
+        with self.lock:
+            entry = self.entries.get(c)
+            if entry is None:
+                return None
+            self.cancel(c)
+            entry = [entry[0] + size / self.min_rate, next(self.order), c, entry[3], True]
+            self.entries[c] = entry
+            heapq.heappush(self.heap, entry)
+
+    def cancel(self, c):
+        # called holding lock, the entry is left in the heap until it reaches the top or the heap is rebuilt
+        entry = self.entries.pop(c, None)
+        if entry is None:
+            return None
+        entry[4] = False
+        self.cancelled += 1
+        if self.cancelled > len(self.entries) + HEAP_SLACK:
+            self.heap = [live for live in self.heap if live[4]]
+            heapq.heapify(self.heap)
+            self.cancelled = 0
+
+    def clear(self, c):
+        """Forgets a connection that is being closed, returning the phase whose deadline it missed if any"""
+
+        with self.lock:
+            self.cancel(c)
+            return self.missed.pop(c, None)
+
+    def expire(self, now):
+        """Shuts down the connections whose deadlines have passed by now, returning how many"""
+
+        expired = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                deadline, order, c, phase, live = heapq.heappop(self.heap)
+                if not live:
+                    self.cancelled -= 1
+                    continue
+                del self.entries[c]
+                self.missed[c] = phase
+                self.culled[phase] += 1
+                expired.append(c)
+        for c in expired:
+            try:
+                c.shutdown(SHUT_RDWR)
+            except OSError:
+                pass
+        return len(expired)
+
+    def expire_loop(self):
+        while not self.stopped.wait(DEADLINE_TICK):
+            self.expire(time.monotonic())
+
+    def start(self):
+        self.thread = threading.Thread(target=self.expire_loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def metrics(self):
+        with self.lock:
+            return {"connections": len(self.entries), "culled": dict(self.culled)}
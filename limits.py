@@ -0,0 +1,239 @@
+"""Message expiry and mailbox size limits for the server's mail store
+
+LimitedMailStore wraps another MailStore. Messages may be given a time to live,
+expired ones are found with a TimingWheel rather than by scanning every mailbox,
+and the bytes held per mailbox and in total can be capped. A message that would
+go over a cap is either refused or makes room by dropping the oldest messages,
+the sender is told which happened in its status frame.
+
+Name: Zya Gurau
+"""
+
+import threading
+import time
+from collections import deque
+from storage import MailStore
+from timers import TimingWheel
+
+# a message over a cap is refused
+OVERFLOW_REJECT = 'reject'
+# the oldest messages are dropped until the new one fits
+OVERFLOW_DROP_OLDEST = 'drop-oldest'
+OVERFLOW_POLICIES = (OVERFLOW_REJECT, OVERFLOW_DROP_OLDEST)
+
+# seconds between expiry checks, messages expire up to this late
+EXPIRY_TICK = 1.0
+
+class MailboxFull(ValueError):
+    """A message was refused because it would take a mailbox or the server over its byte cap"""
+
+class Limits:
+    """The limits a server enforces, None leaves a limit off
+
+    Args:
+        mailbox_bytes (int): the most message bytes stored for one reciever
+        total_bytes (int): the most message bytes stored altogether
+        overflow (str): OVERFLOW_REJECT or OVERFLOW_DROP_OLDEST
+        default_ttl (float): seconds a message is kept for, a sender may ask for less
+    """
+
+    def __init__(self, mailbox_bytes=None, total_bytes=None, overflow=OVERFLOW_REJECT, default_ttl=None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("overflow must be one of " + ", ".join(OVERFLOW_POLICIES))
+        self.mailbox_bytes = mailbox_bytes
+        self.total_bytes = total_bytes
+        self.overflow = overflow
+        self.default_ttl = default_ttl
+
+class LimitedMailStore(MailStore):
+    """Enforces Limits on another mail store
+
+    The size of every stored message is tracked so the caps are checked in O(1),
+    and each mailbox and the store as a whole keep their messages' seqs oldest first
+    for dropping. Seqs of messages that were read are skipped lazily. Messages already
+    in the wrapped store are counted when it is wrapped and get the default ttl.
+
+    While active is False, as on a replication follower whose primary does the
+    removing, messages are tracked but never refused, dropped or expired.
+
+    Args:
+        store (MailStore): the store messages are kept in
+        limits (Limits): the limits to enforce
+    """
+
+    def __init__(self, store, limits):
+        self.store = store
+        self.limits = limits
+        self.active = True
+        self.lock = threading.RLock()
+        # seq -> [recipient, size, expiry timer]
+        self.sizes = dict()
+        # recipient -> [bytes stored, messages stored, deque of seqs oldest first]
+        self.mailboxes = dict()
+        self.total_bytes = 0
+        # (recipient, seq) of every message, oldest first
+        self.order = deque()
+        self.expired = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.wheel = TimingWheel(EXPIRY_TICK, time.monotonic())
+        for seq, recipient, sender, message in store.snapshot():
+            self.track(recipient, seq, len(message), None)
+        self.stopped = threading.Event()
+        self.reaper = threading.Thread(target=self.expire_loop, daemon=True)
+        self.reaper.start()
+
+    def track(self, recipient, seq, size, ttl):
+        if ttl is None:
+            ttl = self.limits.default_ttl
+        elif self.limits.default_ttl is not None:
+            ttl = min(ttl, self.limits.default_ttl)
+        timer = None
+        if ttl is not None:
+            timer = self.wheel.schedule(time.monotonic() + ttl, seq)
+        self.sizes[seq] = [recipient, size, timer]
+        if recipient not in self.mailboxes:
+            self.mailboxes[recipient] = [0, 0, deque()]
+        mailbox = self.mailboxes[recipient]
+        mailbox[0] += size
+        mailbox[1] += 1
+        mailbox[2].append(seq)
+        self.total_bytes += size
+        self.order.append((recipient, seq))
+
+    def mailbox_bytes(self, recipient):
+        mailbox = self.mailboxes.get(recipient)
+        return mailbox[0] if mailbox is not None else 0
+
+    def append(self, recipient, sender, message, seq=None):
+        return self.append_limited(recipient, sender, message, seq=seq)[0]
+
+    def append_limited(self, recipient, sender, message, ttl=None, seq=None):
+        """Stores a message if the limits allow it
+
+        Args:
+            recipient (str): the name of the reciever
+            sender (str): the name of the client who sent the message
+            message (bytearray or SpoolPayload): the message
+            ttl (float): seconds to keep the message for, at most the default ttl
+            seq (int): the sequence number a replication primary gave the message
+
+        Returns:
+            seq (int): the sequence number given to the message
+            dropped (int): the number of older messages dropped to make room
+        """
+
+        size = len(message)
+        limits = self.limits
+        with self.lock:
+            dropped = 0
+            if self.active:
+                over_mailbox = limits.mailbox_bytes is not None and \
+                    self.mailbox_bytes(recipient) + size > limits.mailbox_bytes
+                over_total = limits.total_bytes is not None and self.total_bytes + size > limits.total_bytes
+                too_big = (limits.mailbox_bytes is not None and size > limits.mailbox_bytes) or \
+                    (limits.total_bytes is not None and size > limits.total_bytes)
+                if too_big or ((over_mailbox or over_total) and limits.overflow == OVERFLOW_REJECT):
+                    self.rejected += 1
+                    raise MailboxFull("no room for a " + str(size) + " byte message for " + recipient)
+                if over_mailbox:
+                    dropped += self.drop_oldest(self.mailboxes[recipient][2],
+                        lambda: self.mailbox_bytes(recipient) + size > limits.mailbox_bytes, False)
+                if over_total:
+                    dropped += self.drop_oldest(self.order,
+                        lambda: self.total_bytes + size > limits.total_bytes, True)
+            seq = self.store.append(recipient, sender, message, seq)
+            self.track(recipient, seq, size, ttl)
+        return seq, dropped
+
+    def drop_oldest(self, order, over, keyed):
+        """Removes the oldest messages in order while over() is True, returning how many
+
+        Args:
+            order (deque): a mailbox's seqs, or the (recipient, seq) pairs of every message
+            over (function): returns True while more room is needed
+            keyed (bool): True if order holds (recipient, seq) pairs
+        """
+
+        victims = dict()
+        dropped = 0
+        while over() and order:
+            seq = order.popleft()
+            if keyed:
+                seq = seq[1]
+            if seq not in self.sizes:
+                continue
+            recipient = self.sizes[seq][0]
+            victims.setdefault(recipient, []).append(seq)
+            self.untrack(seq)
+            dropped += 1
+        for recipient, seqs in victims.items():
+            self.store.remove(recipient, seqs)
+        self.dropped += dropped
+        return dropped
+
+    def untrack(self, seq):
+        recipient, size, timer = self.sizes.pop(seq)
+        if timer is not None:
+            self.wheel.cancel(timer)
+        self.total_bytes -= size
+        mailbox = self.mailboxes[recipient]
+        mailbox[0] -= size
+        mailbox[1] -= 1
+        if mailbox[1] == 0:
+            del self.mailboxes[recipient]
+        elif len(mailbox[2]) > 2 * mailbox[1] + 1024:
+            # seqs that were read are only skipped once they reach the front, a mailbox
+            # read out of order is cleared out so its deque stays in proportion to it
+            mailbox[2] = deque(seq for seq in mailbox[2] if seq in self.sizes)
+        if len(self.order) > 2 * len(self.sizes) + 1024:
+            self.order = deque(item for item in self.order if item[1] in self.sizes)
+
+    def peek(self, recipient, limit, after=0, sender=None):
+        return self.store.peek(recipient, limit, after, sender)
+
+    def remove(self, recipient, seqs):
+        with self.lock:
+            self.store.remove(recipient, seqs)
+            for seq in seqs:
+                if seq in self.sizes:
+                    self.untrack(seq)
+
+    def count(self, recipient):
+        return self.store.count(recipient)
+
+    def depths(self, recipients):
+        return self.store.depths(recipients)
+
+    def snapshot(self):
+        return self.store.snapshot()
+
+    def expire(self, now):
+        """Removes the messages whose ttl has run out by now, returning how many"""
+
+        with self.lock:
+            if not self.active:
+                return 0
+            victims = dict()
+            for seq in self.wheel.advance(now):
+                if seq in self.sizes:
+                    victims.setdefault(self.sizes[seq][0], []).append(seq)
+                    self.untrack(seq)
+            for recipient, seqs in victims.items():
+                self.store.remove(recipient, seqs)
+            expired = sum(len(seqs) for seqs in victims.values())
+            self.expired += expired
+            return expired
+
+    def expire_loop(self):
+        while not self.stopped.wait(EXPIRY_TICK):
+            self.expire(time.monotonic())
+
+    def metrics(self):
+        with self.lock:
+            return {"messages": len(self.sizes), "bytes": self.total_bytes, "expired": self.expired,
+                "dropped": self.dropped, "rejected": self.rejected}
+
+    def close(self):
+        self.stopped.set()
+        self.store.close()
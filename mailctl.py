@@ -0,0 +1,69 @@
+"""Thin front-end that forwards a command to a running client daemon
+
+Start the daemon once with 'python client.py <host> <port> <name> daemon', or
+'python client.py unix:/path <name> daemon', then run commands through it with
+'python mailctl.py <name> <request> [args]'. Only the standard library is imported
+here, the daemon already holds the connection, address and keys.
+
+    mailctl.py <name> read
+    mailctl.py <name> create <receiver> <message>
+    mailctl.py <name> attach <receiver> <file path>
+    mailctl.py <name> keys
+    mailctl.py <name> reg
+
+Author: Zya Gurau
+"""
+
+import json
+import socket
+import sys
+from common import daemon_path
+
+def process_argv():
+    try:
+        # gets values from the arguments on the command line and preforms validity checks on them
+
+        if len(sys.argv) < 3:
+            raise ValueError("Request must include a name and a request type")
+
+        name = sys.argv[1]
+        type_rw = sys.argv[2]
+        args = sys.argv[3:]
+
+        if type_rw in ('create', 'attach') and len(args) == 0:
+            args = [input("Enter Receiver Name: ")]
+            args.append(input("Enter Message: " if type_rw == 'create' else "Enter File Path: "))
+        if type_rw in ('create', 'attach') and len(args) != 2:
+            raise ValueError("'" + type_rw + "' takes a reciever name and a " + ("message" if type_rw == 'create' else "file path"))
+
+        return name, type_rw, args
+
+    except ValueError as err:
+        print("ERROR -  " + str(err))
+        exit(1)
+
+def main():
+    """Sends one command to the daemon and prints what it returns"""
+
+    name, type_rw, args = process_argv()
+
+    try:
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.connect(daemon_path(name))
+        with s, s.makefile('rwb') as stream:
+            stream.write(json.dumps({"command": type_rw, "args": args}).encode("utf-8") + b"\n")
+            stream.flush()
+            reply = json.loads(stream.readline())
+
+    except OSError as err:
+        print("ERROR - no daemon running for " + name + " - " + str(err))
+        exit(1)
+    except ValueError:
+        print("ERROR - daemon closed the connection")
+        exit(1)
+
+    print(reply["output"], end="")
+    if not reply["ok"]:
+        exit(1)
+
+main()
@@ -0,0 +1,285 @@
+"""A TCP proxy that makes a loopback connection behave like a slow or unreliable network
+
+The proxy sits between clients and a server on one machine and forwards each
+connection in both directions, delaying every chunk by a latency plus random jitter,
+holding each direction of the link to a bandwidth cap shared by all connections,
+splitting writes into tiny fragments and resetting a connection at random. Chunks
+are never reordered, as on a real TCP connection.
+
+    python server.py 50000
+    python proxy.py 50001 localhost:50000 --latency 40 --jitter 10 --bandwidth 1000000
+    python client.py localhost 50001 zya read
+
+bench.py takes the same options and runs a Proxy in front of its embedded servers.
+
+Author: Zya Gurau
+"""
+
+import argparse
+import asyncio
+import random
+import socket
+import struct
+import threading
+import time
+from common import CHUNK_SIZE, parse_address
+
+# SO_LINGER with a zero timeout, closing the socket then sends a reset
+RESET_LINGER = struct.pack("ii", 1, 0)
+# chunks held per direction of a connection before the proxy stops reading from the sender
+PIPE_QUEUE = 64
+
+class Impairment:
+    """The network conditions a Proxy imposes, the defaults leave the connection as it is
+
+    Args:
+        latency (float): seconds each chunk is delayed by in each direction
+        jitter (float): up to this many more seconds are added to each chunk's delay at random
+        bandwidth (float): bytes per second each direction of the link carries, shared by every connection
+        fragment (int): the most bytes sent by one write
+        reset_rate (float): the chance that forwarding a chunk resets its connection instead
+        seed (int): seeds the random jitter and resets so a run can be repeated
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, bandwidth=None, fragment=None, reset_rate=0.0, seed=None):
+        if latency < 0 or jitter < 0:
+            raise ValueError("latency and jitter can't be negative")
+        if bandwidth is not None and bandwidth <= 0:
+            raise ValueError("bandwidth must be more than 0 bytes per second")
+        if fragment is not None and fragment < 1:
+            raise ValueError("fragment must be at least one byte")
+        if not 0 <= reset_rate <= 1:
+            raise ValueError("reset rate must be between 0 and 1")
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.fragment = fragment
+        self.reset_rate = reset_rate
+        self.random = random.Random(seed)
+
+    def delay(self):
+        return self.latency + self.random.uniform(0, self.jitter)
+
+    def reset(self):
+        return self.reset_rate > 0 and self.random.random() < self.reset_rate
+
+class Link:
+    """One direction of the emulated link, its bandwidth is shared by every connection"""
+
+    def __init__(self, bandwidth):
+        self.bandwidth = bandwidth
+        # when the link has finished sending what it has been given
+        self.free_at = 0.0
+        self.bytes = 0
+
+    def transmit(self, size, now):
+        """Books size bytes onto the link, returning when they have been sent"""
+        self.bytes += size
+        if self.bandwidth is None:
+            return now
+        self.free_at = max(self.free_at, now) + size / self.bandwidth
+        return self.free_at
+
+class ConnectionReset(Exception):
+    """The impairment chose to reset the connection"""
+
+class Proxy:
+    """Forwards connections from a listening port to a server through an Impairment
+
+    Args:
+        port (int): the port to listen on, 0 picks a free one
+        target (str): the server, as 'host:port' or 'unix:/path'
+        impairment (Impairment): the conditions to impose
+        host (str): the address to listen on
+        quiet (bool): if True connections aren't logged
+    """
+
+    def __init__(self, port, target, impairment=None, host='127.0.0.1', quiet=False):
+        self.port = port
+        self.family, self.target = parse_address(target, 'localhost')
+        self.impairment = impairment if impairment is not None else Impairment()
+        self.host = host
+        self.quiet = quiet
+        self.upstream = Link(self.impairment.bandwidth)
+        self.downstream = Link(self.impairment.bandwidth)
+        self.connections = 0
+        self.resets = 0
+        self.loop = None
+        self.task = None
+        self.listener = None
+        self.thread = None
+        self.ready = threading.Event()
+
+    async def listen(self):
+        self.listener = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self.listener.sockets[0].getsockname()[1]
+
+    async def serve(self):
+        """Serves until cancelled"""
+
+        self.loop = asyncio.get_running_loop()
+        self.task = asyncio.current_task()
+        await self.listen()
+        self.ready.set()
+        if not self.quiet:
+            print("proxying port " + str(self.port) + " to " + str(self.target))
+        async with self.listener:
+            await self.listener.serve_forever()
+
+    def start(self):
+        """Starts proxying on a background thread with its own event loop
+
+        Returns:
+            (Proxy): this proxy, so Proxy(0, target).start() can be assigned
+        """
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        self.ready.wait()
+        return self
+
+    def run(self):
+        try:
+            asyncio.run(self.serve())
+        except asyncio.CancelledError:
+            pass
+
+    def stop(self):
+        """Stops a proxy started with start(), asyncio.run then cancels the open connections"""
+
+        if self.task is not None:
+            self.loop.call_soon_threadsafe(self.task.cancel)
+        if self.thread is not None:
+            self.thread.join()
+
+    async def handle(self, client_reader, client_writer):
+        self.connections += 1
+        try:
+            if self.family == socket.AF_UNIX:
+                server_reader, server_writer = await asyncio.open_unix_connection(self.target)
+            else:
+                server_reader, server_writer = await asyncio.open_connection(*self.target)
+        except OSError as err:
+            if not self.quiet:
+                print("ERROR -  " + str(err))
+            client_writer.close()
+            return
+        writers = (client_writer, server_writer)
+        for writer in writers:
+            sock = writer.get_extra_info('socket')
+            if sock.family != socket.AF_UNIX:
+                # fragments go out as separate segments rather than being coalesced
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        pipes = [asyncio.ensure_future(self.pipe(client_reader, server_writer, self.upstream)),
+            asyncio.ensure_future(self.pipe(server_reader, client_writer, self.downstream))]
+        try:
+            await asyncio.gather(*pipes)
+        except ConnectionReset:
+            self.resets += 1
+            for writer in writers:
+                try:
+                    writer.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, RESET_LINGER)
+                except OSError:
+                    pass
+                writer.transport.abort()
+        except OSError:
+            pass
+        except asyncio.CancelledError:
+            # the proxy is stopping, the connection is closed below
+            pass
+        finally:
+            for pipe in pipes:
+                pipe.cancel()
+            for writer in writers:
+                writer.close()
+
+    async def pipe(self, reader, writer, link):
+        """Forwards one direction of a connection until the sender closes it
+
+        Chunks are read as soon as they arrive and queued with the time they are due,
+        so the delay doesn't hold up reading and a burst keeps its spacing. Once the
+        queue is full the sender is held back, as a full TCP window would.
+        """
+
+        queue = asyncio.Queue(PIPE_QUEUE)
+
+        async def receive():
+            while True:
+                chunk = await reader.read(CHUNK_SIZE)
+                await queue.put((time.monotonic() + self.impairment.delay(), chunk))
+                if not chunk:
+                    return
+
+        receiver = asyncio.ensure_future(receive())
+        try:
+            # chunks leave in order, a short delay can't overtake a long one
+            due = 0.0
+            while True:
+                arrival, chunk = await queue.get()
+                if not chunk:
+                    await receiver
+                    if writer.can_write_eof():
+                        writer.write_eof()
+                    return
+                due = max(due, arrival)
+                if self.impairment.reset():
+                    raise ConnectionReset()
+                fragment = self.impairment.fragment or len(chunk)
+                for start in range(0, len(chunk), fragment):
+                    piece = chunk[start:start + fragment]
+                    sent_at = max(due, link.transmit(len(piece), max(due, time.monotonic())))
+                    wait = sent_at - time.monotonic()
+                    if wait > 0:
+                        await asyncio.sleep(wait)
+                    writer.write(piece)
+                    await writer.drain()
+        finally:
+            receiver.cancel()
+
+    def metrics(self):
+        return {"connections": self.connections, "resets": self.resets,
+            "bytes_up": self.upstream.bytes, "bytes_down": self.downstream.bytes}
+
+def add_impairment_arguments(parser):
+    """Adds the options describing an Impairment, shared with bench.py"""
+
+    parser.add_argument("--latency", type=float, default=0, metavar="MS",
+        help="milliseconds each chunk is delayed by in each direction")
+    parser.add_argument("--jitter", type=float, default=0, metavar="MS",
+        help="up to this many more milliseconds are added at random")
+    parser.add_argument("--bandwidth", type=float, default=None, metavar="BYTES",
+        help="bytes per second each direction carries across all connections")
+    parser.add_argument("--fragment", type=int, default=None, metavar="BYTES",
+        help="split writes into pieces of at most this many bytes")
+    parser.add_argument("--reset-rate", type=float, default=0, metavar="P",
+        help="chance that each chunk forwarded resets its connection instead")
+    parser.add_argument("--seed", type=int, default=None, help="seed for the jitter and resets")
+
+def impairment_from_args(args):
+    return Impairment(args.latency / 1000, args.jitter / 1000, args.bandwidth, args.fragment, args.reset_rate,
+        args.seed)
+
+def process_argv():
+    parser = argparse.ArgumentParser(description="Proxies connections to the server through an emulated slow network")
+    parser.add_argument("port", type=int, help="the port to listen on")
+    parser.add_argument("target", help="the server, as host:port or unix:/path")
+    parser.add_argument("--host", default='127.0.0.1', help="the address to listen on (default: 127.0.0.1)")
+    add_impairment_arguments(parser)
+    return parser.parse_args()
+
+def main():
+    args = process_argv()
+    try:
+        proxy = Proxy(args.port, args.target, impairment_from_args(args), args.host)
+    except ValueError as err:
+        print("ERROR -  " + str(err))
+        exit()
+    try:
+        asyncio.run(proxy.serve())
+    except KeyboardInterrupt:
+        print(proxy.metrics())
+    except OSError as err:
+        print("ERROR -  " + str(err))
+
+if __name__ == "__main__":
+    main()
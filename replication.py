@@ -0,0 +1,494 @@
+"""Hot-standby replication, a primary server streams its mutations to follower servers
+
+Every create, removal of delivered messages and key registration on the primary is
+recorded in a MutationLog under a log sequence number (lsn) and streamed to each
+follower in order. A follower applies them to its own stores, acknowledging the lsn
+it has reached, and keeps the sequence numbers the primary gave its messages.
+
+A follower connecting for the first time, or one that has fallen further behind
+than the log keeps, is sent a snapshot of the primary's stores before the stream.
+Followers refuse requests that would change their stores but serve 'keys', and are
+promoted to primary with SIGUSR1 or Server.promote(). Both sides log their
+replication lag every REPL_REPORT_INTERVAL seconds, metrics() gives the same figures.
+
+Two server processes on one box:
+
+    python server.py 50000 --replicate unix:/tmp/mail-repl.sock
+    python server.py 50001 --follow unix:/tmp/mail-repl.sock
+
+Name: Zya Gurau
+"""
+
+import os
+import socket
+import struct
+import tempfile
+import threading
+import time
+from collections import deque
+from itertools import islice
+from common import encode_key_int, recv_exact, recv_to_file
+from storage import MailStore, KeyStore, SpoolPayload
+
+# sent by a follower when it connects
+REPL_MAGIC = b"AERP"
+# magic, epoch of the log the follower last applied, the next lsn it needs
+REPL_HELLO = struct.Struct("!4s16sQ")
+# kind, lsn, primary time, message seq, recipient length, sender length, body length
+REPL_RECORD = struct.Struct("!BQdQHHQ")
+# the lsn a follower has applied, sent back to the primary
+REPL_ACK = struct.Struct("!Q")
+
+# a message was stored, the body is the message
+REPL_APPEND = 1
+# a delivered message was removed, there is no sender or body
+REPL_REMOVE = 2
+# a key was registered, the recipient field is the name and the body a 16 bit e
+# length, e and then n as big-endian integers
+REPL_KEY = 3
+# a snapshot follows, the body is the epoch of the primary's log
+REPL_SNAPSHOT_BEGIN = 4
+# the snapshot is complete up to the record's lsn
+REPL_SNAPSHOT_END = 5
+# nothing has changed, every record up to the lsn has been sent
+REPL_HEARTBEAT = 6
+
+# how many records the primary keeps for followers that reconnect
+REPL_BACKLOG = 65536
+# the most records sent in one batch
+REPL_BATCH = 1024
+# seconds between heartbeats when there is nothing to send
+REPL_HEARTBEAT_INTERVAL = 1
+# a follower acknowledges after this many records even mid batch
+REPL_ACK_EVERY = 256
+# seconds a send or recieve may stall before the connection is dropped, long enough
+# for one large spooled message
+REPL_TIMEOUT = 30
+# seconds a follower waits before reconnecting
+REPL_RETRY = 1
+# seconds between the lag lines in the server log
+REPL_REPORT_INTERVAL = 10
+
+class MutationLog:
+    """The primary's recent mutations, the oldest are dropped after REPL_BACKLOG records
+
+    Records are (lsn, time, kind, seq, recipient, sender, body) tuples. The changed
+    condition guards the log and is held while a mutation is applied to the stores,
+    so the log order is the order the stores changed in.
+    """
+
+    def __init__(self, backlog=REPL_BACKLOG):
+        # a new epoch for every process, lsns from another epoch mean nothing here
+        self.epoch = os.urandom(16)
+        self.records = deque()
+        self.next_lsn = 1
+        self.backlog = backlog
+        self.changed = threading.Condition()
+
+    def record(self, kind, seq, recipient, sender, body):
+        """Adds a record, called holding changed"""
+
+        self.records.append((self.next_lsn, time.time(), kind, seq, recipient, sender, body))
+        self.next_lsn += 1
+        if len(self.records) > self.backlog:
+            self.records.popleft()
+        self.changed.notify_all()
+
+    def since(self, lsn):
+        """Returns up to REPL_BATCH records from lsn onwards, called holding changed
+
+        Returns:
+            (list): the records, or None if lsn has already been dropped from the log
+        """
+
+        if lsn >= self.next_lsn:
+            return []
+        if not self.records or lsn < self.records[0][0]:
+            return None
+        start = lsn - self.records[0][0]
+        return list(islice(self.records, start, start + REPL_BATCH))
+
+    def time_of(self, lsn):
+        """Returns when the record lsn was made, None if it is not in the log"""
+
+        with self.changed:
+            if self.records and self.records[0][0] <= lsn < self.next_lsn:
+                return self.records[lsn - self.records[0][0]][1]
+            return None
+
+class ReplicatedMailStore(MailStore):
+    """Records every change made to a mail store in a MutationLog"""
+
+    def __init__(self, store, log):
+        self.store = store
+        self.log = log
+
+    def append(self, recipient, sender, message, seq=None):
+        with self.log.changed:
+            seq = self.store.append(recipient, sender, message, seq)
+            self.log.record(REPL_APPEND, seq, recipient, sender, message)
+        return seq
+
+    def peek(self, recipient, limit, after=0, sender=None):
+        return self.store.peek(recipient, limit, after, sender)
+
+    def remove(self, recipient, seqs):
+        with self.log.changed:
+            self.store.remove(recipient, seqs)
+            for seq in seqs:
+                self.log.record(REPL_REMOVE, seq, recipient, "", b"")
+
+    def count(self, recipient):
+        return self.store.count(recipient)
+
+    def depths(self, recipients):
+        return self.store.depths(recipients)
+
+    def snapshot(self):
+        return self.store.snapshot()
+
+    def close(self):
+        self.store.close()
+
+class ReplicatedKeyStore(KeyStore):
+    """Records every registration made to a key store in a MutationLog"""
+
+    def __init__(self, store, log):
+        self.store = store
+        self.log = log
+
+    def put(self, name, n, e):
+        e_bytes = encode_key_int(e)
+        with self.log.changed:
+            self.store.put(name, n, e)
+            self.log.record(REPL_KEY, 0, name, "", len(e_bytes).to_bytes(2, "big") + e_bytes + encode_key_int(n))
+
+    def items(self):
+        return self.store.items()
+
+    def close(self):
+        self.store.close()
+
+def send_records(c, records):
+    """Sends log records to a follower, streaming spooled messages from their files
+
+    A spooled message may have been delivered and its file deleted since it was
+    recorded, it is then sent empty as its removal follows later in the stream.
+
+    Args:
+        c (socket): the follower's connection
+        records (list): (lsn, time, kind, seq, recipient, sender, body) tuples
+    """
+
+    buffer = bytearray()
+    for lsn, sent_time, kind, seq, recipient, sender, body in records:
+        recipient_bytes = recipient.encode("utf-8")
+        sender_bytes = sender.encode("utf-8")
+        if not isinstance(body, SpoolPayload):
+            buffer += REPL_RECORD.pack(kind, lsn, sent_time, seq, len(recipient_bytes), len(sender_bytes), len(body))
+            buffer += recipient_bytes + sender_bytes + body
+            if len(buffer) >= 64 * 1024:
+                c.sendall(buffer)
+                buffer = bytearray()
+            continue
+        try:
+            spool_file = open(body.path, 'rb')
+        except FileNotFoundError:
+            spool_file = None
+        length = len(body) if spool_file is not None else 0
+        buffer += REPL_RECORD.pack(kind, lsn, sent_time, seq, len(recipient_bytes), len(sender_bytes), length)
+        buffer += recipient_bytes + sender_bytes
+        c.sendall(buffer)
+        buffer = bytearray()
+        if spool_file is not None:
+            with spool_file:
+                c.sendfile(spool_file, count=length)
+    c.sendall(buffer)
+
+class ReplicationSource:
+    """Listens for followers on the primary and streams the MutationLog to each of them
+
+    Args:
+        server (Server): the primary, its stores must be the Replicated ones sharing log
+        log (MutationLog): the primary's mutation log
+        address (tuple): (family, address) from parse_address for followers to connect to
+    """
+
+    def __init__(self, server, log, address):
+        self.server = server
+        self.log = log
+        self.family, self.address = address
+        self.sock = None
+        self.stopped = False
+        # follower connection -> [peer name, acked lsn, connected time]
+        self.followers = dict()
+        self.lock = threading.Lock()
+
+    def start(self):
+        if self.family == socket.AF_UNIX and os.path.exists(self.address):
+            os.remove(self.address)
+        self.sock = socket.socket(self.family, socket.SOCK_STREAM)
+        if self.family == socket.AF_INET:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(self.address)
+        self.sock.listen()
+        self.server.log("replication listening on " + str(self.address))
+        threading.Thread(target=self.accept_loop, daemon=True).start()
+        threading.Thread(target=self.report_loop, daemon=True).start()
+
+    def stop(self):
+        self.stopped = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        with self.lock:
+            for c in list(self.followers):
+                try:
+                    c.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+        with self.log.changed:
+            self.log.changed.notify_all()
+        if self.family == socket.AF_UNIX and os.path.exists(self.address):
+            os.remove(self.address)
+
+    def accept_loop(self):
+        while not self.stopped:
+            try:
+                c, addr = self.sock.accept()
+            except OSError as err:
+                if not self.stopped:
+                    print("ERROR -  replication - " + str(err))
+                continue
+            threading.Thread(target=self.serve_follower, args=(c, str(addr or "unix socket")), daemon=True).start()
+
+    def serve_follower(self, c, peer):
+        """Sends a follower a snapshot if it needs one, then every record as it is logged"""
+
+        try:
+            c.settimeout(REPL_TIMEOUT)
+            magic, epoch, next_lsn = REPL_HELLO.unpack(recv_exact(c, REPL_HELLO.size))
+            if magic != REPL_MAGIC:
+                raise ValueError("not a replication follower")
+            with self.lock:
+                self.followers[c] = [peer, next_lsn - 1, time.time()]
+            threading.Thread(target=self.read_acks, args=(c,), daemon=True).start()
+            self.server.log("follower connected from " + peer)
+
+            with self.log.changed:
+                records = self.log.since(next_lsn) if epoch == self.log.epoch else None
+            if records is None:
+                next_lsn = self.send_snapshot(c)
+
+            while not self.stopped:
+                with self.log.changed:
+                    records = self.log.since(next_lsn)
+                    if records == []:
+                        self.log.changed.wait(REPL_HEARTBEAT_INTERVAL)
+                        records = self.log.since(next_lsn)
+                    last_lsn = self.log.next_lsn - 1
+                if records is None:
+                    raise ValueError("follower " + peer + " fell behind the replication log")
+                if records == []:
+                    send_records(c, [(last_lsn, time.time(), REPL_HEARTBEAT, 0, "", "", b"")])
+                    continue
+                send_records(c, records)
+                next_lsn = records[-1][0] + 1
+
+        except (OSError, ValueError) as err:
+            if not self.stopped:
+                print("ERROR -  replication - " + str(err))
+        finally:
+            with self.lock:
+                self.followers.pop(c, None)
+            c.close()
+            self.server.log("follower " + peer + " disconnected")
+
+    def send_snapshot(self, c):
+        """Sends every stored message and key, returning the lsn the stream carries on from"""
+
+        with self.log.changed:
+            messages = self.server.mail_store.snapshot()
+            keys = self.server.key_store.items()
+            lsn = self.log.next_lsn - 1
+        now = time.time()
+        send_records(c, [(0, now, REPL_SNAPSHOT_BEGIN, 0, "", "", self.log.epoch)])
+        for index in range(0, len(messages), REPL_BATCH):
+            send_records(c, [(0, now, REPL_APPEND, seq, recipient, sender, message)
+                for seq, recipient, sender, message in messages[index:index + REPL_BATCH]])
+        for name, n, e in keys:
+            e_bytes = encode_key_int(e)
+            send_records(c, [(0, now, REPL_KEY, 0, name, "", len(e_bytes).to_bytes(2, "big") + e_bytes + encode_key_int(n))])
+        send_records(c, [(lsn, now, REPL_SNAPSHOT_END, 0, "", "", b"")])
+        return lsn + 1
+
+    def read_acks(self, c):
+        try:
+            while True:
+                acked = REPL_ACK.unpack(recv_exact(c, REPL_ACK.size))[0]
+                with self.lock:
+                    self.followers[c][1] = acked
+        except (OSError, ValueError, KeyError):
+            # ends the stream too
+            try:
+                c.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def metrics(self):
+        """Returns the lag of each connected follower
+
+        Returns:
+            (list): dicts of 'follower', 'acked_lsn', 'lag_records' and 'lag_seconds', the
+                age of the oldest record the follower has not acknowledged
+        """
+
+        last_lsn = self.log.next_lsn - 1
+        now = time.time()
+        with self.lock:
+            followers = list(self.followers.values())
+        metrics = []
+        for peer, acked, connected in followers:
+            oldest = self.log.time_of(acked + 1) if acked < last_lsn else now
+            metrics.append({"follower": peer, "acked_lsn": acked, "lag_records": last_lsn - acked,
+                "lag_seconds": now - (oldest if oldest is not None else connected)})
+        return metrics
+
+    def report_loop(self):
+        while not self.stopped:
+            time.sleep(REPL_REPORT_INTERVAL)
+            for follower in self.metrics():
+                self.server.log("replication to %s: acked lsn %d, %d records and %.3f s behind" % (
+                    follower["follower"], follower["acked_lsn"], follower["lag_records"], follower["lag_seconds"]))
+
+class ReplicationFollower:
+    """Follows a primary, applying its mutations to this server's stores
+
+    Args:
+        server (Server): the follower
+        address (tuple): (family, address) from parse_address of the primary's replication socket
+        spool_threshold (int): messages at least this large are written to spool files
+    """
+
+    def __init__(self, server, address, spool_threshold):
+        self.server = server
+        self.family, self.address = address
+        self.spool_threshold = spool_threshold
+        self.sock = None
+        self.stopped = False
+        # the primary's log this follower's stores are a copy of
+        self.epoch = bytes(16)
+        self.applied_lsn = 0
+        # seconds between the primary logging the last record applied and it being applied
+        self.lag = None
+        self.connected = False
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped = True
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def run(self):
+        while not self.stopped:
+            try:
+                self.follow()
+            except (OSError, ValueError) as err:
+                if not self.stopped:
+                    print("ERROR -  replication - " + str(err))
+            finally:
+                self.connected = False
+                if self.sock is not None:
+                    self.sock.close()
+            if not self.stopped:
+                time.sleep(REPL_RETRY)
+
+    def follow(self):
+        """Connects to the primary and applies records until the connection ends"""
+
+        self.sock = socket.socket(self.family, socket.SOCK_STREAM)
+        self.sock.settimeout(REPL_TIMEOUT)
+        self.sock.connect(self.address)
+        self.sock.sendall(REPL_HELLO.pack(REPL_MAGIC, self.epoch, self.applied_lsn + 1))
+        self.connected = True
+        self.server.log("following " + str(self.address))
+        unacked = 0
+        last_report = time.monotonic()
+        while not self.stopped:
+            kind, lsn, sent_time, seq, rec_len, sen_len, body_len = REPL_RECORD.unpack(
+                recv_exact(self.sock, REPL_RECORD.size))
+            names = recv_exact(self.sock, rec_len + sen_len)
+            recipient = names[:rec_len].decode("utf-8")
+            sender = names[rec_len:].decode("utf-8")
+
+            if kind == REPL_APPEND:
+                self.server.mail_store.append(recipient, sender, self.recv_message(body_len), seq)
+            elif kind == REPL_REMOVE:
+                self.server.mail_store.remove(recipient, [seq])
+            elif kind == REPL_KEY:
+                body = recv_exact(self.sock, body_len)
+                e_len = int.from_bytes(body[:2], "big")
+                self.server.key_store.put(recipient, int.from_bytes(body[2 + e_len:], "big"),
+                    int.from_bytes(body[2:2 + e_len], "big"))
+            elif kind == REPL_SNAPSHOT_BEGIN:
+                self.epoch = bytes(recv_exact(self.sock, body_len))
+                self.clear()
+            elif kind not in (REPL_SNAPSHOT_END, REPL_HEARTBEAT) or body_len != 0:
+                raise ValueError("unknown replication record")
+
+            # snapshot records carry no lsn of their own
+            if lsn != 0:
+                self.applied_lsn = lsn
+                self.lag = time.time() - sent_time
+                unacked += 1
+            # heartbeats are always answered so the primary knows this follower is alive
+            if kind in (REPL_SNAPSHOT_END, REPL_HEARTBEAT) or unacked >= REPL_ACK_EVERY:
+                self.sock.sendall(REPL_ACK.pack(self.applied_lsn))
+                unacked = 0
+            if time.monotonic() - last_report >= REPL_REPORT_INTERVAL:
+                last_report = time.monotonic()
+                metrics = self.metrics()
+                self.server.log("replicated up to lsn %d, %.3f s behind the primary" % (
+                    metrics["applied_lsn"], metrics["lag_seconds"] or 0))
+
+    def recv_message(self, length):
+        if length < self.spool_threshold:
+            return recv_exact(self.sock, length)
+        fd, path = tempfile.mkstemp(dir=self.server.spool_dir, suffix=".msg")
+        try:
+            with os.fdopen(fd, 'wb') as spool_file:
+                recv_to_file(self.sock, spool_file, length)
+        except (OSError, ValueError):
+            os.remove(path)
+            raise
+        return SpoolPayload(path, length)
+
+    def clear(self):
+        """Removes every message before a snapshot is applied, keys are overwritten by it"""
+
+        mailboxes = dict()
+        for seq, recipient, sender, message in self.server.mail_store.snapshot():
+            mailboxes.setdefault(recipient, []).append(seq)
+        for recipient, seqs in mailboxes.items():
+            self.server.mail_store.remove(recipient, seqs)
+
+    def metrics(self):
+        """Returns how far this follower is behind
+
+        Returns:
+            (dict): 'connected', 'applied_lsn' and 'lag_seconds', how old the primary's
+                last record or heartbeat was when it was applied here
+        """
+
+        return {"connected": self.connected, "applied_lsn": self.applied_lsn, "lag_seconds": self.lag}
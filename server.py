@@ -5,17 +5,305 @@ send messages to the server addressed to other clients that the server will then
 Using a 'read' request a Client can get the server to send them up to 255 of the messages stored 
 for them by the server.
 
+Messages and public keys are kept in the stores from storage.py, chosen with --store,
+and can be replicated to hot standby servers with --replicate and --follow, see replication.py.
+Request rates per sender and per IP and the requests served at once can be limited,
+see admission.py, a client over a limit is sent a retry later frame.
+Clients on the same host can connect through a Unix domain socket given with --unix,
+with the same framing as TCP. Each phase of a connection has a deadline, see
+deadlines.py, so a client sending or reading too slowly is cut off.
+The Server class can also be started and stopped inside another program:
+
+    server = Server(0, quiet=True).start()
+    ...
+    server.stop()
+
 Name: Zya Gurau
 """
 
 from socket import *   
-import sys
-from common import MessageResponse, MessageKeys
+import argparse
+import bisect
+import os
+import signal
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+from common import (MessageResponse, MessageKeys, MessageResponseV2, MessageStatus, MessageUploadState,
+	MessageRetryLater, KEYS_BINARY_ID, REGISTER_BINARY_ID, UPLOAD_OPEN_ID, UPLOAD_CHUNK_ID, UPLOAD_QUERY_ID,
+	STATUS_OK, STATUS_UNKNOWN_UPLOAD, STATUS_BAD_OFFSET, STATUS_READ_ONLY, STATUS_MAILBOX_FULL,
+	STATUS_DROPPED_OLDEST, MAGIC_V1, MAGIC_V2, HEADER_V2, UPLOAD_OPEN, UPLOAD_CHUNK, UPLOAD_QUERY,
+	CHUNK_HEADER, TTL, READ_ACKED, DEPTH_ID, DEPTH_MAX_NAMES, FLAG_CHUNKED, FLAG_KEEP_ALIVE, FLAG_TTL,
+	FLAG_ACK, CHUNK_SIZE, PAGE_SIZE_V2, MAX_KEY_BITS, decode_key_int, recv_exact, recv_chunked, recv_to_file,
+	parse_address)
+from admission import Admission
+from deadlines import Deadlines, PHASE_HEADER, PHASE_BODY, PHASE_IDLE, PHASE_WRITE
+from limits import Limits, LimitedMailStore, MailboxFull, OVERFLOW_POLICIES
+from replication import MutationLog, ReplicatedMailStore, ReplicatedKeyStore, ReplicationSource, ReplicationFollower
+from storage import SpoolPayload, MemoryMailStore, MemoryKeyStore, STORE_TYPES, open_stores
+
+# message bodies at least this large are written to a spool file instead of memory
+SPOOL_THRESHOLD = 1024 * 1024
+# the longest body a read, key or registration request may have, they are recieved into memory
+MAX_REQUEST_BODY = 64 * 1024
+# upload sessions not written to for this many seconds are discarded
+UPLOAD_IDLE_TIMEOUT = 3600
+# how many finished upload tokens are remembered so a late query can see the upload completed
+COMPLETED_UPLOADS = 1024
+# seconds a client may leave read pages unacknowledged before they are sent again
+ACK_TIMEOUT = 30
+# seconds stop() waits for open connections to finish
+STOP_TIMEOUT = 5
+
+class UploadSession:
+	"""The state of a resumable upload, the spool file holds the bytes up to offset"""
+
+	def __init__(self, sender, receiver, length, path):
+		self.sender = sender
+		self.receiver = receiver
+		self.length = length
+		self.path = path
+		self.offset = 0
+		self.last_used = time.monotonic()
+		# set while a connection is writing a chunk
+		self.writing = False
+
+class Delivery:
+	"""The messages of a mailbox that have been sent and not yet removed
+
+	Each page sent by an acknowledged read is kept as its cursor, the seq of its last
+	message, and its seqs. Pages are cut from the mailbox in seq order so acknowledging
+	a cursor acknowledges every page up to it. Pages the client has not acknowledged
+	within ACK_TIMEOUT, or when it starts again with no cursor, are sent again, their
+	seqs are kept in stale so a late acknowledgement still removes them. The seqs a
+	plain read is sending are kept in claimed until it removes them, so neither kind
+	of read sends a message the other has sent.
+	"""
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.pages = deque()
+		self.stale = []
+		self.claimed = set()
+		self.updated = time.monotonic()
+		# set once dropped from server.deliveries, a reader holding it looks it up again
+		self.retired = False
+
+	def acknowledge(self, cursor):
+		"""Returns the seqs of the messages acknowledged by a cursor"""
+
+		seqs = []
+		while self.pages and self.pages[0][0] <= cursor:
+			seqs += self.pages.popleft()[1]
+		if self.stale:
+			index = bisect.bisect_right(self.stale, cursor)
+			seqs += self.stale[:index]
+			del self.stale[:index]
+		return seqs
+
+	def rewind(self):
+		for cursor, seqs in self.pages:
+			self.stale += seqs
+		self.stale.sort()
+		self.pages.clear()
+
+	def in_flight(self):
+		"""Returns the seqs sent by either kind of read and not yet removed"""
+
+		seqs = set(self.claimed)
+		seqs.update(self.stale)
+		for cursor, page in self.pages:
+			seqs.update(page)
+		return seqs
+
+	def idle(self):
+		return not self.pages and not self.stale and not self.claimed
+
+class Server:
+	"""A server that can be embedded in another program, tests or benchmarks
+
+	start() serves connections on a background thread until stop() is called, main()
+	runs the same loop in the foreground. The handlers reach messages and public keys
+	only through the server's mail_store and key_store.
+
+	Args:
+		port (int): The TCP port to listen on, 0 picks a free port and None listens only on unix_path
+		mail_store (MailStore): Where messages are kept, in memory if not given
+		key_store (KeyStore): Where public keys are kept, in memory if not given
+		spool_dir (str): Where large message bodies are written, a new temporary directory if not given
+		host (str): The address to bind, "0.0.0.0" binds to all local interfaces
+		quiet (bool): True to not print a line for every request
+		replicate (tuple): (family, address) from parse_address to stream mutations to followers on
+		follow (tuple): (family, address) from parse_address of a primary to follow, the
+			server then only answers key requests until promoted
+		limits (Limits): The message TTL and mailbox byte caps to enforce, None for none but the TTLs
+			messages are sent with
+		admission (Admission): The request rate and in-flight limits to enforce, None for no limits
+		unix_path (str): A Unix domain socket path to listen on as well, local clients
+			connecting to it skip the TCP stack
+		deadlines (Deadlines): The connection phase timeouts, the defaults if not given
+	"""
+
+	def __init__(self, port, mail_store=None, key_store=None, spool_dir=None, host='0.0.0.0', quiet=False,
+			replicate=None, follow=None, limits=None, admission=None, unix_path=None, deadlines=None):
+		if port is None and unix_path is None:
+			raise ValueError("a server needs a port or a unix socket path to listen on")
+		self.port = port
+		self.host = host
+		self.unix_path = unix_path
+		self.mail_store = mail_store if mail_store is not None else MemoryMailStore()
+		self.key_store = key_store if key_store is not None else MemoryKeyStore()
+		if spool_dir is None:
+			spool_dir = tempfile.mkdtemp(prefix="mailserver-spool-")
+		os.makedirs(spool_dir, exist_ok=True)
+		self.spool_dir = spool_dir
+		self.quiet = quiet
+		# guards uploads, completed_uploads, connections and deliveries, the stores have their own locks
+		self.lock = threading.RLock()
+		# open upload sessions by token
+		self.uploads = dict()
+		# token -> (sender, reciever, message length) of recently finished uploads
+		self.completed_uploads = OrderedDict()
+		# connection sockets being served, closed by stop()
+		self.connections = set()
+		# reciever name -> Delivery of the pages awaiting acknowledgement
+		self.deliveries = dict()
+		# the listening sockets, TCP first
+		self.socks = []
+		self.thread = None
+		self.stopped = False
+		self.replication = None
+		if replicate is not None:
+			log = MutationLog()
+			self.mail_store = ReplicatedMailStore(self.mail_store, log)
+			self.key_store = ReplicatedKeyStore(self.key_store, log)
+			self.replication = ReplicationSource(self, log, replicate)
+		self.follower = None
+		if follow is not None:
+			self.follower = ReplicationFollower(self, follow, SPOOL_THRESHOLD)
+		# a follower refuses requests that would change its stores
+		self.read_only = follow is not None
+		# wraps the replicated store so expiries and dropped messages are replicated too,
+		# a follower leaves them to its primary. It is there without caps as well, as any
+		# message may be sent with a TTL
+		if limits is None:
+			limits = Limits()
+		self.limits = self.mail_store = LimitedMailStore(self.mail_store, limits)
+		self.limits.active = not self.read_only
+		self.admission = admission
+		self.deadlines = deadlines if deadlines is not None else Deadlines()
+
+	def log(self, text):
+		if not self.quiet:
+			print(text)
+
+	def listen(self):
+		"""Binds the server sockets and starts listening, self.port is set to the bound port"""
+
+		try:
+			if self.port is not None:
+				# server socket is created
+				sock = socket(AF_INET, SOCK_STREAM)
+				self.socks.append(sock)
+				sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+				sock.bind((self.host, self.port))
+				self.port = sock.getsockname()[1]
+				self.log("socket bound to %s" %(self.port))
+			if self.unix_path is not None:
+				# a socket file left by a server that was killed would stop the bind
+				if os.path.exists(self.unix_path):
+					os.remove(self.unix_path)
+				sock = socket(AF_UNIX, SOCK_STREAM)
+				self.socks.append(sock)
+				sock.bind(self.unix_path)
+				self.log("socket bound to " + self.unix_path)
+
+			#Listen for connection requests, with admission limits the backlog is bounded too
+			for sock in self.socks:
+				if self.admission is not None:
+					sock.listen(self.admission.queue)
+				else:
+					sock.listen()
+			self.log("socket is listening")
+		except OSError:
+			for sock in self.socks:
+				sock.close()
+			raise
+		if self.replication is not None:
+			self.replication.start()
+		if self.follower is not None:
+			self.follower.start()
+		self.deadlines.start()
+
+	def promote(self):
+		"""Stops following the primary and starts accepting every request"""
+
+		if self.follower is not None:
+			self.follower.stop()
+			self.follower = None
+		self.read_only = False
+		self.limits.active = True
+		self.log("promoted to primary")
+
+	def serve_forever(self):
+		# the first socket is served on this thread and any other on one of its own
+		accept_threads = [threading.Thread(target=self.accept_loop, args=(sock,), daemon=True)
+			for sock in self.socks[1:]]
+		for thread in accept_threads:
+			thread.start()
+		self.accept_loop(self.socks[0])
+		for thread in accept_threads:
+			thread.join()
+
+	def accept_loop(self, sock):
+		while not self.stopped:
+			server_loop(self, sock)
+
+	def start(self):
+		"""Starts serving on a background thread
+
+		Returns:
+			(Server): this server, so Server(0).start() can be assigned
+		"""
 
-# a dictionary used to store Client messages
-messages = dict()
-# a dictionat storing the public key database.
-public_keys = dict()
+		self.listen()
+		self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+		self.thread.start()
+		return self
+
+	def stop(self):
+		"""Stops accepting, closes open connections and then the stores"""
+
+		self.stopped = True
+		if self.follower is not None:
+			self.follower.stop()
+		if self.replication is not None:
+			self.replication.stop()
+		for sock in self.socks:
+			try:
+				# wakes the accept() the serving thread is blocked in
+				sock.shutdown(SHUT_RDWR)
+			except OSError:
+				pass
+			sock.close()
+		if self.unix_path is not None and os.path.exists(self.unix_path):
+			os.remove(self.unix_path)
+		if self.thread is not None and self.thread is not threading.current_thread():
+			self.thread.join()
+		with self.lock:
+			for c in list(self.connections):
+				try:
+					c.shutdown(SHUT_RDWR)
+				except OSError:
+					pass
+		# gives the connection threads a moment to finish with the stores
+		deadline = time.monotonic() + STOP_TIMEOUT
+		while self.connections and time.monotonic() < deadline:
+			time.sleep(0.01)
+		self.deadlines.stop()
+		self.mail_store.close()
+		self.key_store.close()
 
 def create_initial_response(message_response, num_items, more_msgs):
 	"""returns the basic packet header for a read request
@@ -37,7 +325,23 @@ def create_initial_response(message_response, num_items, more_msgs):
 	
 	return message_response
 
-def add_messages(message_response, items, num_items, s, c):
+def encode_sender(encoded, sender):
+	"""Encodes a sender name once per response, a page is usually many messages from a few senders
+
+	Args:
+		encoded (dict): The names encoded so far for this response
+		sender (str): The sender name
+
+	Returns:
+		(bytes): The UTF-8 encoded name
+	"""
+
+	sender_bytes = encoded.get(sender)
+	if sender_bytes is None:
+		sender_bytes = encoded[sender] = sender.encode("utf-8")
+	return sender_bytes
+
+def add_messages(message_response, items, num_items, server, c):
 	"""Adds messages to the message response bytearray
 
 	Iterates through the messages stored for the client in range of the number of items
@@ -45,9 +349,9 @@ def add_messages(message_response, items, num_items, s, c):
 	
 	Args:
 		message_response (bytearray): The bytearray containing the message response header
-		items (list): The list of messages addressed to the client
+		items (list): The (seq, sender, message) tuples addressed to the client
 		num_items (int): The number of messages able to be added to the bytearray
-		s (socket): The server socket
+		server (Server): The server the request was made to
 		c (socket): The connection socket
 
 	Returns:
@@ -56,79 +360,103 @@ def add_messages(message_response, items, num_items, s, c):
 	"""
 
 	try:
+		encoded = dict()
 		for i in range(num_items):
-			message_bytes = items[i][1]
-			sender_bytes = items[i][0].encode("utf-8")
-			message_response.add_message(sender_bytes, message_bytes)
+			message_bytes = items[i][2]
+			if isinstance(message_bytes, SpoolPayload):
+				message_bytes = message_bytes.read()
+			message_response.add_message(encode_sender(encoded, items[i][1]), message_bytes)
 		return message_response
 	
 	except UnicodeEncodeError:
-		print("ERROR - could not encode message")
-		c.close()
-		exit()
+		raise ValueError("could not encode message")
 
-def create_response_message(sen_name, s, c):
+def create_response_message(sen_name, server, c):
 	"""Creates a message response to a 'read' request
+
+	The messages are left in the mail store, they are removed by sequence number
+	once the response has been sent.
 	
 	Args: 
 		sen_name (str): The name of the client who sent the 'read' request
-		s (socket): The server socket
+		server (Server): The server the request was made to
 		c (socket): The connection socket
 	
 	Returns:
 		num_items (int): The number of messsages included in the message_response
 		message_response (bytearray): The bytearray containing the message response
+		seqs (list): The sequence numbers of the messages in the response
 	"""
 
 	num_items = 0
 	more_msgs = 0
 	message_response = bytearray()
+	seqs = []
 
-	# generates the packet header and adds the saved messages to the packet
-	if sen_name in messages.keys():
-		items = messages[sen_name]
+	# messages an acknowledged read has sent are left to it, and the page is claimed so
+	# no other read sends it while it is being sent, release_claim() hands it back
+	delivery = lock_delivery(server, sen_name)
+	try:
+		in_flight = delivery.in_flight()
+		# one more than a page is peeked at to find out if there are more messages
+		items = server.mail_store.peek(sen_name, 256 + len(in_flight))
+		items = [item for item in items if item[0] not in in_flight]
 
 		# the number of messages stored for the Client
-		num_items = len(messages[sen_name]) 
+		num_items = len(items)
 
-		# sets a message send limit of 255 
+		# sets a message send limit of 255
 		# If there are more than 255 messages for the client then 255 are sent with
 		# a flag set indicating there are more messages available
 		if num_items > 255:
 			more_msgs = 1
 			num_items = 255
-		elif num_items == 0:
-			more_msgs = 0
-			num_items = 0 
 
-		message_response = MessageResponse(num_items, more_msgs)    
-		message_response = add_messages(message_response, items, num_items, s, c)    
+		# v1 frames have a 16 bit message length so the page stops before any message
+		# too large for them, those can only be collected with a v2 read
+		for i in range(num_items):
+			if len(items[i][2]) > 0xFFFF:
+				more_msgs = 1
+				num_items = i
+				break
+
+		seqs = [item[0] for item in items[:num_items]]
+		delivery.claimed.update(seqs)
+		retire_delivery(server, sen_name, delivery)
+	finally:
+		delivery.lock.release()
 
-	# generates a packet header indicating there no messages stored for the client           
-	else:
-		message_response = MessageResponse(num_items, more_msgs)   
-	return num_items, message_response
+	# generates the packet header and adds the saved messages to the packet, or a packet
+	# header indicating there no messages stored for the client
+	try:
+		message_response = MessageResponse(num_items, more_msgs)
+		message_response = add_messages(message_response, items, num_items, server, c)
+	except Exception:
+		release_claim(server, sen_name, seqs)
+		raise
+	return num_items, message_response, seqs
 
-def read_request(name_len, req_array, s, c):
+def read_request(name_len, req_array, server, c):
 	"""Gathers the necessary data to handle a clients 'read' request
 	
 	Args:
 		name_len (int): The number of bytes the clients name takes up in the message request bytearray
 		req_array (bytearray): The bytearray containing the clients 'read' request
-		s (socket): The server socket
+		server (Server): The server the request was made to
 		c (socket): The connection socket
 
 	Returns:
 		sen_name (str): The name of the client
 		num_items (int): The number of messages included in the message response
 		message_response (bytearray): The bytearray containing the message response
+		seqs (list): The sequence numbers of the messages in the response
 	"""
 
-	sen_name = get_name(req_array, 0, name_len, s, c)
-	num_items, message_response = create_response_message(sen_name, s, c)   
-	return sen_name, num_items, message_response
+	sen_name = get_name(req_array, 0, name_len, server, c)
+	num_items, message_response, seqs = create_response_message(sen_name, server, c)   
+	return sen_name, num_items, message_response, seqs
 
-def get_name(req_array, range_val_one, range_val_two, s, c):
+def get_name(req_array, range_val_one, range_val_two, server, c):
 	"""Get a name from a message request array
 
 	Uses a 'loop in range' to extract the relevant data to decode the name
@@ -137,7 +465,7 @@ def get_name(req_array, range_val_one, range_val_two, s, c):
 		req_array (bytearray): The bytearray containing the clients 'read' request
 		range_val_one (int): The lower bound for the range loop
 		range_val_two (int): The upper bound for the range loop
-		s (socket): The server socket
+		server (Server): The server the request was made to
 		c (socket): The connection socket
 
 	Returns:
@@ -154,9 +482,7 @@ def get_name(req_array, range_val_one, range_val_two, s, c):
 		return name
 	
 	except UnicodeDecodeError:
-		print("ERROR - could not decode")
-		c.close()
-		exit()
+		raise ValueError("could not decode")
 
 def get_message(req_array, range_val_one, range_val_two):
 	"""Gets the message from a clients 'create' request
@@ -176,14 +502,14 @@ def get_message(req_array, range_val_one, range_val_two):
 		message.append(req_array[i])
 	return bytearray(message)        
         
-def create_request(req_array, name_len, receiver_len,s,c):
+def create_request(req_array, name_len, receiver_len, server, c):
 	"""Handles a clients 'create' request 
 	
 	Args:
 		req_array (bytearray): The bytearray containing the clients 'create' request
 		name_len (int): The number of bytes the clients name takes up in the message request bytearray
 		receiver_len (int): The number of bytes the recievers name take up in the message request bytearray
-		s (socket): The server socket
+		server (Server): The server the request was made to
 		c (socket): The connection socket
 
 	Returns: 
@@ -191,45 +517,63 @@ def create_request(req_array, name_len, receiver_len,s,c):
 		rec_name (str): The name of the reciever
 	"""
 	
-	rec_name = get_name(req_array, name_len, receiver_len+name_len,s,c)
-	send_name = get_name(req_array, 0, name_len,s,c)
+	rec_name = get_name(req_array, name_len, receiver_len+name_len, server, c)
+	send_name = get_name(req_array, 0, name_len, server, c)
 	dec_mes = get_message(req_array, name_len + receiver_len, len(req_array))
 
-	# stores the recieved message under the intended recievers name
-	if rec_name not in messages.keys():
-		# creates array if there are no messages stored for the receiver
-		messages[rec_name] = [(send_name,dec_mes)]
-	else:
-		# if there are already messages for the reciever then new message is added to the array
-		messages[rec_name].append((send_name,dec_mes))    
+	store_message(send_name, rec_name, dec_mes, server)
 	return send_name, rec_name
+
+def store_message(send_name, rec_name, message, server, ttl=None):
+	"""Stores a message under the intended recievers name
+
+	Raises MailboxFull if the server's limits refuse the message, a spooled
+	message's file is then left to the caller.
+
+	Args:
+		send_name (str): The name of the client who sent the message
+		rec_name (str): The name of the reciever
+		message (bytearray or SpoolPayload): The message data
+		server (Server): The server the message was sent to
+		ttl (int): The seconds the sender asked for the message to be kept, None for the default
+
+	Returns:
+		status (int): STATUS_OK, or STATUS_DROPPED_OLDEST if older messages made room for it
+	"""
+
+	seq, dropped = server.limits.append_limited(rec_name, send_name, message, ttl)
+	if dropped > 0:
+		server.log("dropped the " + str(dropped) + " oldest messages for " + rec_name + " to make room")
+		return STATUS_DROPPED_OLDEST
+	return STATUS_OK
  
-def registration(req_array, name_len, e_len, s, c):
+def registration(req_array, name_len, e_len, binary, server, c):
 	""" register the public key of a client with the server
 
 		Args:
 			req_array (bytearray): The bytearray containing the clients 'keys' request
 			name_len (int): The length of the name field
 			e_len (int): The length of the e field
-			s (socket): The server socket
-            c (socket): The connection socket
+			binary (bool): True if e and n are big-endian integers rather than decimal text
+			server (Server): The server the request was made to
+			c (socket): The connection socket
 		Returns:
 			name (string): the name of the client
 	"""
-	e = get_name(req_array, name_len, e_len + name_len,s,c)
-	name = get_name(req_array, 0, name_len,s,c)
-	n = get_message(req_array, name_len + e_len, len(req_array))
-
-	# stores the recieved message under the intended recievers name
-	if name not in public_keys.keys():
-		# creates array if there are no messages stored for the receiver
-		public_keys[name] = (n, e)
-	else:
-		# if there are already messages for the reciever then new message is added to the array
-		public_keys[name] = (n, e)  
+	name = get_name(req_array, 0, name_len, server, c)
+	try:
+		e = decode_key_int(req_array[name_len:name_len + e_len], binary)
+		n = decode_key_int(req_array[name_len + e_len:], binary)
+	except UnicodeDecodeError:
+		raise ValueError("public key is not valid decimal text")
+	if n.bit_length() > MAX_KEY_BITS or e.bit_length() > MAX_KEY_BITS:
+		raise ValueError("public key is larger than " + str(MAX_KEY_BITS) + " bits")
+
+	# stores the public key under the clients name, replacing any older key
+	server.key_store.put(name, n, e)
 	return name, e
 
-def add_keys(message_response, items, num_items, s, c):
+def add_keys(message_response, items, num_items, server, c):
 	"""Adds messages to the message response bytearray
 
 	Iterates through the messages stored for the client in range of the number of items
@@ -239,7 +583,7 @@ def add_keys(message_response, items, num_items, s, c):
 		message_response (bytearray): The bytearray containing the message response header
 		items (list): The list of messages addressed to the client
 		num_items (int): The number of messages able to be added to the bytearray
-		s (socket): The server socket
+		server (Server): The server the request was made to
 		c (socket): The connection socket
 
 	Returns:
@@ -248,22 +592,21 @@ def add_keys(message_response, items, num_items, s, c):
 	"""
 
 	try:
-		for item in items:
+		for item in items[:num_items]:
 			name= item[0].encode("utf-8")
-			message_response.add_message(name, item[1], item[2].encode("utf-8"))
+			message_response.add_key(name, item[1], item[2])
 		return message_response
 	
 	except UnicodeEncodeError:
-		print("ERROR - could not encode message")
-		c.close()
-		exit()
+		raise ValueError("could not encode message")
 
-def create_keyreq_message(sen,s, c):
+def create_keyreq_message(sen, binary, server, c):
 	"""Creates a message response to a key request
 	
 	Args: 
 		sen_name (str): The name of the client who sent the 'read' request
-		s (socket): The server socket
+		binary (bool): True to encode the keys as big-endian integers rather than decimal text
+		server (Server): The server the request was made to
 		c (socket): The connection socket
 	
 	Returns:
@@ -273,12 +616,10 @@ def create_keyreq_message(sen,s, c):
 
 	num_items = 0
 	more_msgs = 0
-	items = []
 	message_response = bytearray()
 
 	# generates the packet header and adds the saved messages to the packet
-	for name in public_keys.keys():
-		items.append((name, public_keys[name][0], public_keys[name][1]))
+	items = server.key_store.items()
 	
 	# the number of keys
 	num_items = len(items) 
@@ -293,18 +634,19 @@ def create_keyreq_message(sen,s, c):
 		more_msgs = 0
 		num_items = 0 
 
-	message_response = MessageKeys(num_items, more_msgs)    
-	message_response = add_keys(message_response, items, num_items, s, c)    
+	message_response = MessageKeys(num_items, more_msgs, binary)    
+	message_response = add_keys(message_response, items, num_items, server, c)    
 
 	return num_items, message_response
 
-def key_request(name_len, req_array, s, c):
+def key_request(name_len, req_array, binary, server, c):
 	"""Gathers the necessary data to handle a clients key request
 	
 	Args:
 		name_len (int): The number of bytes the clients name takes up in the message request bytearray
 		req_array (bytearray): The bytearray containing the clients 'read' request
-		s (socket): The server socket
+		binary (bool): True if the client asked for the compact key encoding
+		server (Server): The server the request was made to
 		c (socket): The connection socket
 
 	Returns:
@@ -313,28 +655,653 @@ def key_request(name_len, req_array, s, c):
 		message_response (bytearray): The bytearray containing the message response
 	"""
 
-	sen_name = get_name(req_array, 0, name_len, s, c)
-	num_items, message_response = create_keyreq_message(sen_name, s, c)   
+	sen_name = get_name(req_array, 0, name_len, server, c)
+	num_items, message_response = create_keyreq_message(sen_name, binary, server, c)   
 	return sen_name, num_items, message_response
 
-def server_loop(s):
-	"""listens and recieves message request froma client
+def send_read_response_v2(c, items, num_items, more_msgs, cursor=None):
+	"""Sends a v2 read response, streaming large messages rather than copying them
+
+	Small messages are gathered into one buffer, a message of CHUNK_SIZE or more is
+	sent straight from where it is stored after flushing whatever has been gathered.
+
+	Args:
+		c (socket): The connection socket
+		items (list): The (seq, sender, message) tuples addressed to the client
+		num_items (int): The number of messages to send
+		more_msgs (int): 1 if more messages are stored than are being sent
+		cursor (int): The cursor acknowledging the page, None if the messages are removed once sent
+	"""
+
+	message_response = MessageResponseV2(3, num_items, more_msgs, cursor)
+	encoded = dict()
+	for i in range(num_items):
+		sender_bytes = encode_sender(encoded, items[i][1])
+		message = items[i][2]
+		if len(message) < CHUNK_SIZE and not isinstance(message, SpoolPayload):
+			message_response.add_message(sender_bytes, message)
+			continue
+		message_response.add_item_header(sender_bytes, len(message))
+		c.sendall(message_response.content)
+		message_response.content = bytearray()
+		if isinstance(message, SpoolPayload):
+			message.send(c)
+			continue
+		view = memoryview(message)
+		for index in range(0, len(message), CHUNK_SIZE):
+			c.sendall(view[index:index + CHUNK_SIZE])
+	c.sendall(message_response.content)
+
+def read_request_v2(server, c, sen_name, body, from_name=None):
+	"""Handles a v2 'read' request, sending up to a page of messages and removing them once sent
+
+	Another connection may read from the same mailbox while the page is being sent,
+	so the messages are removed by sequence number rather than by position.
+
+	Args:
+		server (Server): The server the request was made to
+		c (socket): The connection socket
+		sen_name (str): The name of the client
+		body (bytearray): The request body, empty or a 4 byte maximum page size
+		from_name (str): Only messages from this sender are sent if given, the others stay queued
+
+	Returns:
+		num_items (int): The number of messages sent
+	"""
+
+	page_size = PAGE_SIZE_V2
+	if len(body) == 4:
+		page_size = min(int.from_bytes(body, "big"), PAGE_SIZE_V2)
+	elif len(body) != 0:
+		raise ValueError("read request body must be empty or a 4 byte page size")
+
+	# messages an acknowledged read has sent are left to it, and the page is claimed
+	# so no other read sends it while it is being sent
+	delivery = lock_delivery(server, sen_name)
+	try:
+		in_flight = delivery.in_flight()
+		# one more than a page is peeked at to find out if there are more messages
+		items = server.mail_store.peek(sen_name, page_size + 1 + len(in_flight), sender=from_name)
+		items = [item for item in items if item[0] not in in_flight]
+		more_msgs = 1 if len(items) > page_size else 0
+		items = items[:page_size]
+		seqs = [item[0] for item in items]
+		delivery.claimed.update(seqs)
+		retire_delivery(server, sen_name, delivery)
+	finally:
+		delivery.lock.release()
+
+	try:
+		server.deadlines.arm(c, PHASE_WRITE, sum(len(item[2]) for item in items))
+		send_read_response_v2(c, items, len(items), more_msgs)
+		if len(items) > 0:
+			server.mail_store.remove(sen_name, seqs)
+	finally:
+		release_claim(server, sen_name, seqs)
+	return len(items)
+
+def lock_delivery(server, sen_name):
+	"""Returns the Delivery of a mailbox with its lock held, creating it if there is none"""
+
+	while True:
+		with server.lock:
+			delivery = server.deliveries.get(sen_name)
+			if delivery is None:
+				delivery = server.deliveries[sen_name] = Delivery()
+		delivery.lock.acquire()
+		if not delivery.retired:
+			return delivery
+		# it was dropped while this thread waited for its lock
+		delivery.lock.release()
+
+def retire_delivery(server, sen_name, delivery):
+	"""Drops a Delivery once nothing sent from its mailbox is waiting to be removed, its lock must be held"""
+
+	if delivery.idle() and not delivery.retired:
+		delivery.retired = True
+		with server.lock:
+			del server.deliveries[sen_name]
+
+def release_claim(server, sen_name, seqs):
+	"""Hands back the seqs a plain read claimed, once it has removed them or failed to send them"""
+
+	# a delivery with claimed seqs is never retired, so this is the one they were claimed in
+	delivery = lock_delivery(server, sen_name)
+	try:
+		delivery.claimed.difference_update(seqs)
+		retire_delivery(server, sen_name, delivery)
+	finally:
+		delivery.lock.release()
+
+def read_request_acked(server, c, sen_name, body):
+	"""Handles a v2 'read' with FLAG_ACK, the messages sent stay stored until acknowledged
+
+	The page starts after the pages already sent and not yet acknowledged, so a client
+	can have several pages in flight, and the reply carries the cursor that
+	acknowledges it. The acknowledgement comes in the body of a later read, a client
+	that never sends it gets the messages again after ACK_TIMEOUT. A read with no
+	cursor to acknowledge starts again from the oldest message, so a client retrying
+	a read whose reply it lost is sent the same messages rather than an empty page.
+
+	Args:
+		server (Server): The server the request was made to
+		c (socket): The connection socket
+		sen_name (str): The name of the client
+		body (bytearray): The READ_ACKED page size and cursor to acknowledge
+
+	Returns:
+		num_items (int): The number of messages sent
+	"""
+
+	if len(body) != READ_ACKED.size:
+		raise ValueError("acknowledged read body must be a page size and a cursor")
+	page_size, ack = READ_ACKED.unpack(body)
+	page_size = min(page_size, PAGE_SIZE_V2)
+
+	delivery = lock_delivery(server, sen_name)
+	try:
+		acked = delivery.acknowledge(ack)
+		if len(acked) > 0:
+			server.mail_store.remove(sen_name, acked)
+		now = time.monotonic()
+		if (ack == 0 or now - delivery.updated > ACK_TIMEOUT) and delivery.pages:
+			delivery.rewind()
+		delivery.updated = now
+
+		after = delivery.pages[-1][0] if delivery.pages else 0
+		# messages a plain read is sending are skipped, it removes them once sent
+		items = server.mail_store.peek(sen_name, page_size + 1 + len(delivery.claimed), after)
+		items = [item for item in items if item[0] not in delivery.claimed]
+		more_msgs = 1 if len(items) > page_size else 0
+		items = items[:page_size]
+		if len(items) > 0:
+			delivery.pages.append((items[-1][0], [item[0] for item in items]))
+		cursor = delivery.pages[-1][0] if delivery.pages else 0
+		# nothing is awaiting acknowledgement so the mailbox needs no delivery state
+		retire_delivery(server, sen_name, delivery)
+	finally:
+		delivery.lock.release()
+
+	server.deadlines.arm(c, PHASE_WRITE, sum(len(item[2]) for item in items))
+	send_read_response_v2(c, items, len(items), more_msgs, cursor)
+	return len(items)
+
+def key_request_v2(server, c):
+	"""Handles a v2 key request, sending every registered key in the compact encoding
+
+	Args:
+		server (Server): The server the request was made to
+		c (socket): The connection socket
+	"""
+
+	items = server.key_store.items()
+	message_response = MessageResponseV2(KEYS_BINARY_ID, len(items), 0)
+	for name, n, e in items:
+		message_response.add_key(name.encode("utf-8"), n, e)
+	server.deadlines.arm(c, PHASE_WRITE, len(message_response.content))
+	c.sendall(message_response.content)
+
+def depth_request_v2(server, c, body):
+	"""Handles a v2 depth request, sending how many messages and bytes wait for each name asked about
+
+	Nothing is read or removed. The answers come from counters the stores keep up to
+	date as messages are created and read, so asking about many names costs a lookup each.
+
+	Args:
+		server (Server): The server the request was made to
+		c (socket): The connection socket
+		body (bytearray): The names, each a byte of length and then the name
+
+	Returns:
+		num_items (int): The number of names answered
+	"""
+
+	names = []
+	index = 0
+	while index < len(body):
+		end = index + 1 + body[index]
+		if body[index] == 0 or end > len(body):
+			raise ValueError("depth request names are malformed")
+		names.append(body[index + 1:end].decode("utf-8"))
+		index = end
+	if len(names) > DEPTH_MAX_NAMES:
+		raise ValueError("a depth request can ask about at most " + str(DEPTH_MAX_NAMES) + " names")
+
+	depths = server.mail_store.depths(names)
+	message_response = MessageResponseV2(DEPTH_ID, len(depths), 0)
+	message_response.add_depths(depths)
+	server.deadlines.arm(c, PHASE_WRITE, len(message_response.content))
+	c.sendall(message_response.content)
+	return len(depths)
+
+def recv_body(server, c, size):
+	"""Recieves a body held in memory, a piece at a time
+
+	The body deadline is given the time for each piece just before it is recieved,
+	so a client is only given time for bytes it goes on to send rather than for the
+	length it declared.
+
+	Args:
+		server (Server): The server the body is sent to
+		c (socket): The connection socket
+		size (int): The body length
+
+	Returns:
+		body (bytearray): The body
+	"""
+
+	body = bytearray()
+	while len(body) < size:
+		piece = min(size - len(body), CHUNK_SIZE)
+		server.deadlines.extend(c, piece)
+		body += recv_exact(c, piece)
+	return body
+
+def recv_body_to_file(server, c, fileobj, size):
+	"""Copies a body into a file a piece at a time, extending the body deadline as recv_body does
+
+	Args:
+		server (Server): The server the body is sent to
+		c (socket): The connection socket
+		fileobj (file): The file to write to opened in binary mode, or None to discard the bytes
+		size (int): The body length
+	"""
+
+	while size > 0:
+		piece = min(size, CHUNK_SIZE)
+		server.deadlines.extend(c, piece)
+		recv_to_file(c, fileobj, piece)
+		size -= piece
+
+def spool_message(server, c, message_len, chunked):
+	"""Recieves a message body into a new spool file instead of memory
+
+	Args:
+		server (Server): The server the message was sent to
+		c (socket): The connection socket
+		message_len (int): The body length from the header, 0 if a chunked body's length is unknown
+		chunked (bool): True if the body is sent as length prefixed chunks
+
+	Returns:
+		(SpoolPayload): The spooled message
+	"""
+
+	fd, path = tempfile.mkstemp(dir=server.spool_dir, suffix=".msg")
+	length = 0
+	try:
+		with os.fdopen(fd, 'wb') as spool_file:
+			if not chunked:
+				recv_body_to_file(server, c, spool_file, message_len)
+				length = message_len
+			while chunked:
+				chunk_len = CHUNK_HEADER.unpack(recv_exact(c, CHUNK_HEADER.size))[0]
+				if chunk_len == 0:
+					break
+				if message_len != 0 and length + chunk_len > message_len:
+					raise ValueError("chunks are longer than the message length")
+				recv_body_to_file(server, c, spool_file, chunk_len)
+				length += chunk_len
+		if message_len != 0 and length != message_len:
+			raise ValueError("chunks are shorter than the message length")
+	except (OSError, ValueError):
+		os.remove(path)
+		raise
+	return SpoolPayload(path, length)
+
+def expire_uploads(server):
+	"""Discards upload sessions that have not been written to for UPLOAD_IDLE_TIMEOUT seconds
+
+	Args:
+		server (Server): The server holding the upload sessions, its lock must be held
+	"""
+
+	now = time.monotonic()
+	for token, session in list(server.uploads.items()):
+		if now - session.last_used > UPLOAD_IDLE_TIMEOUT:
+			del server.uploads[token]
+			SpoolPayload(session.path, session.offset).discard()
+
+def upload_request(server, c, r_id, sen_name, rec_name, message_len):
+	"""Handles the requests of a resumable upload
+
+	An upload is opened with a client chosen token, then its chunks are written to
+	a spool file at the offset they name. Only a chunk starting at the committed offset
+	is accepted, so after a reconnect the client queries the offset and carries on
+	from there. Once the whole message is written it is stored for the reciever.
+
+	Args:
+		server (Server): The server the upload is sent to
+		c (socket): The connection socket
+		r_id (int): UPLOAD_OPEN_ID, UPLOAD_CHUNK_ID or UPLOAD_QUERY_ID
+		sen_name (str): The name of the client
+		rec_name (str): The name of the reciever, only given when opening an upload
+		message_len (int): The length of the request body
+
+	Returns:
+		(MessageUploadState): The state of the upload to send back
+	"""
+
+	if r_id == UPLOAD_OPEN_ID:
+		if message_len != UPLOAD_OPEN.size or rec_name is None:
+			raise ValueError("upload open request is malformed")
+		token, length = UPLOAD_OPEN.unpack(recv_exact(c, UPLOAD_OPEN.size))
+		if length < 1:
+			raise ValueError("message length incorrect")
+		with server.lock:
+			expire_uploads(server)
+			# a token is only resumed by the upload that opened it, anyone else is told it is unknown
+			if token in server.completed_uploads:
+				if server.completed_uploads[token] != (sen_name, rec_name, length):
+					return MessageUploadState(STATUS_UNKNOWN_UPLOAD, 0, False)
+				return MessageUploadState(STATUS_OK, length, True)
+			if token not in server.uploads:
+				path = os.path.join(server.spool_dir, token.hex() + ".part")
+				open(path, 'wb').close()
+				server.uploads[token] = UploadSession(sen_name, rec_name, length, path)
+			session = server.uploads[token]
+			if (session.sender, session.receiver, session.length) != (sen_name, rec_name, length):
+				return MessageUploadState(STATUS_UNKNOWN_UPLOAD, 0, False)
+			return MessageUploadState(STATUS_OK, session.offset, False)
+
+	if r_id == UPLOAD_QUERY_ID:
+		if message_len != UPLOAD_QUERY.size:
+			raise ValueError("upload query request is malformed")
+		token = UPLOAD_QUERY.unpack(recv_exact(c, UPLOAD_QUERY.size))[0]
+		with server.lock:
+			if token in server.completed_uploads and server.completed_uploads[token][0] == sen_name:
+				return MessageUploadState(STATUS_OK, server.completed_uploads[token][2], True)
+			if token not in server.uploads or server.uploads[token].sender != sen_name:
+				return MessageUploadState(STATUS_UNKNOWN_UPLOAD, 0, False)
+			return MessageUploadState(STATUS_OK, server.uploads[token].offset, False)
+
+	# otherwise it's a chunk
+	if message_len < UPLOAD_CHUNK.size:
+		raise ValueError("upload chunk request is malformed")
+	token, offset = UPLOAD_CHUNK.unpack(recv_exact(c, UPLOAD_CHUNK.size))
+	data_len = message_len - UPLOAD_CHUNK.size
+	claimed = False
+	with server.lock:
+		session = server.uploads.get(token)
+		if session is None or session.sender != sen_name:
+			session = None
+		elif offset == session.offset and offset + data_len <= session.length and not session.writing:
+			session.writing = True
+			claimed = True
+	if session is None:
+		recv_body_to_file(server, c, None, data_len)
+		return MessageUploadState(STATUS_UNKNOWN_UPLOAD, 0, False)
+	if not claimed:
+		recv_body_to_file(server, c, None, data_len)
+		return MessageUploadState(STATUS_BAD_OFFSET, session.offset, False)
+
+	# only the connection that claimed the session writes to its spool file
+	try:
+		with open(session.path, 'r+b') as spool_file:
+			spool_file.seek(offset)
+			recv_body_to_file(server, c, spool_file, data_len)
+		session.offset += data_len
+		session.last_used = time.monotonic()
+	finally:
+		session.writing = False
+
+	if session.offset < session.length:
+		return MessageUploadState(STATUS_OK, session.offset, False)
+
+	# the upload is complete, the spool file becomes the stored message
+	try:
+		status = store_message(session.sender, session.receiver, SpoolPayload(session.path, session.length), server)
+	except MailboxFull:
+		with server.lock:
+			del server.uploads[token]
+		SpoolPayload(session.path, session.length).discard()
+		return MessageUploadState(STATUS_MAILBOX_FULL, session.offset, False)
+	with server.lock:
+		del server.uploads[token]
+		server.completed_uploads[token] = (session.sender, session.receiver, session.length)
+		if len(server.completed_uploads) > COMPLETED_UPLOADS:
+			server.completed_uploads.popitem(last=False)
+	server.log(session.sender + " has uploaded a " + str(session.length) + " byte message for " + session.receiver)
+	return MessageUploadState(status, session.offset, True)
+
+def handle_request_v2(header, server, c):
+	"""Handles a request sent with the v2 frame
+
+	The v2 header has 16 bit name lengths, a 32 bit message length and a flags byte,
+	with FLAG_CHUNKED set a 'create' body arrives as length prefixed chunks that are
+	recieved straight into the stored message.
+
+	Args:
+		header (bytearray): The HEADER_V2 bytes of the request
+		server (Server): The server the request was made to
+		c (socket): The connection socket
+
+	Returns:
+		keep_alive (bool): True if the client set FLAG_KEEP_ALIVE and will send another request
+	"""
+
+	magic_no, r_id, flags, name_len, receiver_len, message_len = HEADER_V2.unpack(header)
+
+	# checks the validity of the recieved data
+	if r_id not in (1, 2, KEYS_BINARY_ID, REGISTER_BINARY_ID, UPLOAD_OPEN_ID, UPLOAD_CHUNK_ID, UPLOAD_QUERY_ID, DEPTH_ID):
+		raise ValueError("ID incorrect")
+	if name_len < 1:
+		raise ValueError("Name length less than 1")
+	if r_id in (2, UPLOAD_OPEN_ID) and receiver_len < 1:
+		raise ValueError("reciever length incorrect")
+	if flags & FLAG_CHUNKED and r_id != 2:
+		raise ValueError("only 'create' requests can be chunked")
+	if flags & FLAG_TTL and r_id != 2:
+		raise ValueError("only 'create' requests can have a TTL")
+	if flags & FLAG_ACK and r_id != 1:
+		raise ValueError("only 'read' requests can be acknowledged")
+	if flags & FLAG_ACK and receiver_len != 0:
+		raise ValueError("acknowledged reads can't select a sender")
+	if r_id == DEPTH_ID and message_len > DEPTH_MAX_NAMES * 256:
+		raise ValueError("depth request is too long")
+	# create bodies from SPOOL_THRESHOLD up are spooled and upload chunks are written
+	# to their file, every other body is held in memory so its length is capped
+	if r_id in (1, KEYS_BINARY_ID, REGISTER_BINARY_ID) and message_len > MAX_REQUEST_BODY:
+		raise ValueError("request body is too long")
+
+	# the names get time in proportion to their length, the body is given time for each
+	# piece as it arrives rather than for the length declared, see recv_body. The serving
+	# of the request and any small reply come under the same deadline
+	server.deadlines.arm(c, PHASE_BODY, name_len + receiver_len)
+
+	# a follower only serves keys and depths, the body is left unread so the connection is closed
+	if server.read_only and r_id not in (KEYS_BINARY_ID, DEPTH_ID):
+		c.sendall(MessageStatus(STATUS_READ_ONLY).content)
+		return False
+
+	req_array = recv_exact(c, name_len + receiver_len)
+	sen_name = get_name(req_array, 0, name_len, server, c)
+
+	if server.admission is None:
+		return serve_request_v2(server, c, r_id, flags, name_len, receiver_len, message_len, req_array, sen_name)
+	# a request over the admission limits is answered at once and its connection closed
+	refused = server.admission.admit(sen_name, peer_ip(c))
+	if refused is not None:
+		# a small body is recieved and dropped, closing with it unread would reset the
+		# connection and could lose the retry later frame before the client reads it
+		body_len = message_len + (TTL.size if flags & FLAG_TTL else 0)
+		if not flags & FLAG_CHUNKED and body_len < SPOOL_THRESHOLD:
+			recv_body(server, c, body_len)
+		refuse_request(server, c, sen_name, refused)
+		return False
+	try:
+		return serve_request_v2(server, c, r_id, flags, name_len, receiver_len, message_len, req_array, sen_name)
+	finally:
+		server.admission.release()
+
+def serve_request_v2(server, c, r_id, flags, name_len, receiver_len, message_len, req_array, sen_name):
+	"""Serves an admitted v2 request, its header and names have been recieved
+
+	Args:
+		server (Server): The server the request was made to
+		c (socket): The connection socket
+		r_id (int): The request ID
+		flags (int): The request flags
+		name_len (int): The length of the clients name
+		receiver_len (int): The length of the recievers name, or the e field of a registration
+		message_len (int): The length of the body still to be recieved
+		req_array (bytearray): The names
+		sen_name (str): The name of the client
+
+	Returns:
+		keep_alive (bool): True if the client set FLAG_KEEP_ALIVE and will send another request
+	"""
+
+	keep_alive = bool(flags & FLAG_KEEP_ALIVE)
+
+	# if it's a create request
+	if r_id == 2:
+		rec_name = get_name(req_array, name_len, name_len + receiver_len, server, c)
+		ttl = None
+		if flags & FLAG_TTL:
+			ttl = TTL.unpack(recv_exact(c, TTL.size))[0]
+		# large or unknown length bodies go to disk so server memory stays bounded
+		if message_len >= SPOOL_THRESHOLD or (message_len == 0 and flags & FLAG_CHUNKED):
+			message = spool_message(server, c, message_len, flags & FLAG_CHUNKED)
+		elif flags & FLAG_CHUNKED:
+			message = recv_chunked(c, message_len, lambda size: server.deadlines.extend(c, size))
+		else:
+			message = recv_body(server, c, message_len)
+		if len(message) < 1:
+			raise ValueError("message length incorrect")
+		try:
+			status = store_message(sen_name, rec_name, message, server, ttl)
+		except MailboxFull as err:
+			if isinstance(message, SpoolPayload):
+				message.discard()
+			c.sendall(MessageStatus(STATUS_MAILBOX_FULL).content)
+			server.log("refused a message from " + sen_name + " - " + str(err))
+			return keep_alive
+		c.sendall(MessageStatus(status).content)
+		server.log(sen_name + " has created a " + str(len(message)) + " byte message for " + rec_name)
+		return keep_alive
+
+	# if it's part of a resumable upload
+	if r_id in (UPLOAD_OPEN_ID, UPLOAD_CHUNK_ID, UPLOAD_QUERY_ID):
+		rec_name = None
+		if r_id == UPLOAD_OPEN_ID:
+			rec_name = get_name(req_array, name_len, name_len + receiver_len, server, c)
+		c.sendall(upload_request(server, c, r_id, sen_name, rec_name, message_len).content)
+		return keep_alive
+
+	body = recv_body(server, c, message_len)
+
+	# if it's a read request
+	if r_id == 1:
+		if flags & FLAG_ACK:
+			num_items = read_request_acked(server, c, sen_name, body)
+		else:
+			# a reciever name on a 'read' selects the messages from that sender
+			from_name = None
+			if receiver_len > 0:
+				from_name = get_name(req_array, name_len, name_len + receiver_len, server, c)
+			num_items = read_request_v2(server, c, sen_name, body, from_name)
+		server.log("sent " + str(num_items) + " messages to " + sen_name)
+		return keep_alive
+
+	# if registration
+	if r_id == REGISTER_BINARY_ID:
+		req_array += body
+		registration(req_array, name_len, receiver_len, True, server, c)
+		c.sendall(MessageStatus(STATUS_OK).content)
+		server.log(sen_name + " has registered public key! ")
+		return keep_alive
+
+	# if key request
+	if r_id == KEYS_BINARY_ID:
+		key_request_v2(server, c)
+		return keep_alive
+
+	# if it's a depth request
+	if r_id == DEPTH_ID:
+		num_items = depth_request_v2(server, c, body)
+		server.log("sent the depths of " + str(num_items) + " mailboxes to " + sen_name)
+		return keep_alive
+
+def peer_ip(c):
+	"""Returns the IP address a connection comes from, None for a Unix socket"""
+
+	try:
+		peer = c.getpeername()
+	except OSError:
+		return None
+	return peer[0] if isinstance(peer, tuple) else None
+
+def refuse_request(server, c, sen_name, refused):
+	"""Tells a client over the admission limits to retry later, v1 clients just see the connection close
+
+	Args:
+		server (Server): The server the request was made to
+		c (socket): The connection socket, or None for a v1 request
+		sen_name (str): The name of the client
+		refused (tuple): The reason and seconds to wait, from Admission.admit()
+	"""
+
+	reason, retry_after = refused
+	if c is not None:
+		c.sendall(MessageRetryLater(retry_after).content)
+	if server.admission.report_due():
+		server.log("refused a request from " + sen_name + " over the " + reason + " limit, refusals so far: " +
+			str(server.admission.metrics()["rejected"]))
+
+def server_loop(server, sock):
+	"""listens for a connection from a client and serves it on its own thread
+
+	A keep-alive connection can stay open between requests, so connections are served
+	on their own threads rather than one after another.
+
+	Args:
+		server (Server): The server accepting the connection
+		sock (socket): The listening socket, TCP or Unix domain
+	"""
+
+	try:
+		# accepts an incoming connection request
+		c, addr = sock.accept() 
+		server.log('Got connection from ' + str(addr or server.unix_path))
+	except OSError as err:
+		if not server.stopped:
+			print("ERROR -  " + str(err))
+		return None
+	threading.Thread(target=handle_connection, args=(server, c), daemon=True).start()
+
+def handle_connection(server, c):
+	"""recieves message requests from a client
 	
 	Decodes the message request header and handles 'read' and 'create' requests
 
 	Args:
-		s (socket): The server socket  
+		server (Server): The server the connection was made to
+		c (socket): The connection socket
 	"""
 
+	with server.lock:
+		server.connections.add(c)
+	admitted = False
 	try:
-		# accepts an incoming connection request
-		c, addr = s.accept() 
-		# set the timeout length for the connection socket 
-		c.settimeout(1)
-		print ('Got connection from', addr )
+		# the whole header must arrive before its deadline, however it is trickled
+		server.deadlines.arm(c, PHASE_HEADER)
 		
-		# recieve the first three bytes from the connection socket
-		req_array = c.recv(7)
+		# the first two bytes give the frame version
+		req_array = recv_exact(c, 2)
+		while (req_array[0]<<8 | req_array[1]) == MAGIC_V2:
+			if not handle_request_v2(req_array + recv_exact(c, HEADER_V2.size - 2), server, c):
+				return None
+			# waits for the next request on a keep-alive connection, a close
+			# between requests is not an error
+			server.deadlines.arm(c, PHASE_IDLE)
+			req_array = bytearray(c.recv(1))
+			if len(req_array) == 0:
+				return None
+			server.deadlines.arm(c, PHASE_HEADER)
+			req_array += recv_exact(c, 1)
+
+		# recieve the rest of the v1 header from the connection socket
+		req_array += recv_exact(c, 5)
 		
 		# uses bitwise operations on the byte data to extract the "magic" number and request ID
 		magic_no = req_array[0]<<8 | req_array[1]
@@ -344,9 +1311,9 @@ def server_loop(s):
 		message_len = req_array[5]<<8 | req_array[6]
 
 		# checks the validity of the recieved data
-		if magic_no != 0xAE73:
+		if magic_no != MAGIC_V1:
 			raise ValueError("magic number incorrect")
-		if r_id != 1 and r_id != 2 and r_id != 4 and r_id != 6:
+		if r_id not in (1, 2, 4, 6, KEYS_BINARY_ID, REGISTER_BINARY_ID):
 			raise ValueError("ID incorrect")
 		if name_len < 1:
 			raise ValueError("Name length less than 1")
@@ -354,113 +1321,178 @@ def server_loop(s):
 			raise ValueError("reciever length incorrect")
 		if (r_id == 1 and message_len != 0) or (r_id == 2 and message_len < 1):
 			raise ValueError("message length incorrect")  
+		if server.read_only and r_id not in (6, KEYS_BINARY_ID):
+			raise ValueError("this server is a replication follower and only answers key requests")
+
+		server.deadlines.arm(c, PHASE_BODY, name_len + receiver_len + message_len)
+		req_array = recv_exact(c, name_len + receiver_len + message_len)
 
-		req_array = c.recv(name_len + receiver_len + message_len)
+		if server.admission is not None:
+			sen_name = get_name(req_array, 0, name_len, server, c)
+			refused = server.admission.admit(sen_name, peer_ip(c))
+			if refused is not None:
+				refuse_request(server, None, sen_name, refused)
+				return None
+			admitted = True
 
 		# if it's a create request
 		if r_id == 2:
-			send_name, rec_name = create_request(req_array, name_len, receiver_len,s,c)
-			print(send_name + " has created a message for " + rec_name)
-			c.close()
+			send_name, rec_name = create_request(req_array, name_len, receiver_len, server, c)
+			server.log(send_name + " has created a message for " + rec_name)
 			return None
 		
 		# if it's a read request
 		if r_id == 1:
-			sen_name, num_items, message_response = read_request(name_len, req_array, s, c)
-			# if messages are sent info message is printed and the sent messages are removed form
-			# the message dictionary
-			if num_items > 0:
-				print("sent " + str(num_items) + " messages to " + sen_name)
-		
-				# iterates though the messages stored under the receivers name and deletes each
-				# message in the range of 0 - number of messages sent
-				for i in range(num_items):
-					messages[sen_name].pop(0) 
-			
-			# if no messages are sent
-			else:
-				print("no messages sent")      
-			# sends a message response via the connection socket
-			c.send(message_response.content)
-			# closes the connection socket
-			c.close()     
+			sen_name, num_items, message_response, seqs = read_request(name_len, req_array, server, c)
+			try:
+				# sends a message response via the connection socket
+				server.deadlines.arm(c, PHASE_WRITE, len(message_response.content))
+				c.sendall(message_response.content)
+
+				# if messages are sent info message is printed and the sent messages are removed form
+				# the mail store
+				if num_items > 0:
+					server.log("sent " + str(num_items) + " messages to " + sen_name)
+					server.mail_store.remove(sen_name, seqs)
+
+				# if no messages are sent
+				else:
+					server.log("no messages sent")
+			finally:
+				release_claim(server, sen_name, seqs)
 			return None   
 
-		#if registration
-		if r_id == 4:
-			send_name, rec_name = registration(req_array, name_len, receiver_len,s,c)
-			print(send_name + " has registered public key! ")
-			c.close()
+		#if registration, ID 8 carries the key as big-endian integers
+		if r_id == 4 or r_id == REGISTER_BINARY_ID:
+			send_name, rec_name = registration(req_array, name_len, receiver_len, r_id == REGISTER_BINARY_ID, server, c)
+			server.log(send_name + " has registered public key! ")
 			return None
 
-		#if key request
-		if r_id == 6:
-			sen_name, num_items, message_response = key_request(name_len, req_array, s, c)
+		#if key request, ID 7 asks for the keys as big-endian integers
+		if r_id == 6 or r_id == KEYS_BINARY_ID:
+			sen_name, num_items, message_response = key_request(name_len, req_array, r_id == KEYS_BINARY_ID, server, c)
 			# sends a message response via the connection socket
+			server.deadlines.arm(c, PHASE_WRITE, len(message_response.content))
 			c.send(message_response.content)
-			# closes the connection socket
-			c.close()     
 			return None 
 	
+	# a failed or malformed request only ends its own connection, an interrupted
+	# upload can then be resumed against the same server
 	except OSError as err:
-		print("ERROR -  " + str(err))
-		c.close()
-		exit()
-	except TimeoutError:
-		print("ERROR - timed out")
-		c.close()
-		exit()
+		missed = server.deadlines.clear(c)
+		if missed is not None:
+			print("ERROR - timed out, the " + missed + " deadline passed")
+		elif not server.stopped:
+			print("ERROR -  " + str(err))
+		return None
 	except ValueError as err:
 		print("ERROR -  " + str(err))
+		return None
+	finally:
+		if admitted:
+			server.admission.release()
+		server.deadlines.clear(c)
+		# closes the connection socket
+		with server.lock:
+			server.connections.discard(c)
 		c.close()
-		exit()
 
-def process_argv():
-	#gets the prt number from command lines arguments and check if its valid
+def port_number(text):
+	#checks the port number from the command line is valid
 	try:
-		port = int(sys.argv[1]) # 50000
-		if port < 1024 or port > 64000:
-			raise ValueError()
-		return port
-	except TypeError:
-		print("ERROR - Port must be a number")
-		exit()
-
+		port = int(text) # 50000
 	except ValueError:
-		print("ERROR - Port must be between 1024 and 64000 inclusive")
-		exit()
+		raise argparse.ArgumentTypeError("Port must be a number")
+	if port < 1024 or port > 64000:
+		raise argparse.ArgumentTypeError("Port must be between 1024 and 64000 inclusive")
+	return port
 
-	except IndexError:
-		print("ERROR - Server takes exactly one argument")
-		exit()
+def process_argv():
+	#gets the port number and storage options from the command line arguments
+	parser = argparse.ArgumentParser(description="Stores messages and public keys for the clients")
+	parser.add_argument("port", type=port_number, nargs="?", help="the TCP port to listen on")
+	parser.add_argument("--unix", metavar="PATH",
+		help="listen on this Unix domain socket path too, or only on it if no port is given")
+	parser.add_argument("--store", choices=STORE_TYPES, default='memory',
+		help="where messages and keys are kept (default: memory)")
+	parser.add_argument("--data-dir", help="the directory a 'sqlite' or 'log' store and its spool files are kept in")
+	parser.add_argument("--spill-after", type=float, metavar="SECONDS",
+		help="write 'memory' store mailboxes unused for this long to disk, under --data-dir if given")
+	parser.add_argument("--memory-limit", type=int, metavar="BYTES",
+		help="write the largest 'memory' store mailboxes to disk while they take more than this")
+	parser.add_argument("--ttl", type=float, help="seconds a message is kept before it expires unread")
+	parser.add_argument("--mailbox-bytes", type=int, help="the most message bytes stored for one reciever")
+	parser.add_argument("--total-bytes", type=int, help="the most message bytes stored altogether")
+	parser.add_argument("--overflow", choices=OVERFLOW_POLICIES, default=OVERFLOW_POLICIES[0],
+		help="what happens to a message over a byte cap (default: reject)")
+	parser.add_argument("--sender-rate", type=float, help="requests per second allowed for each sender name")
+	parser.add_argument("--sender-burst", type=float, help="requests a sender name may make at once")
+	parser.add_argument("--ip-rate", type=float, help="requests per second allowed from each source IP")
+	parser.add_argument("--ip-burst", type=float, help="requests a source IP may make at once")
+	parser.add_argument("--max-in-flight", type=int, help="the most requests served at once")
+	parser.add_argument("--queue", type=int, default=64,
+		help="the most requests waiting to be served, and the listen backlog (default: 64)")
+	parser.add_argument("--replicate", metavar="ADDRESS",
+		help="stream every change to followers connecting to this port, host:port or unix:/path")
+	parser.add_argument("--follow", metavar="ADDRESS",
+		help="be a hot standby of the primary replicating on this host:port or unix:/path")
+	parser.add_argument("--header-timeout", type=float, default=5,
+		help="seconds a client has to send a request header (default: 5)")
+	parser.add_argument("--body-timeout", type=float, default=10,
+		help="seconds a client has to send a request body, on top of the time --min-rate allows (default: 10)")
+	parser.add_argument("--idle-timeout", type=float, default=60,
+		help="seconds a keep-alive connection may wait for its next request (default: 60)")
+	parser.add_argument("--write-timeout", type=float, default=10,
+		help="seconds a client has to take a response, on top of the time --min-rate allows (default: 10)")
+	parser.add_argument("--min-rate", type=float, default=16 * 1024, metavar="BYTES",
+		help="the slowest bytes per second a body or response is given time for (default: 16384)")
+	args = parser.parse_args()
+	if args.port is None and args.unix is None:
+		parser.error("a port or --unix path is needed")
+	if args.store != 'memory' and (args.spill_after is not None or args.memory_limit is not None):
+		parser.error("--spill-after and --memory-limit are only for the 'memory' store")
+	if args.store != 'memory' and args.data_dir is None:
+		parser.error("--store " + args.store + " needs --data-dir")
+	try:
+		if args.replicate is not None:
+			args.replicate = parse_address(args.replicate)
+		if args.follow is not None:
+			args.follow = parse_address(args.follow, 'localhost')
+	except ValueError as err:
+		parser.error(str(err))
+	return args
 
 def main():
-
-	port = process_argv()
+	args = process_argv()
 
 	try:
-			
-		# server socket is created
-		s = socket(AF_INET, SOCK_STREAM)     
-		# socket is bound to a given port and an ip address "0.0.0.0" is used 
-		# to bind to all local interfaces    
-		s.bind(('0.0.0.0', port))        
-		print ("socket bound to %s" %(port))
-
-		#Listen for connection requests
-		s.listen()    
-		print ("socket is listening")    
+		mail_store, key_store = open_stores(args.store, args.data_dir, args.spill_after, args.memory_limit)
+		spool_dir = None
+		if args.data_dir is not None:
+			# spool files must outlive the process for a persistent store to refer to them
+			spool_dir = os.path.join(args.data_dir, "spool")
+		limits = None
+		if args.ttl is not None or args.mailbox_bytes is not None or args.total_bytes is not None:
+			limits = Limits(args.mailbox_bytes, args.total_bytes, args.overflow, args.ttl)
+		admission = None
+		if args.sender_rate is not None or args.ip_rate is not None or args.max_in_flight is not None:
+			admission = Admission(args.sender_rate, args.sender_burst, args.ip_rate, args.ip_burst,
+				args.max_in_flight, args.queue)
+		deadlines = Deadlines(args.header_timeout, args.body_timeout, args.idle_timeout, args.write_timeout,
+			args.min_rate)
+		server = Server(args.port, mail_store, key_store, spool_dir, replicate=args.replicate, follow=args.follow,
+			limits=limits, admission=admission, unix_path=args.unix, deadlines=deadlines)
+		server.listen()
 			
 	except OSError as err:
 		print("ERROR -  " + str(err))
-		s.close()
 		exit()
-	while True:
-		server_loop(s)
-
-main()
-
-    
-  
-
+	# a follower is promoted to primary with kill -USR1
+	signal.signal(signal.SIGUSR1, lambda signum, frame: threading.Thread(target=server.promote).start())
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		server.stop()
 
+if __name__ == "__main__":
+	main()
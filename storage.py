@@ -0,0 +1,1068 @@
+"""Storage backends for the server's mailboxes and public key directory
+
+The server's handlers only talk to a MailStore and a KeyStore, so where messages
+and keys are kept can be swapped without touching the protocol code:
+
+    MemoryMailStore / MemoryKeyStore    dicts, lost when the server stops
+    SQLiteMailStore / SQLiteKeyStore    a SQLite database file
+    LogMailStore / LogKeyStore          an append-only log file replayed on start
+
+Every message is given a sequence number when it is stored, reads peek at a
+mailbox and remove what was delivered by sequence number. Each store has its own
+lock so it can be shared by the server's connection threads.
+
+Name: Zya Gurau
+"""
+
+import bisect
+import mmap
+import os
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from itertools import dropwhile, islice
+
+class SpoolPayload:
+    """A stored message body that lives in a spool file rather than in memory
+
+    Stands in for the bytearray in a stored message, len() gives the message length
+    so page size checks work unchanged.
+    """
+
+    def __init__(self, path, length):
+        self.path = path
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def read(self):
+        with open(self.path, 'rb') as spool_file:
+            return spool_file.read()
+
+    def send(self, c):
+        with open(self.path, 'rb') as spool_file:
+            c.sendfile(spool_file)
+
+    def discard(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+class MailStore:
+    """The interface the server stores messages through
+
+    A message is a bytearray or a SpoolPayload, a spooled message's file is owned by
+    the store once appended and is deleted when the message is removed.
+    """
+
+    def append(self, recipient, sender, message, seq=None):
+        """Stores a message at the end of a mailbox
+
+        Args:
+            recipient (str): the name of the reciever
+            sender (str): the name of the client who sent the message
+            message (bytearray or SpoolPayload): the message
+            seq (int): the sequence number a replication primary gave the message,
+                the next unused one if not given
+
+        Returns:
+            seq (int): the sequence number given to the message
+        """
+        raise NotImplementedError
+
+    def peek(self, recipient, limit, after=0, sender=None):
+        """Gets the oldest messages in a mailbox without removing them
+
+        Args:
+            recipient (str): the name of the reciever
+            limit (int): the most messages to return
+            after (int): only messages with a greater sequence number are returned
+            sender (str): only messages from this client are returned if given, found
+                through an index so the other senders' messages are not looked at
+
+        Returns:
+            items (list): (seq, sender, message) tuples, oldest first
+        """
+        raise NotImplementedError
+
+    def remove(self, recipient, seqs):
+        """Removes delivered messages from a mailbox, seqs no longer stored are ignored
+
+        Args:
+            recipient (str): the name of the reciever
+            seqs (list): the sequence numbers of the messages to remove
+        """
+        raise NotImplementedError
+
+    def count(self, recipient):
+        """Returns the number of messages stored for a reciever"""
+        raise NotImplementedError
+
+    def depths(self, recipients):
+        """Gets how much is waiting in many mailboxes, from counters rather than the messages
+
+        Args:
+            recipients (list): the names of the recievers
+
+        Returns:
+            (list): a (message count, message bytes) pair for each reciever, in order
+        """
+        raise NotImplementedError
+
+    def snapshot(self):
+        """Returns every stored message as (seq, recipient, sender, message) tuples in seq order"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class KeyStore:
+    """The interface the server keeps registered public keys through"""
+
+    def put(self, name, n, e):
+        """Stores a client's public key, replacing any older key"""
+        raise NotImplementedError
+
+    def items(self):
+        """Returns every registered key as (name, n, e) tuples"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class Mailbox:
+    """A reciever's messages in seq order, with a secondary index of each sender's messages
+
+    Entries are tuples that start with the seq and the sender. Any message can be
+    removed in O(1), and a read of one sender's messages walks only those. nbytes is
+    the size of the messages, kept up to date by the store.
+    """
+
+    __slots__ = ("entries", "senders", "nbytes")
+
+    def __init__(self):
+        # seq -> entry, oldest first
+        self.entries = OrderedDict()
+        # sender -> OrderedDict of the seqs of that sender's messages, oldest first
+        self.senders = dict()
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries.values())
+
+    def append(self, entry):
+        self.entries[entry[0]] = entry
+        seqs = self.senders.get(entry[1])
+        if seqs is None:
+            seqs = self.senders[entry[1]] = OrderedDict()
+        seqs[entry[0]] = None
+
+    def pop(self, seq):
+        """Removes a message, returning its entry or None if it is not in the mailbox"""
+
+        entry = self.entries.pop(seq, None)
+        if entry is not None:
+            seqs = self.senders[entry[1]]
+            del seqs[seq]
+            if not seqs:
+                del self.senders[entry[1]]
+        return entry
+
+    def select(self, limit, after=0, sender=None):
+        """Returns up to limit entries with a seq greater than after, only sender's if given"""
+
+        if sender is None:
+            entries = self.entries.values()
+        else:
+            entries = map(self.entries.__getitem__, self.senders.get(sender, ()))
+        # seqs only grow within a mailbox, so skipping from the front finds the first one after
+        return list(islice(dropwhile(lambda entry: entry[0] <= after, entries), limit))
+
+# a compact mailbox is rewritten once it has more than this many removed rows or
+# arena bytes and they outnumber the live ones
+COMPACT_MIN_ROWS = 1024
+COMPACT_MIN_BYTES = 64 * 1024
+# bytes of columns and sender index per row of a compact mailbox
+COMPACT_ROW_BYTES = 44
+
+class CompactMailbox:
+    """A reciever's messages kept column-wise, with the bodies packed into one arena
+
+    Row i is the message seqs[i] from sender ID sender_ids[i], its body is lengths[i]
+    bytes of the arena from offsets[i] - base. Rows are in seq order so a seq is found
+    by bisecting, and a removed row is marked with a length of -1 until most of the
+    mailbox is removed rows and it is rewritten. Spooled messages stay on disk and are
+    kept in spooled by seq. by_sender holds each sender's seqs in order for filtered
+    reads, seqs of removed rows are skipped and dropped when the mailbox is rewritten.
+    """
+
+    __slots__ = ("seqs", "sender_ids", "offsets", "lengths", "arena", "base", "head", "live", "live_bytes",
+        "dead_bytes", "holes", "spooled", "by_sender", "touched")
+
+    def __init__(self):
+        self.seqs = array('q')
+        self.sender_ids = array('I')
+        self.offsets = array('Q')
+        self.lengths = array('q')
+        self.arena = bytearray()
+        # the offset of the start of the arena, so dropping its front leaves offsets as they are
+        self.base = 0
+        # every row before head has been removed
+        self.head = 0
+        self.live = 0
+        # the size of the live messages, spooled ones included
+        self.live_bytes = 0
+        self.dead_bytes = 0
+        # True once a row after head has been removed, the columns then can't simply be sliced
+        self.holes = False
+        self.spooled = dict()
+        self.by_sender = dict()
+        # when the mailbox was last used, for spilling cold mailboxes
+        self.touched = 0
+
+    def __len__(self):
+        return self.live
+
+    def nbytes(self):
+        """Returns roughly the memory the mailbox's columns, index and arena take"""
+
+        return len(self.arena) + COMPACT_ROW_BYTES * len(self.seqs)
+
+    def append(self, seq, sender_id, message):
+        self.seqs.append(seq)
+        self.sender_ids.append(sender_id)
+        self.offsets.append(self.base + len(self.arena))
+        if isinstance(message, SpoolPayload):
+            self.spooled[seq] = message
+        else:
+            self.arena += message
+        self.lengths.append(len(message))
+        self.live += 1
+        self.live_bytes += len(message)
+        seqs = self.by_sender.get(sender_id)
+        if seqs is None:
+            seqs = self.by_sender[sender_id] = array('q')
+        seqs.append(seq)
+
+    def find(self, seq):
+        """Returns the row of a stored message, -1 if it is not stored"""
+
+        row = bisect.bisect_left(self.seqs, seq, self.head)
+        if row < len(self.seqs) and self.seqs[row] == seq and self.lengths[row] >= 0:
+            return row
+        return -1
+
+    def message(self, row):
+        if self.spooled and self.seqs[row] in self.spooled:
+            return self.spooled[self.seqs[row]]
+        start = self.offsets[row] - self.base
+        return self.arena[start:start + self.lengths[row]]
+
+    def remove(self, seqs):
+        """Removes messages, seqs not stored are ignored
+
+        Returns:
+            (list): the SpoolPayloads of the spooled messages removed
+        """
+
+        spooled = []
+        seqs = sorted(seqs)
+        if not seqs:
+            return spooled
+        # delivered seqs are nearly always a run of rows, so the rows are walked
+        # alongside them rather than each one being bisected for
+        row = bisect.bisect_left(self.seqs, seqs[0], self.head)
+        end = len(self.seqs)
+        for seq in seqs:
+            while row < end and self.seqs[row] < seq:
+                row += 1
+            if row == end:
+                break
+            if self.seqs[row] != seq or self.lengths[row] < 0:
+                continue
+            if self.spooled and seq in self.spooled:
+                spooled.append(self.spooled.pop(seq))
+            else:
+                self.dead_bytes += self.lengths[row]
+            self.live_bytes -= self.lengths[row]
+            self.lengths[row] = -1
+            self.live -= 1
+            if row != self.head:
+                self.holes = True
+            while self.head < end and self.lengths[self.head] < 0:
+                self.head += 1
+        dead_rows = end - self.live
+        if (dead_rows > COMPACT_MIN_ROWS and dead_rows > self.live) or \
+                (self.dead_bytes > COMPACT_MIN_BYTES and self.dead_bytes * 2 > len(self.arena)):
+            self.compact()
+        return spooled
+
+    def compact(self):
+        """Rewrites the columns and arena with only the live rows"""
+
+        if not self.holes or self.live == 0:
+            # the removed rows are all at the front, so the live ones are sliced off as a block
+            head = self.head
+            first = self.seqs[head] if head < len(self.seqs) else None
+            start = self.offsets[head] if head < len(self.seqs) else self.base + len(self.arena)
+            self.seqs = self.seqs[head:]
+            self.sender_ids = self.sender_ids[head:]
+            self.offsets = self.offsets[head:]
+            self.lengths = self.lengths[head:]
+            self.arena = self.arena[start - self.base:]
+            self.base = start
+            for sender_id in list(self.by_sender):
+                seqs = self.by_sender[sender_id]
+                if first is None or seqs[-1] < first:
+                    del self.by_sender[sender_id]
+                else:
+                    del seqs[:bisect.bisect_left(seqs, first)]
+        else:
+            rows = [row for row in range(self.head, len(self.seqs)) if self.lengths[row] >= 0]
+            arena = bytearray()
+            offsets = array('Q')
+            view = memoryview(self.arena)
+            for row in rows:
+                offsets.append(len(arena))
+                if self.seqs[row] not in self.spooled:
+                    start = self.offsets[row] - self.base
+                    arena += view[start:start + self.lengths[row]]
+            view.release()
+            self.seqs = array('q', [self.seqs[row] for row in rows])
+            self.sender_ids = array('I', [self.sender_ids[row] for row in rows])
+            self.lengths = array('q', [self.lengths[row] for row in rows])
+            self.offsets = offsets
+            self.arena = arena
+            self.base = 0
+            self.index_senders()
+        self.head = 0
+        self.dead_bytes = 0
+        self.holes = False
+
+    def index_senders(self):
+        """Rebuilds by_sender from the columns, which must hold no removed rows"""
+
+        self.by_sender = dict()
+        for seq, sender_id in zip(self.seqs, self.sender_ids):
+            if sender_id not in self.by_sender:
+                self.by_sender[sender_id] = array('q')
+            self.by_sender[sender_id].append(seq)
+
+    def select(self, limit, after=0, sender_id=None):
+        """Returns the rows of up to limit messages with a seq greater than after, only sender_id's if given"""
+
+        rows = []
+        if sender_id is None:
+            row = bisect.bisect_right(self.seqs, after, self.head)
+            end = len(self.seqs)
+            while row < end and len(rows) < limit:
+                if self.lengths[row] >= 0:
+                    rows.append(row)
+                row += 1
+            return rows
+        seqs = self.by_sender.get(sender_id, ())
+        for index in range(bisect.bisect_right(seqs, after), len(seqs)):
+            if len(rows) == limit:
+                break
+            row = self.find(seqs[index])
+            if row >= 0:
+                rows.append(row)
+        return rows
+
+    def rows(self):
+        return [row for row in range(self.head, len(self.seqs)) if self.lengths[row] >= 0]
+
+# spill segment header: rows, arena length, then the seq, sender ID, offset and length
+# columns in native order and the arena, followed by any SEGMENT_RECORDs appended since
+SEGMENT_HEADER = struct.Struct("!QQ")
+# a message stored for a spilled mailbox: seq, sender ID, body length, then the body
+# unless the message is spooled and kept by reference, spooled bodies can pass 4 GiB
+SEGMENT_RECORD = struct.Struct("!qIQB")
+# seconds between looks for mailboxes that have gone cold
+SPILL_CHECK_INTERVAL = 1.0
+# over the memory limit, the largest mailboxes are spilled until this fraction of it is used
+SPILL_LOW_WATER = 0.75
+
+class SpilledMailbox:
+    """A mailbox written out to a segment file, only its depth and spooled payloads stay in memory
+
+    Messages stored while spilled are appended to the segment rather than bringing
+    the mailbox back in, it is loaded with mmap once it is read.
+
+    Args:
+        path (str): the segment file
+        mailbox (CompactMailbox): the mailbox to write out
+    """
+
+    __slots__ = ("path", "live", "live_bytes", "spooled")
+
+    def __init__(self, path, mailbox):
+        if mailbox.head > 0 or mailbox.holes:
+            mailbox.compact()
+        self.path = path
+        self.live = mailbox.live
+        self.live_bytes = mailbox.live_bytes
+        self.spooled = mailbox.spooled
+        offsets = array('Q', mailbox.offsets)
+        for index in range(len(offsets)):
+            offsets[index] -= mailbox.base
+        with open(path, 'wb') as segment:
+            segment.write(SEGMENT_HEADER.pack(len(mailbox.seqs), len(mailbox.arena)))
+            for column in (mailbox.seqs, mailbox.sender_ids, offsets, mailbox.lengths):
+                column.tofile(segment)
+            segment.write(mailbox.arena)
+
+    def __len__(self):
+        return self.live
+
+    def append(self, seq, sender_id, message):
+        spooled = isinstance(message, SpoolPayload)
+        with open(self.path, 'ab') as segment:
+            segment.write(SEGMENT_RECORD.pack(seq, sender_id, len(message), spooled))
+            if spooled:
+                self.spooled[seq] = message
+            else:
+                segment.write(message)
+        self.live += 1
+        self.live_bytes += len(message)
+
+    def load(self):
+        """Reads the segment back into a CompactMailbox, the file is left in place"""
+
+        mailbox = CompactMailbox()
+        mailbox.spooled = dict(self.spooled)
+        with open(self.path, 'rb') as segment:
+            mapped = mmap.mmap(segment.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(mapped)
+        try:
+            rows, arena_len = SEGMENT_HEADER.unpack_from(mapped, 0)
+            offset = SEGMENT_HEADER.size
+            for column in (mailbox.seqs, mailbox.sender_ids, mailbox.offsets, mailbox.lengths):
+                end = offset + rows * column.itemsize
+                column.frombytes(view[offset:end])
+                offset = end
+            mailbox.arena = bytearray(view[offset:offset + arena_len])
+            offset += arena_len
+            mailbox.live = rows
+            mailbox.live_bytes = sum(mailbox.lengths)
+            mailbox.index_senders()
+            while offset < len(mapped):
+                seq, sender_id, length, spooled = SEGMENT_RECORD.unpack_from(mapped, offset)
+                offset += SEGMENT_RECORD.size
+                if spooled:
+                    mailbox.append(seq, sender_id, mailbox.spooled.pop(seq))
+                else:
+                    mailbox.append(seq, sender_id, view[offset:offset + length])
+                    offset += length
+        finally:
+            view.release()
+            mapped.close()
+        return mailbox
+
+    def discard(self):
+        os.remove(self.path)
+
+class MemoryMailStore(MailStore):
+    """Keeps each mailbox as a CompactMailbox, spilling cold ones to disk if given a spill_dir
+
+    Sender names are interned as integer IDs so each name is kept once, and a stored
+    message costs its body plus a few dozen bytes of columns rather than a tuple, a
+    str and a bytearray. Names are kept for the life of the store.
+
+    With spilling, mailboxes not used for spill_after seconds, and the largest ones
+    while the mailboxes take more than memory_limit bytes, are written to a segment
+    file each. A spilled mailbox's depth is still answered from memory and it is read
+    back in when it is next read. The segments are removed when the store is closed,
+    like the rest of a memory store they don't outlive the server.
+
+    Unused mailboxes are looked for by a thread every SPILL_CHECK_INTERVAL seconds,
+    so they are spilled while the server is idle too. The memory limit is checked
+    whenever a message is stored or a mailbox read back in, the only times the
+    mailboxes grow.
+
+    Args:
+        spill_dir (str): where segment files are written, a new temporary directory
+            if spill_after or memory_limit is given without one
+        spill_after (float): seconds a mailbox may go unused before it is spilled
+        memory_limit (int): bytes of mailboxes kept in memory
+    """
+
+    def __init__(self, spill_dir=None, spill_after=None, memory_limit=None):
+        # recipient -> CompactMailbox, least recently used first
+        self.mailboxes = OrderedDict()
+        # recipient -> SpilledMailbox
+        self.spilled = dict()
+        self.next_seq = 1
+        self.lock = threading.Lock()
+        # sender name -> ID, and the name of each ID
+        self.sender_ids = dict()
+        self.sender_names = []
+        self.spill_after = spill_after
+        self.memory_limit = memory_limit
+        self.spill_dir = spill_dir
+        if spill_dir is None and (spill_after is not None or memory_limit is not None):
+            self.spill_dir = tempfile.mkdtemp(prefix="mailserver-spill-")
+        if self.spill_dir is not None:
+            os.makedirs(self.spill_dir, exist_ok=True)
+        self.segments = 0
+        self.resident_bytes = 0
+        self.stopped = threading.Event()
+        if spill_after is not None:
+            self.spiller = threading.Thread(target=self.spill_loop, daemon=True)
+            self.spiller.start()
+
+    def intern(self, sender):
+        sender_id = self.sender_ids.get(sender)
+        if sender_id is None:
+            sender_id = self.sender_ids[sender] = len(self.sender_names)
+            self.sender_names.append(sys.intern(sender))
+        return sender_id
+
+    def touch(self, recipient, create):
+        """Gets a mailbox to use, reading it back in if it was spilled
+
+        Args:
+            recipient (str): the name of the reciever
+            create (bool): True to make an empty mailbox if there is none
+
+        Returns:
+            (CompactMailbox): the mailbox, None if there is none and create is False
+        """
+
+        mailbox = self.mailboxes.get(recipient)
+        if mailbox is not None:
+            self.mailboxes.move_to_end(recipient)
+        else:
+            spilled = self.spilled.pop(recipient, None)
+            if spilled is not None:
+                mailbox = spilled.load()
+                spilled.discard()
+                self.resident_bytes += mailbox.nbytes()
+            elif create:
+                mailbox = CompactMailbox()
+            else:
+                return None
+            self.mailboxes[recipient] = mailbox
+        if self.spill_dir is not None:
+            mailbox.touched = time.monotonic()
+        return mailbox
+
+    def spill(self, recipient):
+        mailbox = self.mailboxes.pop(recipient)
+        self.resident_bytes -= mailbox.nbytes()
+        self.segments += 1
+        path = os.path.join(self.spill_dir, "mailbox-" + str(self.segments) + ".seg")
+        self.spilled[recipient] = SpilledMailbox(path, mailbox)
+
+    def spill_cold(self, now):
+        """Spills mailboxes that have gone unused for spill_after seconds by now"""
+
+        # the mailboxes are kept least recently used first, so the cold ones are at the front
+        while self.mailboxes:
+            recipient, mailbox = next(iter(self.mailboxes.items()))
+            if now - mailbox.touched < self.spill_after:
+                break
+            self.spill(recipient)
+
+    def spill_loop(self):
+        while not self.stopped.wait(SPILL_CHECK_INTERVAL):
+            with self.lock:
+                self.spill_cold(time.monotonic())
+
+    def spill_over_limit(self):
+        """Spills the largest mailboxes while they take more memory than the limit"""
+
+        if self.memory_limit is not None and self.resident_bytes > self.memory_limit:
+            for recipient in sorted(self.mailboxes, key=lambda name: self.mailboxes[name].nbytes(), reverse=True):
+                if self.resident_bytes <= self.memory_limit * SPILL_LOW_WATER:
+                    break
+                self.spill(recipient)
+
+    def append(self, recipient, sender, message, seq=None):
+        with self.lock:
+            if seq is None:
+                seq = self.next_seq
+            self.next_seq = max(self.next_seq, seq + 1)
+            spilled = self.spilled.get(recipient)
+            if spilled is not None:
+                spilled.append(seq, self.intern(sender), message)
+                return seq
+            mailbox = self.touch(recipient, True)
+            size = mailbox.nbytes()
+            mailbox.append(seq, self.intern(sender), message)
+            self.resident_bytes += mailbox.nbytes() - size
+            self.spill_over_limit()
+        return seq
+
+    def peek(self, recipient, limit, after=0, sender=None):
+        with self.lock:
+            mailbox = self.touch(recipient, False)
+            if mailbox is None:
+                return []
+            sender_id = None
+            if sender is not None:
+                sender_id = self.sender_ids.get(sender)
+                if sender_id is None:
+                    return []
+            items = [(mailbox.seqs[row], self.sender_names[mailbox.sender_ids[row]], mailbox.message(row))
+                for row in mailbox.select(limit, after, sender_id)]
+            self.spill_over_limit()
+            return items
+
+    def remove(self, recipient, seqs):
+        with self.lock:
+            mailbox = self.touch(recipient, False)
+            if mailbox is None:
+                return None
+            size = mailbox.nbytes()
+            spooled = mailbox.remove(seqs)
+            self.resident_bytes += mailbox.nbytes() - size
+            # an emptied mailbox is dropped so abandoned names don't hold memory
+            if not mailbox:
+                del self.mailboxes[recipient]
+                self.resident_bytes -= mailbox.nbytes()
+        for payload in spooled:
+            payload.discard()
+
+    def count(self, recipient):
+        with self.lock:
+            mailbox = self.mailboxes.get(recipient)
+            if mailbox is None:
+                mailbox = self.spilled.get(recipient)
+            return len(mailbox) if mailbox is not None else 0
+
+    def depths(self, recipients):
+        # neither touches a mailbox, so polling doesn't keep cold ones in memory
+        depths = []
+        with self.lock:
+            for recipient in recipients:
+                mailbox = self.mailboxes.get(recipient)
+                if mailbox is None:
+                    mailbox = self.spilled.get(recipient)
+                depths.append((mailbox.live, mailbox.live_bytes) if mailbox is not None else (0, 0))
+        return depths
+
+    def snapshot(self):
+        with self.lock:
+            mailboxes = list(self.mailboxes.items())
+            mailboxes += [(recipient, spilled.load()) for recipient, spilled in self.spilled.items()]
+            return sorted((mailbox.seqs[row], recipient, self.sender_names[mailbox.sender_ids[row]],
+                mailbox.message(row)) for recipient, mailbox in mailboxes for row in mailbox.rows())
+
+    def metrics(self):
+        with self.lock:
+            return {"resident_mailboxes": len(self.mailboxes), "resident_bytes": self.resident_bytes,
+                "spilled_mailboxes": len(self.spilled)}
+
+    def close(self):
+        self.stopped.set()
+        with self.lock:
+            for spilled in self.spilled.values():
+                spilled.discard()
+            self.spilled.clear()
+
+class MemoryKeyStore(KeyStore):
+
+    def __init__(self):
+        self.keys = dict()
+        self.lock = threading.Lock()
+
+    def put(self, name, n, e):
+        with self.lock:
+            self.keys[name] = (n, e)
+
+    def items(self):
+        with self.lock:
+            return [(name, n, e) for name, (n, e) in self.keys.items()]
+
+class SQLiteMailStore(MailStore):
+    """Keeps messages in a SQLite table, a spooled message is stored by its path
+
+    Args:
+        path (str): the database file
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.lock = threading.Lock()
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS messages (seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "recipient TEXT NOT NULL, sender TEXT NOT NULL, body BLOB, spool_path TEXT, length INTEGER NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS messages_recipient ON messages (recipient, seq)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS messages_sender ON messages (recipient, sender, seq)")
+        # recipient -> [message count, message bytes], counted once here and then kept up to date
+        self.counters = {recipient: [count, size] for recipient, count, size in self.db.execute(
+            "SELECT recipient, COUNT(*), SUM(length) FROM messages GROUP BY recipient")}
+
+    def append(self, recipient, sender, message, seq=None):
+        if isinstance(message, SpoolPayload):
+            row = (seq, recipient, sender, None, message.path, len(message))
+        else:
+            row = (seq, recipient, sender, bytes(message), None, len(message))
+        with self.lock:
+            seq = self.db.execute("INSERT INTO messages (seq, recipient, sender, body, spool_path, length) "
+                "VALUES (?, ?, ?, ?, ?, ?)", row).lastrowid
+            counter = self.counters.setdefault(recipient, [0, 0])
+            counter[0] += 1
+            counter[1] += len(message)
+            return seq
+
+    def peek(self, recipient, limit, after=0, sender=None):
+        with self.lock:
+            if sender is None:
+                rows = self.db.execute("SELECT seq, sender, body, spool_path, length FROM messages "
+                    "WHERE recipient = ? AND seq > ? ORDER BY seq LIMIT ?", (recipient, after, limit)).fetchall()
+            else:
+                rows = self.db.execute("SELECT seq, sender, body, spool_path, length FROM messages "
+                    "WHERE recipient = ? AND sender = ? AND seq > ? ORDER BY seq LIMIT ?",
+                    (recipient, sender, after, limit)).fetchall()
+        return [(seq, sender, SpoolPayload(spool_path, length) if spool_path is not None else bytearray(body))
+            for seq, sender, body, spool_path, length in rows]
+
+    def snapshot(self):
+        with self.lock:
+            rows = self.db.execute("SELECT seq, recipient, sender, body, spool_path, length FROM messages "
+                "ORDER BY seq").fetchall()
+        return [(seq, recipient, sender, SpoolPayload(spool_path, length) if spool_path is not None
+            else bytearray(body)) for seq, recipient, sender, body, spool_path, length in rows]
+
+    def remove(self, recipient, seqs):
+        rows = [(recipient, seq) for seq in seqs]
+        with self.lock:
+            self.db.execute("BEGIN")
+            try:
+                removed = []
+                for row in rows:
+                    removed += self.db.execute("SELECT spool_path, length FROM messages WHERE recipient = ? "
+                        "AND seq = ?", row).fetchall()
+                self.db.executemany("DELETE FROM messages WHERE recipient = ? AND seq = ?", rows)
+                self.db.execute("COMMIT")
+            except sqlite3.Error:
+                self.db.execute("ROLLBACK")
+                raise
+            if removed:
+                counter = self.counters[recipient]
+                counter[0] -= len(removed)
+                counter[1] -= sum(length for spool_path, length in removed)
+                if counter[0] == 0:
+                    del self.counters[recipient]
+        for spool_path, length in removed:
+            if spool_path is not None:
+                SpoolPayload(spool_path, length).discard()
+
+    def count(self, recipient):
+        with self.lock:
+            return self.counters.get(recipient, (0, 0))[0]
+
+    def depths(self, recipients):
+        with self.lock:
+            return [tuple(self.counters.get(recipient, (0, 0))) for recipient in recipients]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+class SQLiteKeyStore(KeyStore):
+    """Keeps public keys in a SQLite table, n and e are stored as big-endian blobs
+
+    Args:
+        path (str): the database file, may be the one a SQLiteMailStore uses
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.lock = threading.Lock()
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS public_keys (name TEXT PRIMARY KEY, n BLOB NOT NULL, e BLOB NOT NULL)")
+
+    def put(self, name, n, e):
+        row = (name, n.to_bytes((n.bit_length() + 7) // 8, "big"), e.to_bytes((e.bit_length() + 7) // 8, "big"))
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO public_keys (name, n, e) VALUES (?, ?, ?)", row)
+
+    def items(self):
+        with self.lock:
+            rows = self.db.execute("SELECT name, n, e FROM public_keys ORDER BY rowid").fetchall()
+        return [(name, int.from_bytes(n, "big"), int.from_bytes(e, "big")) for name, n, e in rows]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+# log record header: kind, seq, recipient length, sender length, body length
+LOG_RECORD = struct.Struct("!BQHHI")
+# the body is the message
+LOG_APPEND = 1
+# the body is the path of a spool file holding the message, then its length
+LOG_APPEND_SPOOL = 2
+# removes the message with seq, there is no sender or body
+LOG_REMOVE = 3
+# a log is rewritten once it is at least this large and mostly removed records
+LOG_COMPACT_SIZE = 16 * 1024 * 1024
+# the length at the end of a LOG_APPEND_SPOOL body
+LOG_SPOOL_LENGTH = struct.Struct("!Q")
+
+class LogMailStore(MailStore):
+    """Appends every change to a log file and keeps an index of the live messages in memory
+
+    A store is one sequential write per create and one small record per removed
+    message, bodies are read back from the log with pread when a mailbox is read. The
+    index is rebuilt by replaying the log when the store is opened, and once most of the
+    log is removed records it is rewritten with only the live messages.
+
+    Args:
+        path (str): the log file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # recipient -> Mailbox of (seq, sender, offset, length, spool_path)
+        self.mailboxes = dict()
+        self.next_seq = 1
+        self.live_bytes = 0
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o600)
+        self.replay()
+
+    def replay(self):
+        """Rebuilds the index from the log, a torn record at the end is cut off"""
+
+        entries = dict()
+        offset = 0
+        with open(self.path, 'rb') as log_file:
+            data = log_file.read()
+        while offset + LOG_RECORD.size <= len(data):
+            kind, seq, rec_len, sen_len, body_len = LOG_RECORD.unpack_from(data, offset)
+            end = offset + LOG_RECORD.size + rec_len + sen_len + body_len
+            if kind not in (LOG_APPEND, LOG_APPEND_SPOOL, LOG_REMOVE) or end > len(data):
+                break
+            start = offset + LOG_RECORD.size
+            recipient = data[start:start + rec_len].decode("utf-8")
+            sender = data[start + rec_len:start + rec_len + sen_len].decode("utf-8")
+            body_start = start + rec_len + sen_len
+            if kind == LOG_APPEND:
+                entries[seq] = (recipient, sender, body_start, body_len, None)
+            elif kind == LOG_APPEND_SPOOL:
+                path = data[body_start:end - LOG_SPOOL_LENGTH.size].decode("utf-8")
+                length = LOG_SPOOL_LENGTH.unpack_from(data, end - LOG_SPOOL_LENGTH.size)[0]
+                entries[seq] = (recipient, sender, 0, length, path)
+            else:
+                entries.pop(seq, None)
+            self.next_seq = max(self.next_seq, seq + 1)
+            offset = end
+        if offset < len(data):
+            os.truncate(self.path, offset)
+
+        for seq in sorted(entries):
+            recipient, sender, body_offset, length, path = entries[seq]
+            if recipient not in self.mailboxes:
+                self.mailboxes[recipient] = Mailbox()
+            self.mailboxes[recipient].append((seq, sender, body_offset, length, path))
+            self.mailboxes[recipient].nbytes += length
+            self.live_bytes += length if path is None else 0
+
+    def write_record(self, kind, seq, recipient_bytes, sender_bytes, body):
+        """Appends one record, returning the offset its body was written at"""
+
+        record = LOG_RECORD.pack(kind, seq, len(recipient_bytes), len(sender_bytes), len(body))
+        record += recipient_bytes + sender_bytes
+        offset = os.lseek(self.fd, 0, os.SEEK_END) + len(record)
+        os.write(self.fd, record + body)
+        return offset
+
+    def append(self, recipient, sender, message, seq=None):
+        recipient_bytes = recipient.encode("utf-8")
+        sender_bytes = sender.encode("utf-8")
+        with self.lock:
+            if seq is None:
+                seq = self.next_seq
+            self.next_seq = max(self.next_seq, seq + 1)
+            if isinstance(message, SpoolPayload):
+                body = message.path.encode("utf-8") + LOG_SPOOL_LENGTH.pack(len(message))
+                self.write_record(LOG_APPEND_SPOOL, seq, recipient_bytes, sender_bytes, body)
+                entry = (seq, sender, 0, len(message), message.path)
+            else:
+                offset = self.write_record(LOG_APPEND, seq, recipient_bytes, sender_bytes, bytes(message))
+                entry = (seq, sender, offset, len(message), None)
+                self.live_bytes += len(message)
+            if recipient not in self.mailboxes:
+                self.mailboxes[recipient] = Mailbox()
+            self.mailboxes[recipient].append(entry)
+            self.mailboxes[recipient].nbytes += len(message)
+        return seq
+
+    def peek(self, recipient, limit, after=0, sender=None):
+        with self.lock:
+            mailbox = self.mailboxes.get(recipient)
+            if mailbox is None:
+                return []
+            entries = mailbox.select(limit, after, sender)
+            return [(seq, sender, SpoolPayload(path, length) if path is not None
+                else bytearray(os.pread(self.fd, length, offset))) for seq, sender, offset, length, path in entries]
+
+    def remove(self, recipient, seqs):
+        removed = []
+        with self.lock:
+            mailbox = self.mailboxes.get(recipient)
+            if mailbox is None:
+                return None
+            for seq in seqs:
+                entry = mailbox.pop(seq)
+                if entry is not None:
+                    removed.append(entry)
+                    mailbox.nbytes -= entry[3]
+            if not mailbox:
+                del self.mailboxes[recipient]
+            records = b"".join(LOG_RECORD.pack(LOG_REMOVE, entry[0], 0, 0, 0) for entry in removed)
+            if records:
+                os.write(self.fd, records)
+            for seq, sender, offset, length, path in removed:
+                self.live_bytes -= length if path is None else 0
+            size = os.lseek(self.fd, 0, os.SEEK_END)
+            if size >= LOG_COMPACT_SIZE and self.live_bytes * 2 < size:
+                self.compact()
+        for seq, sender, offset, length, path in removed:
+            if path is not None:
+                SpoolPayload(path, length).discard()
+
+    def compact(self):
+        """Rewrites the log with only the live messages, called holding the lock"""
+
+        temp_path = self.path + ".compact"
+        temp_fd = os.open(temp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        mailboxes = dict()
+        offset = 0
+        try:
+            entries = [(entry, recipient) for recipient, mailbox in self.mailboxes.items() for entry in mailbox]
+            for (seq, sender, body_offset, length, path), recipient in sorted(entries):
+                recipient_bytes = recipient.encode("utf-8")
+                sender_bytes = sender.encode("utf-8")
+                if path is None:
+                    kind, body = LOG_APPEND, os.pread(self.fd, length, body_offset)
+                else:
+                    kind, body = LOG_APPEND_SPOOL, path.encode("utf-8") + LOG_SPOOL_LENGTH.pack(length)
+                header = LOG_RECORD.pack(kind, seq, len(recipient_bytes), len(sender_bytes), len(body))
+                header += recipient_bytes + sender_bytes
+                os.write(temp_fd, header + body)
+                offset += len(header)
+                if recipient not in mailboxes:
+                    mailboxes[recipient] = Mailbox()
+                mailboxes[recipient].append((seq, sender, offset, length, path))
+                mailboxes[recipient].nbytes += length
+                offset += len(body)
+            os.fsync(temp_fd)
+        finally:
+            os.close(temp_fd)
+        os.replace(temp_path, self.path)
+        os.close(self.fd)
+        self.fd = os.open(self.path, os.O_RDWR | os.O_APPEND)
+        self.mailboxes = mailboxes
+
+    def count(self, recipient):
+        with self.lock:
+            return len(self.mailboxes.get(recipient, ()))
+
+    def depths(self, recipients):
+        with self.lock:
+            return [(len(self.mailboxes[recipient]), self.mailboxes[recipient].nbytes)
+                if recipient in self.mailboxes else (0, 0) for recipient in recipients]
+
+    def snapshot(self):
+        with self.lock:
+            entries = sorted((entry, recipient) for recipient, mailbox in self.mailboxes.items() for entry in mailbox)
+            return [(seq, recipient, sender, SpoolPayload(path, length) if path is not None
+                else bytearray(os.pread(self.fd, length, offset))) for (seq, sender, offset, length, path), recipient in entries]
+
+    def close(self):
+        with self.lock:
+            os.close(self.fd)
+
+# key record header: name length, e length, n length
+LOG_KEY_RECORD = struct.Struct("!HHH")
+
+class LogKeyStore(KeyStore):
+    """Appends every registration to a log file, replaying it on open keeps the latest key of each name
+
+    Args:
+        path (str): the log file
+    """
+
+    def __init__(self, path):
+        self.keys = dict()
+        self.lock = threading.Lock()
+        with open(path, 'ab+') as log_file:
+            log_file.seek(0)
+            data = log_file.read()
+        offset = 0
+        while offset + LOG_KEY_RECORD.size <= len(data):
+            name_len, e_len, n_len = LOG_KEY_RECORD.unpack_from(data, offset)
+            start = offset + LOG_KEY_RECORD.size
+            if start + name_len + e_len + n_len > len(data):
+                break
+            name = data[start:start + name_len].decode("utf-8")
+            e = int.from_bytes(data[start + name_len:start + name_len + e_len], "big")
+            n = int.from_bytes(data[start + name_len + e_len:start + name_len + e_len + n_len], "big")
+            self.keys[name] = (n, e)
+            offset = start + name_len + e_len + n_len
+        if offset < len(data):
+            os.truncate(path, offset)
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+
+    def put(self, name, n, e):
+        name_bytes = name.encode("utf-8")
+        e_bytes = e.to_bytes((e.bit_length() + 7) // 8, "big")
+        n_bytes = n.to_bytes((n.bit_length() + 7) // 8, "big")
+        with self.lock:
+            os.write(self.fd, LOG_KEY_RECORD.pack(len(name_bytes), len(e_bytes), len(n_bytes)) + name_bytes + e_bytes + n_bytes)
+            self.keys[name] = (n, e)
+
+    def items(self):
+        with self.lock:
+            return [(name, n, e) for name, (n, e) in self.keys.items()]
+
+    def close(self):
+        with self.lock:
+            os.close(self.fd)
+
+STORE_TYPES = ('memory', 'sqlite', 'log')
+
+def open_stores(store_type, data_dir=None, spill_after=None, memory_limit=None):
+    """Opens a mail store and key store of one of the STORE_TYPES
+
+    Args:
+        store_type (str): 'memory', 'sqlite' or 'log'
+        data_dir (str): the directory the files of a 'sqlite' or 'log' store are kept in,
+            a 'memory' store spills mailboxes to data_dir/spill if given
+        spill_after (float): seconds before an untouched mailbox of a 'memory' store is spilled
+        memory_limit (int): bytes of mailboxes a 'memory' store keeps in memory
+
+    Returns:
+        mail_store (MailStore): the message store
+        key_store (KeyStore): the public key store
+    """
+
+    if store_type == 'memory':
+        spill_dir = None
+        if data_dir is not None and (spill_after is not None or memory_limit is not None):
+            spill_dir = os.path.join(data_dir, "spill")
+        return MemoryMailStore(spill_dir, spill_after, memory_limit), MemoryKeyStore()
+    if store_type not in STORE_TYPES:
+        raise ValueError("store must be one of " + ", ".join(STORE_TYPES))
+    if data_dir is None:
+        raise ValueError("a '" + store_type + "' store needs a data directory")
+    os.makedirs(data_dir, exist_ok=True)
+    if store_type == 'sqlite':
+        path = os.path.join(data_dir, "mail.sqlite3")
+        return SQLiteMailStore(path), SQLiteKeyStore(path)
+    return LogMailStore(os.path.join(data_dir, "mail.log")), LogKeyStore(os.path.join(data_dir, "keys.log"))
@@ -0,0 +1,47 @@
+"""Shared fixtures for the tests, the modules are imported from the repository root
+
+Name: Zya Gurau
+"""
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server import Server
+
+
+@pytest.fixture
+def start_server(tmp_path):
+    """Starts embedded servers on free ports, stopping them when the test ends"""
+
+    servers = []
+
+    def start(**kwargs):
+        kwargs.setdefault("spool_dir", str(tmp_path / ("spool" + str(len(servers)))))
+        server = Server(0, host='127.0.0.1', quiet=True, **kwargs).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.stop()
+
+
+@pytest.fixture
+def server(start_server):
+    """A server with in-memory stores"""
+
+    return start_server()
+
+
+@pytest.fixture
+def client_dir(tmp_path, monkeypatch):
+    """Keeps the key files and daemon sockets a test makes in its own directory"""
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+    return tmp_path
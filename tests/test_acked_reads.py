@@ -0,0 +1,204 @@
+"""Tests for acknowledged reads, their cursors and how they share a mailbox with plain reads
+
+Name: Zya Gurau
+"""
+
+import asyncio
+import socket
+import time
+
+import pytest
+
+import server as server_module
+from async_client import AsyncClient
+from common import recv_exact
+
+
+@pytest.fixture
+def as_bob(server):
+    """Stores ten messages from ali for bob, then runs coroutine functions as bob"""
+
+    async def fill():
+        async with AsyncClient('127.0.0.1', server.port, "ali") as ali:
+            for i in range(10):
+                await ali.create("bob", b"m%d" % i)
+
+    async def session(steps):
+        async with AsyncClient('127.0.0.1', server.port, "bob", pool_size=1) as bob:
+            return await steps(bob)
+
+    asyncio.run(fill())
+    return lambda steps: asyncio.run(session(steps))
+
+
+def messages(items):
+    return [message for sender, message in items]
+
+
+def test_pages_follow_each_other_until_acknowledged(server, as_bob):
+    async def steps(bob):
+        first = await bob.read_acked(4)
+        assert server.mail_store.count("bob") == 10
+        second = await bob.read_acked(4, ack=first[2])
+        assert server.mail_store.count("bob") == 6
+        last = await bob.read_acked(4, ack=second[2])
+        await bob.read_acked(0, ack=last[2])
+        return first, second, last
+
+    first, second, last = as_bob(steps)
+    assert messages(first[0]) == [b"m0", b"m1", b"m2", b"m3"] and first[1]
+    assert messages(second[0]) == [b"m4", b"m5", b"m6", b"m7"] and second[2] > first[2]
+    assert messages(last[0]) == [b"m8", b"m9"] and not last[1]
+    assert server.mail_store.count("bob") == 0
+    assert server.deliveries == {}
+
+
+def test_passing_the_same_cursor_again_fetches_the_next_page(server, as_bob):
+    async def steps(bob):
+        first = await bob.read_acked(2)
+        second = await bob.read_acked(2, ack=first[2])
+        # the second page is still in flight, this one starts after it
+        third = await bob.read_acked(2, ack=first[2])
+        assert server.mail_store.count("bob") == 8
+        await bob.read_acked(0, ack=third[2])
+        return second, third
+
+    second, third = as_bob(steps)
+    assert messages(second[0]) == [b"m2", b"m3"]
+    assert messages(third[0]) == [b"m4", b"m5"]
+    assert server.mail_store.count("bob") == 4
+
+
+def test_retry_without_a_cursor_is_sent_the_same_page(server, as_bob):
+    async def steps(bob):
+        # the reply to this read is lost, so the client retries with no cursor
+        lost = await bob.read_acked(5)
+        retried = await bob.read_acked(5)
+        await bob.read_acked(0, ack=retried[2])
+        return lost, retried
+
+    lost, retried = as_bob(steps)
+    assert messages(retried[0]) == messages(lost[0]) == [b"m0", b"m1", b"m2", b"m3", b"m4"]
+    assert server.mail_store.count("bob") == 5
+
+
+def test_plain_read_skips_messages_awaiting_acknowledgement(server, as_bob):
+    async def steps(bob):
+        page = await bob.read_acked(4)
+        plain = await bob.read(3)
+        rest = await bob.read(100)
+        # only the acknowledged read's page is left, for it to acknowledge. A plain read
+        # removes its page after sending it, the next request on the connection follows that
+        assert await bob.depths(["bob"]) == {"bob": (4, 8)}
+        await bob.read_acked(0, ack=page[2])
+        return plain, rest
+
+    plain, rest = as_bob(steps)
+    assert messages(plain[0]) == [b"m4", b"m5", b"m6"] and plain[1]
+    assert messages(rest[0]) == [b"m7", b"m8", b"m9"] and not rest[1]
+    assert server.mail_store.count("bob") == 0
+
+
+def test_sender_filtered_read_skips_messages_awaiting_acknowledgement(server, as_bob):
+    async def steps(bob):
+        await bob.read_acked(2)
+        return await bob.read(100, sender="ali")
+
+    items, more_msgs = as_bob(steps)
+    assert messages(items) == [b"m%d" % i for i in range(2, 10)]
+
+
+def test_plain_read_messages_are_not_redelivered_after_the_timeout(server, as_bob, monkeypatch):
+    monkeypatch.setattr(server_module, "ACK_TIMEOUT", 0.05)
+
+    async def steps(bob):
+        first = await bob.read_acked(2)
+        page = await bob.read_acked(2, ack=first[2])
+        plain = await bob.read(100)
+        await asyncio.sleep(0.1)
+        return page, plain, await bob.read_acked(100, ack=first[2])
+
+    page, plain, redelivered = as_bob(steps)
+    # the timed out page is sent again, the messages the plain read took are not
+    assert messages(redelivered[0]) == messages(page[0]) == [b"m2", b"m3"]
+    assert messages(plain[0]) == [b"m%d" % i for i in range(4, 10)]
+
+
+def test_late_acknowledgement_removes_a_page_sent_again(server, as_bob, monkeypatch):
+    monkeypatch.setattr(server_module, "ACK_TIMEOUT", 0.05)
+
+    async def steps(bob):
+        first = await bob.read_acked(2)
+        late = await bob.read_acked(4, ack=first[2])
+        await asyncio.sleep(0.1)
+        again = await bob.read_acked(2, ack=first[2])
+        await bob.read_acked(0, ack=late[2])
+        return late, again
+
+    late, again = as_bob(steps)
+    assert messages(again[0]) == [b"m2", b"m3"]
+    assert messages(late[0]) == [b"m2", b"m3", b"m4", b"m5"]
+    assert server.mail_store.count("bob") == 4
+
+
+def test_streamed_page_is_acknowledged_on_the_pooled_connection(server, as_bob):
+    async def steps(bob):
+        streamed = [(sender, message, more_msgs) async for sender, message, more_msgs in bob.read_stream(4)]
+        conn = bob.pool.idle[-1][0]
+        rest = [message async for sender, message, more_msgs in bob.read_stream()]
+        return streamed, conn is bob.pool.idle[-1][0], rest
+
+    streamed, reused, rest = as_bob(steps)
+    assert streamed == [("ali", b"m%d" % i, True) for i in range(4)]
+    assert reused
+    assert rest == [b"m%d" % i for i in range(4, 10)]
+    assert server.mail_store.count("bob") == 0
+
+
+def test_stream_left_part_way_is_sent_again(server, as_bob):
+    async def steps(bob):
+        stream = bob.read_stream(4)
+        first = await stream.__anext__()
+        await stream.aclose()
+        return first, [message async for sender, message, more_msgs in bob.read_stream(4)]
+
+    first, again = as_bob(steps)
+    assert first == ("ali", b"m0", True)
+    assert again == [b"m0", b"m1", b"m2", b"m3"]
+    assert server.mail_store.count("bob") == 6
+
+
+def test_concurrent_v1_and_v2_reads_send_each_message_once(server):
+    async def fill():
+        async with AsyncClient('127.0.0.1', server.port, "ali") as ali:
+            for i in range(300):
+                await ali.create("bob", b"%05d" % i + bytes(60000))
+
+    asyncio.run(fill())
+    with socket.create_connection(('127.0.0.1', server.port)) as v1:
+        v1.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        v1.sendall(bytes([0xAE, 0x73, 1, 3, 0, 0, 0]) + b"bob")
+        # the v1 page is far larger than the socket buffers, so it is still being sent
+        deadline = time.monotonic() + 5
+        while "bob" not in server.deliveries and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        async def read_v2():
+            async with AsyncClient('127.0.0.1', server.port, "bob") as bob:
+                return await bob.read()
+
+        v2_items, more_msgs = asyncio.run(read_v2())
+        header = recv_exact(v1, 5)
+        v1_messages = []
+        for i in range(header[3]):
+            sender_len, high, low = recv_exact(v1, 3)
+            v1_messages.append(bytes(recv_exact(v1, sender_len + (high << 8 | low))[sender_len:sender_len + 5]))
+
+    v2_messages = [message[:5] for sender, message in v2_items]
+    assert len(v1_messages) == 255 and len(v2_messages) == 45
+    assert sorted(v1_messages + v2_messages) == [b"%05d" % i for i in range(300)]
+    deadline = time.monotonic() + 5
+    while server.mail_store.count("bob") > 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert server.mail_store.count("bob") == 0
+    assert server.deliveries == {}
@@ -0,0 +1,62 @@
+"""Tests for the per-sender and per-IP rate limits and the in-flight cap
+
+Name: Zya Gurau
+"""
+
+import socket
+
+from admission import Admission
+from common import HEADER_V2, RESPONSE_HEADER_V2, MAGIC_V2, RETRY_LATER_ID, STATUS_ID, STATUS_OK, recv_exact
+
+
+def test_sender_refusal_leaves_the_ip_token():
+    admission = Admission(sender_rate=0.01, ip_rate=0.01, ip_burst=2)
+    assert admission.admit("ali", "10.0.0.1") is None
+    admission.release()
+    reason, retry_after = admission.admit("ali", "10.0.0.1")
+    assert reason == "sender" and retry_after > 0
+    # the refused request didn't spend the IP's second token
+    assert admission.admit("bob", "10.0.0.1") is None
+    admission.release()
+    assert admission.admit("eve", "10.0.0.1")[0] == "ip"
+    assert admission.rejected == {"sender": 1, "ip": 1, "in_flight": 0}
+
+
+def test_ip_refusal_leaves_the_sender_token():
+    admission = Admission(sender_rate=0.01, ip_rate=0.01)
+    assert admission.admit("ali", "10.0.0.1") is None
+    admission.release()
+    assert admission.admit("bob", "10.0.0.1")[0] == "ip"
+    # bob's token wasn't spent by the refusal so another IP can still send as bob
+    assert admission.admit("bob", "10.0.0.2") is None
+    admission.release()
+
+
+def test_unix_socket_requests_skip_the_ip_limit():
+    admission = Admission(ip_rate=0.01)
+    for i in range(3):
+        assert admission.admit("ali", None) is None
+        admission.release()
+
+
+def test_in_flight_cap_refuses_once_the_queue_is_full():
+    admission = Admission(max_in_flight=1, queue=0)
+    assert admission.admit("ali", "10.0.0.1") is None
+    assert admission.admit("bob", "10.0.0.2")[0] == "in_flight"
+    admission.release()
+    assert admission.admit("bob", "10.0.0.2") is None
+    admission.release()
+    assert admission.metrics()["in_flight"] == 0
+
+
+def test_server_answers_a_request_over_the_limit_with_retry_later(start_server):
+    server = start_server(admission=Admission(sender_rate=0.01))
+    replies = []
+    for i in range(2):
+        with socket.create_connection(('127.0.0.1', server.port)) as c:
+            c.sendall(HEADER_V2.pack(MAGIC_V2, 2, 0, 3, 3, 2) + b"alibobhi")
+            replies.append(RESPONSE_HEADER_V2.unpack(recv_exact(c, RESPONSE_HEADER_V2.size)))
+    assert replies[0] == (MAGIC_V2, STATUS_ID, 0, STATUS_OK)
+    magic_no, r_id, flags, retry_after_ms = replies[1]
+    assert r_id == RETRY_LATER_ID and retry_after_ms > 0
+    assert server.mail_store.count("bob") == 1
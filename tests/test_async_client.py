@@ -0,0 +1,111 @@
+"""Tests for when AsyncClient sends a request again after its pooled connection failed
+
+Name: Zya Gurau
+"""
+
+import asyncio
+import socket
+import threading
+import time
+
+import pytest
+
+from async_client import AsyncClient, ClientConnectionError
+from common import (HEADER_V2, RESPONSE_HEADER_V2, MAGIC_V2, STATUS_ID, STATUS_OK, KEYS_BINARY_ID, recv_exact)
+from deadlines import Deadlines, DEADLINE_TICK
+
+
+class DroppingServer:
+    """Answers v2 creates and key requests, but closes the connection without replying to request drop_at
+
+    Every request that arrives is counted, whether or not it was answered.
+    """
+
+    def __init__(self, drop_at):
+        self.drop_at = drop_at
+        self.requests = []
+        self.listener = socket.create_server(('127.0.0.1', 0))
+        self.port = self.listener.getsockname()[1]
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                c, addr = self.listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.handle, args=(c,), daemon=True).start()
+
+    def handle(self, c):
+        with c:
+            try:
+                while True:
+                    magic_no, r_id, flags, name_len, receiver_len, message_len = HEADER_V2.unpack(
+                        recv_exact(c, HEADER_V2.size))
+                    recv_exact(c, name_len + receiver_len + message_len)
+                    self.requests.append(r_id)
+                    if len(self.requests) == self.drop_at:
+                        return
+                    if r_id == KEYS_BINARY_ID:
+                        c.sendall(RESPONSE_HEADER_V2.pack(MAGIC_V2, KEYS_BINARY_ID, 0, 0))
+                    else:
+                        c.sendall(RESPONSE_HEADER_V2.pack(MAGIC_V2, STATUS_ID, 0, STATUS_OK))
+            except (OSError, ConnectionError):
+                return
+
+    def close(self):
+        self.listener.close()
+
+
+@pytest.fixture
+def dropping_server():
+    servers = []
+
+    def start(drop_at):
+        servers.append(DroppingServer(drop_at))
+        return servers[-1]
+
+    yield start
+    for server in servers:
+        server.close()
+
+
+def test_create_is_not_repeated_after_the_connection_fails(dropping_server):
+    server = dropping_server(2)
+
+    async def run():
+        async with AsyncClient('127.0.0.1', server.port, "ali", pool_size=1) as ali:
+            await ali.create("bob", b"first")
+            # the pooled connection is reused and the server drops it once the create is sent
+            with pytest.raises(ClientConnectionError):
+                await ali.create("bob", b"second")
+
+    asyncio.run(run())
+    assert server.requests == [2, 2]
+
+
+def test_query_is_repeated_on_a_new_connection(dropping_server):
+    server = dropping_server(2)
+
+    async def run():
+        async with AsyncClient('127.0.0.1', server.port, "ali", pool_size=1) as ali:
+            await ali.create("bob", b"first")
+            return await ali.fetch_keys()
+
+    assert asyncio.run(run()) == {}
+    assert server.requests == [2, KEYS_BINARY_ID, KEYS_BINARY_ID]
+
+
+def test_connection_closed_while_idle_is_replaced_before_sending(start_server):
+    server = start_server(deadlines=Deadlines(idle=0.1))
+
+    async def run():
+        async with AsyncClient('127.0.0.1', server.port, "ali", pool_size=1) as ali:
+            await ali.create("bob", b"first")
+            # the server's idle deadline closes the pooled connection
+            await asyncio.sleep(0.1 + 2 * DEADLINE_TICK)
+            await ali.create("bob", b"second")
+
+    asyncio.run(run())
+    assert server.mail_store.count("bob") == 2
@@ -0,0 +1,64 @@
+"""Tests for the client daemon serving mailctl.py commands over its Unix socket
+
+Name: Zya Gurau
+"""
+
+import asyncio
+import json
+
+from async_client import ConnectionPool
+from client import ClientCommands
+from common import daemon_path
+from deadlines import Deadlines, DEADLINE_TICK
+
+
+async def send_command(name, command, args):
+    """Sends one command to a daemon the way mailctl.py does"""
+
+    reader, writer = await asyncio.open_unix_connection(daemon_path(name))
+    writer.write(json.dumps({"command": command, "args": args}).encode("utf-8") + b"\n")
+    reply = json.loads(await reader.readline())
+    writer.close()
+    return reply
+
+
+def test_daemon_creates_survive_the_server_closing_idle_connections(client_dir, start_server):
+    server = start_server(deadlines=Deadlines(idle=0.1))
+    address = ('127.0.0.1', server.port)
+
+    async def run():
+        bob = ClientCommands("bob", address)
+        await bob.register()
+        ali = ClientCommands("ali", address)
+        await ali.keys()
+        daemon = asyncio.ensure_future(ali.serve())
+        while not (client_dir / "mailclient-ali.sock").exists():
+            await asyncio.sleep(0.01)
+        replies = [await send_command("ali", "create", ["bob", "first"])]
+        # the server's idle deadline closes the daemon's pooled connection between commands
+        await asyncio.sleep(0.1 + 2 * DEADLINE_TICK)
+        replies.append(await send_command("ali", "create", ["bob", "second"]))
+        daemon.cancel()
+        await asyncio.gather(daemon, return_exceptions=True)
+        return replies, await bob.read()
+
+    replies, output = asyncio.run(run())
+    assert [reply["ok"] for reply in replies] == [True, True]
+    assert "first" in output and "second" in output
+    assert server.mail_store.count("bob") == 0
+
+
+def test_pool_closes_connections_idle_too_long(server):
+    async def run():
+        pool = ConnectionPool('127.0.0.1', server.port, 1, max_idle=0.05)
+        conn, reused = await pool.acquire()
+        pool.release(conn, True)
+        again, reused_again = await pool.acquire()
+        pool.release(again, True)
+        await asyncio.sleep(0.1)
+        stale, reused_stale = await pool.acquire()
+        pool.release(stale, False)
+        await pool.close()
+        return reused, (again is conn, reused_again), (stale is conn, reused_stale)
+
+    assert asyncio.run(run()) == (False, (True, True), (False, False))
@@ -0,0 +1,82 @@
+"""Tests for the command line client's streaming, acknowledged read
+
+Name: Zya Gurau
+"""
+
+import asyncio
+
+from async_client import AsyncClient
+from client import ClientCommands, ATTACHMENT_MAGIC, UNDECRYPTED_SUFFIX
+
+
+def send_messages(server, client_dir):
+    """Registers bob, then stores two messages encrypted for him with garbage between them"""
+
+    address = ('127.0.0.1', server.port)
+
+    async def run():
+        bob = ClientCommands("bob", address)
+        await bob.register()
+        await bob.client.close()
+        ali = ClientCommands("ali", address)
+        await ali.keys()
+        await ali.create("bob", "first")
+        async with AsyncClient('127.0.0.1', server.port, "eve") as eve:
+            await eve.create("bob", b"not encrypted for bob")
+        await ali.create("bob", "second")
+        await ali.client.close()
+
+    asyncio.run(run())
+    return address
+
+
+def read(commands):
+    async def run():
+        try:
+            return await commands.read()
+        finally:
+            await commands.client.close()
+
+    return asyncio.run(run())
+
+
+def test_read_emits_each_message_and_saves_the_one_it_cant_decrypt(server, client_dir):
+    address = send_messages(server, client_dir)
+    emitted = []
+    remaining = read(ClientCommands("bob", address, emitted.append))
+
+    assert len(emitted) == 3
+    assert "first" in emitted[0] and "second" in emitted[2]
+    assert "could not decrypt" in emitted[1]
+    saved = list(client_dir.glob("eve-*" + UNDECRYPTED_SUFFIX))
+    assert len(saved) == 1 and saved[0].read_bytes() == b"not encrypted for bob"
+    assert remaining == ""
+    # the whole page was handled so it was acknowledged
+    assert server.mail_store.count("bob") == 0
+    assert read(ClientCommands("bob", address)) == "no messages\n"
+
+
+def test_daemon_read_returns_the_messages_together(server, client_dir):
+    address = send_messages(server, client_dir)
+    output = read(ClientCommands("bob", address))
+
+    assert output.index("first") < output.index("could not decrypt") < output.index("second")
+    assert server.mail_store.count("bob") == 0
+
+
+def test_attachment_from_a_sender_named_like_a_path_stays_in_the_client_directory(server, client_dir):
+    address = ('127.0.0.1', server.port)
+
+    async def run():
+        bob = ClientCommands("bob", address)
+        await bob.register()
+        await bob.client.close()
+        async with AsyncClient('127.0.0.1', server.port, "../../evil") as evil:
+            await evil.create("bob", ATTACHMENT_MAGIC + (8).to_bytes(2, "big") + b"note.txt" + b"payload")
+
+    asyncio.run(run())
+    output = read(ClientCommands("bob", address))
+
+    assert "Attachment:" in output
+    assert not (client_dir.parent.parent / "evil-note.txt").exists()
+    assert (client_dir / ".._.._evil-note.txt").read_bytes() == b"payload"
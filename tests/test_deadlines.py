@@ -0,0 +1,90 @@
+"""Tests for the per-phase connection deadlines
+
+Name: Zya Gurau
+"""
+
+import socket
+import threading
+import time
+
+from common import HEADER_V2, RESPONSE_HEADER_V2, MAGIC_V2, STATUS_ID, STATUS_OK, recv_exact
+from deadlines import Deadlines, DEADLINE_TICK, PHASE_BODY, PHASE_HEADER
+
+
+def closed_within(sock, seconds):
+    """Returns how long the peer took to close the connection, None if it was still open after seconds"""
+
+    start = time.monotonic()
+    sock.settimeout(seconds)
+    try:
+        while sock.recv(4096):
+            pass
+    except socket.timeout:
+        return None
+    except ConnectionResetError:
+        pass
+    return time.monotonic() - start
+
+
+def test_expire_shuts_down_connections_past_their_deadline():
+    deadlines = Deadlines(header=1.0, body=1.0)
+    a, b = socket.socketpair()
+    c, d = socket.socketpair()
+    with a, b, c, d:
+        deadlines.arm(a, PHASE_HEADER)
+        deadlines.arm(c, PHASE_BODY)
+        deadlines.extend(c, deadlines.min_rate)
+        assert deadlines.expire(time.monotonic() + 1.5) == 1
+        assert b.recv(1) == b""
+        assert deadlines.clear(a) == PHASE_HEADER
+        assert deadlines.expire(time.monotonic() + 2.5) == 1
+        assert deadlines.clear(c) == PHASE_BODY
+        assert deadlines.metrics() == {"connections": 0, "culled": {"header": 1, "body": 1, "idle": 0, "write": 0}}
+
+
+def test_rearming_replaces_the_last_deadline():
+    deadlines = Deadlines(header=1.0, idle=10.0)
+    a, b = socket.socketpair()
+    with a, b:
+        deadlines.arm(a, PHASE_HEADER)
+        deadlines.arm(a, "idle")
+        assert deadlines.expire(time.monotonic() + 5) == 0
+        assert deadlines.clear(a) is None
+
+
+def test_silent_connection_is_closed_after_the_header_timeout(start_server):
+    server = start_server(deadlines=Deadlines(header=0.2))
+    with socket.create_connection(('127.0.0.1', server.port)) as c:
+        took = closed_within(c, 5)
+    assert took is not None and took < 0.2 + 3 * DEADLINE_TICK
+
+
+def test_declared_length_buys_no_time_for_a_trickled_body(start_server):
+    # declaring 4 GiB would once have bought 430 seconds at this rate
+    server = start_server(deadlines=Deadlines(body=0.2, min_rate=10 * 1024 * 1024))
+    with socket.create_connection(('127.0.0.1', server.port)) as c:
+        c.sendall(HEADER_V2.pack(MAGIC_V2, 2, 0, 3, 3, 0xFFFFFFFF) + b"alibob")
+        c.sendall(b"x" * 100)
+        took = closed_within(c, 5)
+    assert took is not None and took < 0.2 + 3 * DEADLINE_TICK
+    assert server.mail_store.count("bob") == 0
+
+
+def test_body_sent_faster_than_the_min_rate_is_not_cut_off(start_server):
+    # the body takes longer than the body timeout, but each piece arrives in time
+    server = start_server(deadlines=Deadlines(body=0.2, min_rate=512 * 1024))
+    body = b"y" * (1536 * 1024)
+
+    def trickle(c):
+        for index in range(0, len(body), 256 * 1024):
+            c.sendall(body[index:index + 256 * 1024])
+            time.sleep(0.1)
+
+    with socket.create_connection(('127.0.0.1', server.port)) as c:
+        c.sendall(HEADER_V2.pack(MAGIC_V2, 2, 0, 3, 3, len(body)) + b"alibob")
+        sender = threading.Thread(target=trickle, args=(c,))
+        sender.start()
+        reply = RESPONSE_HEADER_V2.unpack(recv_exact(c, RESPONSE_HEADER_V2.size))
+        sender.join()
+    assert reply == (MAGIC_V2, STATUS_ID, 0, STATUS_OK)
+    assert server.mail_store.count("bob") == 1
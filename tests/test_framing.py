@@ -0,0 +1,98 @@
+"""Tests for the v2 framing helpers and the server's checks on declared lengths
+
+Name: Zya Gurau
+"""
+
+import socket
+import threading
+import tracemalloc
+
+import pytest
+
+from common import (CHUNK_HEADER, HEADER_V2, MAGIC_V2, READ_ACKED, FLAG_ACK, FLAG_CHUNKED, recv_chunked,
+    recv_exact)
+
+
+def closed_by_peer(sock):
+    """True once the peer has closed the connection, the close is a reset if it left bytes unread"""
+    sock.settimeout(5)
+    try:
+        return sock.recv(64) == b""
+    except ConnectionResetError:
+        return True
+
+
+def send_chunks(sock, chunks):
+    for chunk in chunks:
+        sock.sendall(CHUNK_HEADER.pack(len(chunk)) + chunk)
+    sock.sendall(CHUNK_HEADER.pack(0))
+
+
+def test_recv_chunked_reassembles_known_and_unknown_lengths():
+    a, b = socket.socketpair()
+    with a, b:
+        send_chunks(a, [b"abc", b"defg"])
+        assert recv_chunked(b, 7) == b"abcdefg"
+        send_chunks(a, [b"x" * 5000, b"y"])
+        assert recv_chunked(b, 0) == b"x" * 5000 + b"y"
+
+
+def test_recv_chunked_rejects_chunks_not_matching_the_length():
+    a, b = socket.socketpair()
+    with a, b:
+        send_chunks(a, [b"abc", b"defg"])
+        with pytest.raises(ValueError):
+            recv_chunked(b, 5)
+    a, b = socket.socketpair()
+    with a, b:
+        send_chunks(a, [b"abc"])
+        with pytest.raises(ValueError):
+            recv_chunked(b, 4)
+
+
+def test_claimed_lengths_are_not_preallocated():
+    a, b = socket.socketpair()
+    with a, b:
+        tracemalloc.start()
+        try:
+            send_chunks(a, [b"abc"])
+            with pytest.raises(ValueError):
+                recv_chunked(b, 0xFFFFFFFF)
+            a.sendall(b"abc")
+            a.shutdown(socket.SHUT_WR)
+            with pytest.raises(ConnectionError):
+                recv_exact(b, 0xFFFFFFFF)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    assert peak < 4 * 1024 * 1024
+
+
+def test_recv_exact_large_body_arrives_whole():
+    a, b = socket.socketpair()
+    body = bytes(range(256)) * 4096
+    sender = threading.Thread(target=a.sendall, args=(body,))
+    with a, b:
+        sender.start()
+        assert recv_exact(b, len(body)) == body
+        sender.join()
+
+
+def test_server_refuses_an_oversized_read_body(server):
+    with socket.create_connection(('127.0.0.1', server.port)) as c:
+        c.sendall(HEADER_V2.pack(MAGIC_V2, 1, FLAG_ACK, 3, 0, 0xFFFFFFFF) + b"bob")
+        assert closed_by_peer(c)
+    # the server carries on serving other connections
+    with socket.create_connection(('127.0.0.1', server.port)) as c:
+        c.sendall(HEADER_V2.pack(MAGIC_V2, 1, FLAG_ACK, 3, 0, READ_ACKED.size) + b"bob" + READ_ACKED.pack(10, 0))
+        c.settimeout(5)
+        assert c.recv(64)[:2] == MAGIC_V2.to_bytes(2, "big")
+
+
+def test_server_grows_a_chunked_create_as_it_arrives(server):
+    with socket.create_connection(('127.0.0.1', server.port)) as c:
+        c.sendall(HEADER_V2.pack(MAGIC_V2, 2, FLAG_CHUNKED, 3, 3, 1000) + b"alibob")
+        send_chunks(c, [b"a" * 600, b"b" * 400])
+        c.settimeout(5)
+        assert c.recv(64)
+    assert server.mail_store.count("bob") == 1
@@ -0,0 +1,57 @@
+"""Tests for public key registration and the key responses
+
+Name: Zya Gurau
+"""
+
+import asyncio
+import socket
+
+import pytest
+
+from async_client import AsyncClient
+from common import HEADER_V2, MAGIC_V2, MAX_KEY_BITS, REGISTER_BINARY_ID, encode_key_int, recv_exact
+from test_framing import closed_by_peer
+
+
+def decimal_keys(server):
+    """Fetches the key directory with a v1 ID 6 request, returning name -> (n, e)"""
+
+    with socket.create_connection(('127.0.0.1', server.port)) as c:
+        c.sendall(bytes([0xAE, 0x73, 6, 3, 0, 0, 0]) + b"ali")
+        header = recv_exact(c, 5)
+        assert header[:3] == bytes([0xAE, 0x73, 6])
+        keys = dict()
+        for i in range(header[3]):
+            name_len, e_len, n_high, n_low = recv_exact(c, 4)
+            fields = recv_exact(c, name_len + e_len + (n_high << 8 | n_low))
+            keys[fields[:name_len].decode("utf-8")] = (int(fields[name_len + e_len:]),
+                int(fields[name_len:name_len + e_len]))
+        return keys
+
+
+def test_oversized_key_is_refused_and_decimal_keys_still_load(server):
+    async def register():
+        async with AsyncClient('127.0.0.1', server.port, "bob") as bob:
+            await bob.register(65537 * 3, 65537)
+            with pytest.raises(ValueError):
+                await bob.register((1 << 16000) - 1, 65537)
+
+    asyncio.run(register())
+    e = encode_key_int(65537)
+    n = encode_key_int((1 << (MAX_KEY_BITS + 1)) - 1)
+    with socket.create_connection(('127.0.0.1', server.port)) as c:
+        c.sendall(HEADER_V2.pack(MAGIC_V2, REGISTER_BINARY_ID, 0, 3, len(e), len(n)) + b"eve" + e + n)
+        assert closed_by_peer(c)
+    assert decimal_keys(server) == {"bob": (65537 * 3, 65537)}
+
+
+def test_largest_key_round_trips_in_both_encodings(server):
+    n = (1 << MAX_KEY_BITS) - 1
+
+    async def register_and_fetch():
+        async with AsyncClient('127.0.0.1', server.port, "bob") as bob:
+            await bob.register(n, 65537)
+            return await bob.fetch_keys()
+
+    assert asyncio.run(register_and_fetch()) == {"bob": (n, 65537)}
+    assert decimal_keys(server) == {"bob": (n, 65537)}
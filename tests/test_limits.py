@@ -0,0 +1,139 @@
+"""Tests for message TTLs and the mailbox and total byte caps
+
+Name: Zya Gurau
+"""
+
+import asyncio
+import time
+
+import pytest
+
+from async_client import AsyncClient, StatusError
+from common import STATUS_OK, STATUS_DROPPED_OLDEST, STATUS_MAILBOX_FULL
+from limits import Limits, LimitedMailStore, MailboxFull, OVERFLOW_DROP_OLDEST
+from storage import MemoryMailStore
+
+
+@pytest.fixture
+def limited():
+    stores = []
+
+    def wrap(**kwargs):
+        stores.append(LimitedMailStore(MemoryMailStore(), Limits(**kwargs)))
+        return stores[-1]
+
+    yield wrap
+    for store in stores:
+        store.close()
+
+
+def bodies(store, recipient):
+    return [bytes(message) for seq, sender, message in store.peek(recipient, 100)]
+
+
+def test_message_over_the_mailbox_cap_is_refused(limited):
+    store = limited(mailbox_bytes=10)
+    store.append("bob", "ali", bytearray(b"123456"))
+    with pytest.raises(MailboxFull):
+        store.append("bob", "ali", bytearray(b"12345"))
+    # other mailboxes have caps of their own
+    store.append("eve", "ali", bytearray(b"12345"))
+    assert store.metrics()["rejected"] == 1
+    assert bodies(store, "bob") == [b"123456"]
+
+
+def test_drop_oldest_makes_room_in_the_mailbox(limited):
+    store = limited(mailbox_bytes=10, overflow=OVERFLOW_DROP_OLDEST)
+    store.append("eve", "ali", bytearray(b"eve"))
+    for body in (b"aaaa", b"bbbb", b"cccc"):
+        seq, dropped = store.append_limited("bob", "ali", bytearray(body))
+    assert dropped == 1
+    assert bodies(store, "bob") == [b"bbbb", b"cccc"]
+    assert bodies(store, "eve") == [b"eve"]
+    with pytest.raises(MailboxFull):
+        store.append("bob", "ali", bytearray(11))
+
+
+def test_drop_oldest_makes_room_across_mailboxes_for_the_total_cap(limited):
+    store = limited(total_bytes=10, overflow=OVERFLOW_DROP_OLDEST)
+    store.append("bob", "ali", bytearray(b"aaaa"))
+    store.append("eve", "ali", bytearray(b"bbbb"))
+    seq, dropped = store.append_limited("eve", "ali", bytearray(b"cccc"))
+    assert dropped == 1
+    assert bodies(store, "bob") == []
+    assert store.metrics()["bytes"] == 8
+
+
+def test_read_messages_no_longer_count_towards_the_caps(limited):
+    store = limited(mailbox_bytes=10)
+    seq = store.append("bob", "ali", bytearray(b"123456"))
+    store.remove("bob", [seq])
+    store.append("bob", "ali", bytearray(b"1234567890"))
+    assert store.metrics()["bytes"] == 10
+
+
+def test_messages_expire_after_their_ttl(limited):
+    store = limited(default_ttl=100)
+    store.append_limited("bob", "ali", bytearray(b"short"), ttl=5)
+    # a sender can't ask for longer than the default
+    store.append_limited("bob", "ali", bytearray(b"capped"), ttl=1000)
+    store.append("bob", "ali", bytearray(b"default"))
+    now = time.monotonic()
+    assert store.expire(now + 10) == 1
+    assert bodies(store, "bob") == [b"capped", b"default"]
+    assert store.expire(now + 110) == 2
+    assert bodies(store, "bob") == []
+    assert store.metrics()["expired"] == 3
+
+
+def test_inactive_store_tracks_but_never_refuses_or_expires(limited):
+    store = limited(mailbox_bytes=4, default_ttl=1)
+    store.active = False
+    store.append("bob", "ali", bytearray(b"12345678"))
+    assert store.expire(time.monotonic() + 10) == 0
+    assert store.metrics()["bytes"] == 8
+
+
+def test_server_reports_refused_and_dropping_creates(start_server):
+    refusing = start_server(limits=Limits(mailbox_bytes=10))
+    dropping = start_server(limits=Limits(mailbox_bytes=10, overflow=OVERFLOW_DROP_OLDEST))
+
+    async def run(server):
+        async with AsyncClient('127.0.0.1', server.port, "ali") as ali:
+            statuses = [await ali.create("bob", b"12345678")]
+            try:
+                statuses.append(await ali.create("bob", b"12345678"))
+            except StatusError as err:
+                statuses.append(err.status)
+            return statuses
+
+    assert asyncio.run(run(refusing)) == [STATUS_OK, STATUS_MAILBOX_FULL]
+    assert asyncio.run(run(dropping)) == [STATUS_OK, STATUS_DROPPED_OLDEST]
+    assert refusing.mail_store.count("bob") == 1
+    assert dropping.mail_store.count("bob") == 1
+
+
+def test_server_expires_a_create_with_a_ttl(start_server):
+    server = start_server(limits=Limits())
+
+    async def run():
+        async with AsyncClient('127.0.0.1', server.port, "ali") as ali:
+            await ali.create("bob", b"soon", ttl=2)
+            await ali.create("bob", b"kept")
+
+    asyncio.run(run())
+    assert server.limits.expire(time.monotonic() + 3) == 1
+    assert bodies(server.mail_store, "bob") == [b"kept"]
+
+
+def test_server_without_limits_still_expires_a_create_with_a_ttl(server):
+    async def run():
+        async with AsyncClient('127.0.0.1', server.port, "ali") as ali:
+            assert await ali.create("bob", b"soon", ttl=1) == STATUS_OK
+            await ali.create("bob", b"kept")
+
+    asyncio.run(run())
+    deadline = time.monotonic() + 5
+    while server.mail_store.count("bob") > 1 and time.monotonic() < deadline:
+        time.sleep(0.1)
+    assert bodies(server.mail_store, "bob") == [b"kept"]
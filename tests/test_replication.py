@@ -0,0 +1,129 @@
+"""Tests for hot-standby replication and promoting a follower after its primary fails
+
+Name: Zya Gurau
+"""
+
+import asyncio
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+from async_client import AsyncClient, ClientError, StatusError
+from common import STATUS_READ_ONLY, parse_address
+
+SERVER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "server.py")
+
+
+def wait_for(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            if condition():
+                return True
+        except (OSError, ClientError):
+            pass
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def depths(port, names):
+    async def run():
+        async with AsyncClient('127.0.0.1', port, "probe") as probe:
+            return await probe.depths(names)
+
+    return asyncio.run(run())
+
+
+async def fill_primary(port):
+    async with AsyncClient('127.0.0.1', port, "ali") as ali:
+        await ali.register(2 ** 512 + 1, 65537)
+        for i in range(20):
+            await ali.create("bob", b"m%d" % i)
+        await ali.create("eve", b"x" * (2 * 1024 * 1024))
+    async with AsyncClient('127.0.0.1', port, "bob") as bob:
+        items, more_msgs = await bob.read(5)
+    return items
+
+
+async def read_everything(port, name):
+    async with AsyncClient('127.0.0.1', port, name) as client:
+        items, more_msgs = await client.read()
+        return items
+
+
+def test_follower_applies_the_primary_and_serves_after_promotion(start_server, tmp_path):
+    repl = str(tmp_path / "repl.sock")
+    primary = start_server(replicate=parse_address("unix:" + repl))
+    follower = start_server(follow=parse_address("unix:" + repl))
+
+    asyncio.run(fill_primary(primary.port))
+    assert wait_for(lambda: depths(follower.port, ["bob", "eve"]) == {"bob": (15, 40), "eve": (1, 2 * 1024 * 1024)})
+
+    async def refused():
+        async with AsyncClient('127.0.0.1', follower.port, "ali") as ali:
+            with pytest.raises(StatusError) as err:
+                await ali.create("bob", b"no")
+            return err.value.status, await ali.fetch_keys()
+
+    status, keys = asyncio.run(refused())
+    assert status == STATUS_READ_ONLY
+    assert keys == {"ali": (2 ** 512 + 1, 65537)}
+
+    primary.stop()
+    follower.promote()
+    items = asyncio.run(read_everything(follower.port, "bob"))
+    assert [message for sender, message in items] == [b"m%d" % i for i in range(5, 20)]
+    assert follower.mail_store.count("eve") == 1
+
+
+def test_two_process_failover(tmp_path):
+    repl = "unix:" + str(tmp_path / "repl.sock")
+    primary_port, follower_port = free_port(), free_port()
+    processes = []
+
+    def spawn(*args):
+        processes.append(subprocess.Popen([sys.executable, SERVER, *args],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=str(tmp_path)))
+        return processes[-1]
+
+    try:
+        primary = spawn(str(primary_port), "--replicate", repl)
+        assert wait_for(lambda: depths(primary_port, ["bob"]) == {"bob": (0, 0)})
+        asyncio.run(fill_primary(primary_port))
+
+        # the follower starts late, so it is sent a snapshot and then the stream
+        follower = spawn(str(follower_port), "--follow", repl)
+        assert wait_for(lambda: depths(follower_port, ["bob"]) == {"bob": (15, 40)})
+
+        async def more():
+            async with AsyncClient('127.0.0.1', primary_port, "ali") as ali:
+                await ali.create("bob", b"after")
+
+        asyncio.run(more())
+        assert wait_for(lambda: depths(follower_port, ["bob"]) == {"bob": (16, 45)})
+
+        # the primary dies without warning and the follower is promoted in its place
+        primary.kill()
+        primary.wait()
+        follower.send_signal(signal.SIGUSR1)
+        assert wait_for(lambda: asyncio.run(read_everything(follower_port, "eve")) != [])
+
+        items = asyncio.run(read_everything(follower_port, "bob"))
+        assert [message for sender, message in items] == [b"m%d" % i for i in range(5, 20)] + [b"after"]
+        assert depths(follower_port, ["bob", "eve"]) == {"bob": (0, 0), "eve": (0, 0)}
+    finally:
+        for process in processes:
+            process.kill()
+            process.wait()
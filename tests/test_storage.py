@@ -0,0 +1,84 @@
+"""Tests for the memory store's spilling of cold mailboxes to segment files
+
+Name: Zya Gurau
+"""
+
+import time
+
+import pytest
+
+import storage
+from storage import MemoryMailStore, SpoolPayload
+
+
+@pytest.fixture
+def fast_spill_checks(monkeypatch):
+    monkeypatch.setattr(storage, "SPILL_CHECK_INTERVAL", 0.01)
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_idle_store_spills_unused_mailboxes(tmp_path, fast_spill_checks):
+    store = MemoryMailStore(str(tmp_path), spill_after=0.05)
+    try:
+        store.append("bob", "ali", bytearray(b"hello"))
+        store.append("eve", "ali", bytearray(b"hi"))
+        # nothing else is stored or read, the store's own thread spills them
+        assert wait_for(lambda: store.metrics()["spilled_mailboxes"] == 2)
+        assert store.metrics()["resident_bytes"] == 0
+        assert store.count("bob") == 1
+        assert store.depths(["bob", "eve"]) == [(1, 5), (1, 2)]
+        assert [(sender, bytes(message)) for seq, sender, message in store.peek("bob", 10)] == [("ali", b"hello")]
+        assert store.metrics()["spilled_mailboxes"] == 1
+    finally:
+        store.close()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_messages_stored_while_spilled_are_read_back(tmp_path, fast_spill_checks):
+    store = MemoryMailStore(str(tmp_path), spill_after=0.05)
+    try:
+        store.append("bob", "ali", bytearray(b"first"))
+        assert wait_for(lambda: store.metrics()["spilled_mailboxes"] == 1)
+        store.append("bob", "eve", bytearray(b"second"))
+        items = store.peek("bob", 10)
+        assert [(sender, bytes(message)) for seq, sender, message in items] == [("ali", b"first"), ("eve", b"second")]
+    finally:
+        store.close()
+
+
+def test_memory_limit_spills_the_largest_mailboxes(tmp_path):
+    store = MemoryMailStore(str(tmp_path), memory_limit=64 * 1024)
+    try:
+        for i in range(10):
+            store.append("big", "ali", bytearray(10 * 1024))
+        store.append("small", "ali", bytearray(10))
+        assert store.metrics()["resident_bytes"] <= 64 * 1024
+        assert "big" in store.spilled
+        assert store.count("big") == 10
+    finally:
+        store.close()
+
+
+def test_spooled_message_over_4_gib_survives_a_spill(tmp_path, fast_spill_checks):
+    store = MemoryMailStore(str(tmp_path), spill_after=0.05)
+    length = 5 * 1024 * 1024 * 1024
+    payload = SpoolPayload(str(tmp_path / "huge.msg"), length)
+    try:
+        store.append("bob", "ali", bytearray(b"first"))
+        assert wait_for(lambda: store.metrics()["spilled_mailboxes"] == 1)
+        # appended to the segment as a record, the body is kept by reference
+        store.append("bob", "ali", payload)
+        assert store.depths(["bob"]) == [(2, length + 5)]
+        seq, sender, message = store.peek("bob", 10)[1]
+        assert message is payload
+        assert len(message) == length
+    finally:
+        store.close()
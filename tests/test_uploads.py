@@ -0,0 +1,117 @@
+"""Tests for resumable uploads and the checks on upload tokens
+
+Name: Zya Gurau
+"""
+
+import asyncio
+import io
+
+import pytest
+
+import async_client
+from async_client import AsyncClient, StatusError, read_upload_state
+from common import (MessageRequestV2, UPLOAD_OPEN_ID, UPLOAD_CHUNK_ID, UPLOAD_QUERY_ID, UPLOAD_OPEN,
+    UPLOAD_CHUNK, UPLOAD_QUERY, STATUS_OK, STATUS_UNKNOWN_UPLOAD, FLAG_KEEP_ALIVE)
+
+TOKEN = bytes(range(16))
+
+
+async def open_upload(client, receiver, length, token=TOKEN):
+    return await client.request(client.make_request(UPLOAD_OPEN_ID, receiver.encode("utf-8"),
+        UPLOAD_OPEN.pack(token, length)), read_upload_state)
+
+
+async def send_chunk(client, offset, data, token=TOKEN):
+    message_request = MessageRequestV2(UPLOAD_CHUNK_ID, len(client.name_bytes), 0, UPLOAD_CHUNK.size + len(data),
+        FLAG_KEEP_ALIVE)
+    message_request.add_name(client.name_bytes)
+    message_request.add_message(UPLOAD_CHUNK.pack(token, offset))
+    return await client.request(message_request, read_upload_state, data)
+
+
+async def query_upload(client, token=TOKEN):
+    return await client.request(client.make_request(UPLOAD_QUERY_ID, message=UPLOAD_QUERY.pack(token)),
+        read_upload_state)
+
+
+def test_upload_is_stored_whole(server, monkeypatch):
+    monkeypatch.setattr(async_client, "UPLOAD_PIECE", 1000)
+    body = bytes(range(256)) * 20
+
+    async def run():
+        async with AsyncClient('127.0.0.1', server.port, "ali") as ali:
+            await ali.upload("bob", io.BytesIO(body[5:]), len(body) - 5, prefix=body[:5])
+        async with AsyncClient('127.0.0.1', server.port, "bob") as bob:
+            return await bob.read()
+
+    items, more_msgs = asyncio.run(run())
+    assert items == [("ali", body)]
+    assert not more_msgs
+
+
+def test_upload_resumes_from_the_committed_offset(server, monkeypatch):
+    monkeypatch.setattr(async_client, "UPLOAD_PIECE", 1000)
+    body = bytes(range(256)) * 20
+
+    async def run():
+        async with AsyncClient('127.0.0.1', server.port, "ali") as ali:
+            assert await open_upload(ali, "bob", len(body)) == (STATUS_OK, False, 0)
+            assert await send_chunk(ali, 0, body[:1500]) == (STATUS_OK, False, 1500)
+            # a chunk from the wrong offset is refused and the committed offset returned
+            assert (await send_chunk(ali, 1000, body[1000:2000]))[2] == 1500
+        # the client that gave up is gone, another process resumes with the same token
+        async with AsyncClient('127.0.0.1', server.port, "ali") as ali:
+            assert await query_upload(ali) == (STATUS_OK, False, 1500)
+            await ali.upload("bob", io.BytesIO(body), len(body), token=TOKEN)
+            assert await query_upload(ali) == (STATUS_OK, True, len(body))
+        async with AsyncClient('127.0.0.1', server.port, "bob") as bob:
+            return await bob.read()
+
+    items, more_msgs = asyncio.run(run())
+    assert items == [("ali", body)]
+    assert server.uploads == {}
+
+
+@pytest.mark.parametrize("name, receiver, length", [("eve", "bob", 100), ("ali", "eve", 100), ("ali", "bob", 99)])
+def test_open_upload_token_mismatch_is_unknown(server, name, receiver, length):
+    async def run():
+        async with AsyncClient('127.0.0.1', server.port, "ali") as ali:
+            await open_upload(ali, "bob", 100)
+            await send_chunk(ali, 0, b"a" * 40)
+        async with AsyncClient('127.0.0.1', server.port, name) as other:
+            return await open_upload(other, receiver, length), await query_upload(other)
+
+    opened, queried = asyncio.run(run())
+    assert opened == (STATUS_UNKNOWN_UPLOAD, False, 0)
+    if name != "ali":
+        assert queried == (STATUS_UNKNOWN_UPLOAD, False, 0)
+    session = server.uploads[TOKEN]
+    assert (session.sender, session.receiver, session.length, session.offset) == ("ali", "bob", 100, 40)
+
+
+def test_completed_upload_token_is_only_reported_to_its_uploader(server):
+    async def run():
+        async with AsyncClient('127.0.0.1', server.port, "ali") as ali:
+            await open_upload(ali, "bob", 10)
+            assert await send_chunk(ali, 0, b"a" * 10) == (STATUS_OK, True, 10)
+            again = await open_upload(ali, "bob", 10)
+        async with AsyncClient('127.0.0.1', server.port, "eve") as eve:
+            return again, await open_upload(eve, "bob", 10), await query_upload(eve)
+
+    again, opened, queried = asyncio.run(run())
+    assert again == (STATUS_OK, True, 10)
+    assert opened == (STATUS_UNKNOWN_UPLOAD, False, 0)
+    assert queried == (STATUS_UNKNOWN_UPLOAD, False, 0)
+    assert server.mail_store.count("bob") == 1
+
+
+def test_client_upload_raises_on_a_token_in_use(server):
+    async def run():
+        async with AsyncClient('127.0.0.1', server.port, "ali") as ali:
+            await open_upload(ali, "bob", 100)
+        async with AsyncClient('127.0.0.1', server.port, "eve") as eve:
+            await eve.upload("bob", io.BytesIO(b"e" * 100), 100, token=TOKEN)
+
+    with pytest.raises(StatusError) as err:
+        asyncio.run(run())
+    assert err.value.status == STATUS_UNKNOWN_UPLOAD
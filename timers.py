@@ -0,0 +1,99 @@
+"""A hierarchical timing wheel for scheduling many timeouts cheaply
+
+Scheduling, cancelling and expiring a timer are O(1) amortized however many are
+pending, there is no periodic scan of every timer. Level 0 has one slot per tick,
+each slot of level n covers a whole turn of level n - 1, and a slot is moved down a
+level once time reaches it, so a timer is handled at most once per level.
+
+Name: Zya Gurau
+"""
+
+class TimingWheel:
+    """Timers grouped into wheels of slots, the caller provides its own locking
+
+    Args:
+        tick (float): the resolution in seconds, timers expire up to one tick late
+        now (float): the current time, from the same clock later passed to advance()
+        slot_bits (int): each level has 2 ** slot_bits slots
+        levels (int): the number of wheels, timers further out than all of them
+            together are parked in the top level and placed again when it comes round
+    """
+
+    def __init__(self, tick, now, slot_bits=8, levels=4):
+        self.tick = tick
+        self.slot_bits = slot_bits
+        self.mask = (1 << slot_bits) - 1
+        self.levels = levels
+        self.wheels = [[[] for slot in range(1 << slot_bits)] for level in range(levels)]
+        # the last tick that has been expired
+        self.current = int(now / tick)
+        # the number of timers scheduled and not yet expired or cancelled
+        self.pending = 0
+
+    def schedule(self, deadline, item):
+        """Adds a timer
+
+        Args:
+            deadline (float): when the timer expires
+            item: what advance() returns once it has
+
+        Returns:
+            (list): the timer, to pass to cancel()
+        """
+
+        timer = [max(int(deadline / self.tick + 0.999999), self.current + 1), item, True]
+        self.place(timer)
+        self.pending += 1
+        return timer
+
+    def cancel(self, timer):
+        """Cancels a timer, it is dropped from its slot when the slot next comes round"""
+
+        if timer[2]:
+            timer[2] = False
+            self.pending -= 1
+
+    def place(self, timer):
+        expires = timer[0]
+        for level in range(self.levels):
+            if expires - self.current < 1 << (self.slot_bits * (level + 1)):
+                self.wheels[level][(expires >> (self.slot_bits * level)) & self.mask].append(timer)
+                return None
+        # parks the timer in the furthest top level slot, it is placed again when that comes round
+        parked = self.current + (1 << (self.slot_bits * self.levels)) - 1
+        self.wheels[-1][(parked >> (self.slot_bits * (self.levels - 1))) & self.mask].append(timer)
+
+    def advance(self, now):
+        """Moves the wheel on to now, returning the items of the timers that have expired"""
+
+        expired = []
+        target = int(now / self.tick)
+        if self.pending == 0:
+            # nothing to expire, the slots only hold cancelled timers that can wait
+            self.current = max(self.current, target)
+            return expired
+        while self.current < target:
+            self.current += 1
+            # when a level turns over, the next slot of the level above is moved down
+            for level in range(1, self.levels):
+                if self.current & ((1 << (self.slot_bits * level)) - 1):
+                    break
+                slot = (self.current >> (self.slot_bits * level)) & self.mask
+                timers = self.wheels[level][slot]
+                self.wheels[level][slot] = []
+                for timer in timers:
+                    if timer[2]:
+                        self.place(timer)
+            slot = self.current & self.mask
+            timers = self.wheels[0][slot]
+            self.wheels[0][slot] = []
+            for timer in timers:
+                if not timer[2]:
+                    continue
+                if timer[0] <= self.current:
+                    timer[2] = False
+                    self.pending -= 1
+                    expired.append(timer[1])
+                else:
+                    self.place(timer)
+        return expired